@@ -1,11 +1,11 @@
 import os
 import sys
-from flask import Flask, render_template, jsonify, request, send_file
+from flask import Flask, Response, render_template, jsonify, request, send_file, stream_with_context
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta
 import pandas as pd
 from io import BytesIO
-from utils.database import Database
+from utils.database import Database, VOLUME_DIMENSIONS, VOLUME_RESOLUTIONS
 
 # تحميل متغيرات البيئة من ملف .env
 load_dotenv()
@@ -26,35 +26,40 @@ db = Database(database_url)
 
 # إضافة استيراد TaskerAutomation
 from utils.tasker_automation import TaskerAutomation
+from utils.tasker_outbox import TaskerOutboxWorker
+from utils.tasker_devices import TaskerDeviceRegistry
 tasker = TaskerAutomation()
+tasker_devices = TaskerDeviceRegistry(db)
+tasker_outbox = TaskerOutboxWorker(db, tasker, tasker_devices)
 
-# تحميل متغيرات البيئة من ملف .env
-load_dotenv()
+from utils.tasker_callbacks import TaskerCallbackIngestor, SIGNATURE_HEADER, ATTEMPT_HEADER
+from utils.tasker_reaper import summarize_latency
+tasker_callbacks = TaskerCallbackIngestor(db)
+tasker_callbacks.start()
 
-# إضافة المسار الرئيسي إلى Python path
-current_dir = os.path.dirname(os.path.abspath(__file__))
-parent_dir = os.path.dirname(current_dir)
-sys.path.append(parent_dir)
+# تخزين مؤقت لاستجابات القراءة، تبطله نقاط الكتابة
+from dashboard.response_cache import ResponseCache
+response_cache = ResponseCache()
 
-# التأكد من وجود رابط قاعدة البيانات
-database_url = os.getenv("DATABASE_URL")
-if not database_url:
-    raise ValueError("DATABASE_URL غير موجود في ملف .env")
+# مستمع واحد لإشعارات التحويلات يوزعها على كل المتصفحات المتصلة
+from utils.transfer_events import TransferEventBroker
+transfer_events = TransferEventBroker(database_url)
 
-# إنشاء تطبيق Flask
-app = Flask(__name__)
-db = Database(database_url)
+# عدد الأكواد في كل صفحة من قائمة الأكواد
+CODES_PAGE_SIZE = int(os.getenv('DASHBOARD_CODES_PAGE_SIZE', '50'))
 
 @app.route('/')
+@response_cache.cached('statistics', 'codes')
 def dashboard():
     """عرض لوحة التحكم الرئيسية"""
     try:
         stats = db.get_statistics()
-        codes = db.get_all_codes()
-        return render_template('index.html', stats=stats, codes=codes)
+        codes = db.list_codes(limit=CODES_PAGE_SIZE)
+        return render_template('index.html', stats=stats, codes=codes['codes'], next_cursor=codes['next_cursor'])
     except Exception as e:
         app.logger.error(f"خطأ في عرض لوحة التحكم: {e}")
-        return render_template('index.html', stats={}, codes=[], error="حدث خطأ في الاتصال بقاعدة البيانات")
+        # رمز 503 حتى لا يخزن ResponseCache صفحة الخطأ المؤقت ويعرضها لكل المشرفين
+        return render_template('index.html', stats={}, codes=[], error="حدث خطأ في الاتصال بقاعدة البيانات"), 503
 
 @app.route('/transfers')
 def transfers_page():
@@ -73,6 +78,29 @@ def get_transfers():
     transfers = db.get_transfers(page=page, per_page=per_page, status=status)
     return jsonify(transfers)
 
+@app.route('/api/transfers/search')
+def search_transfers():
+    """البحث في التحويلات بالاسم أو الرقم أو رقم الحساب أو الهاش أو معرف التحويل"""
+    query = request.args.get('q', '')
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 20, type=int), 1), 100)
+    status = request.args.get('status')
+    if len(query.strip()) < 2:
+        return jsonify({'success': False, 'error': 'Query must be at least 2 characters'}), 400
+    return jsonify(db.search_transfers(query, page=page, per_page=per_page, status=status))
+
+@app.route('/api/transfers/stream')
+def transfer_stream():
+    """بث مباشر (Server-Sent Events) للتحويلات الجديدة وتغير حالتها"""
+    subscription = transfer_events.subscribe(request.headers.get('Last-Event-ID'))
+    if subscription is None:
+        return jsonify({'success': False, 'error': 'Too many live connections'}), 503, {'Retry-After': '30'}
+    return Response(
+        stream_with_context(transfer_events.stream(subscription)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 @app.route('/api/transfers/<transfer_id>')
 def get_transfer_details(transfer_id):
     """الحصول على تفاصيل تحويل معين عبر API"""
@@ -82,18 +110,60 @@ def get_transfer_details(transfer_id):
     return jsonify({'error': 'Transfer not found'}), 404
 
 @app.route('/api/statistics')
+@response_cache.cached('statistics')
 def get_statistics():
     """الحصول على الإحصائيات عبر API"""
     stats = db.get_statistics()
     return jsonify(stats)
 
+@app.route('/api/timeseries')
+@response_cache.cached('timeseries')
+def get_timeseries():
+    """
+    عدد وأحجام التحويلات لكل دقيقة/ساعة/يوم من الدلاء المجمعة.
+    المعاملات: start وend بصيغة ISO (افتراضياً آخر 7 أيام)، resolution (اختياري)،
+    group_by مفصولة بفواصل، وتصفية بأي من usdt_network وlocal_currency وwallet_name وstatus.
+    """
+    def parse_time(name):
+        value = datetime.fromisoformat(request.args[name].replace('Z', '+00:00'))
+        # created_at يحفظ بالتوقيت المحلي بدون منطقة زمنية
+        return value.astimezone().replace(tzinfo=None) if value.tzinfo else value
+
+    try:
+        end = parse_time('end') if request.args.get('end') else datetime.now()
+        start = parse_time('start') if request.args.get('start') else end - timedelta(days=7)
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Invalid start or end date'}), 400
+    if start >= end:
+        return jsonify({'success': False, 'error': 'start must be before end'}), 400
+
+    resolution = request.args.get('resolution') or None
+    if resolution and resolution not in VOLUME_RESOLUTIONS:
+        return jsonify({'success': False, 'error': f"resolution must be one of {', '.join(VOLUME_RESOLUTIONS)}"}), 400
+    group_by = [name.strip() for name in request.args.get('group_by', '').split(',') if name.strip()]
+    unknown = [name for name in group_by if name not in VOLUME_DIMENSIONS]
+    if unknown:
+        return jsonify({'success': False, 'error': f"Unknown group_by: {', '.join(unknown)}"}), 400
+    filters = {name: request.args[name] for name in VOLUME_DIMENSIONS if name in request.args}
+
+    return jsonify(db.get_volume_timeseries(start, end, resolution=resolution, group_by=group_by, filters=filters))
+
 @app.route('/api/codes', methods=['GET'])
+@response_cache.cached('codes')
 def get_codes():
-    """عرض جميع الأكواد عبر API"""
-    codes = db.get_all_codes()
-    return jsonify(codes)
+    """
+    صفحة من الأكواد عبر API. المعاملات: limit، after (قيمة next_cursor من الصفحة السابقة)،
+    q للبحث في الكود والوصف، وstatus (active أو inactive).
+    """
+    limit = min(max(request.args.get('limit', CODES_PAGE_SIZE, type=int), 1), 200)
+    after = request.args.get('after', type=int)
+    status = request.args.get('status') or None
+    if status and status not in ('active', 'inactive'):
+        return jsonify({'success': False, 'error': 'Invalid status'}), 400
+    return jsonify(db.list_codes(limit=limit, after=after, query=request.args.get('q'), status=status))
 
 @app.route('/api/codes', methods=['POST'])
+@response_cache.invalidates('codes')
 def add_code():
     """إضافة كود جديد عبر API"""
     try:
@@ -139,6 +209,7 @@ def add_code():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/codes/<code>', methods=['PUT'])
+@response_cache.invalidates('codes')
 def update_code(code):
     """تحديث كود معين عبر API"""
     data = request.json
@@ -176,12 +247,14 @@ def get_code_details(code):
     return jsonify({'error': 'Code not found'}), 404
 
 @app.route('/api/codes/<code>', methods=['DELETE'])
+@response_cache.invalidates('codes')
 def delete_code(code):
     """حذف كود معين عبر API"""
     success = db.delete_registration_code(code)
     return jsonify({'success': success})
 
 @app.route('/api/settings', methods=['GET', 'POST'])
+@response_cache.cached('settings')
 def handle_settings():
     """إعدادات البوت عبر API"""
     if request.method == 'POST':
@@ -195,6 +268,7 @@ def handle_settings():
             'max_withdrawal': float(data.get('max_withdrawal', 1000))
         }
         success = db.update_settings(settings)
+        response_cache.invalidate('settings')
         return jsonify({'success': success})
     else:
         # استرجاع الإعدادات من قاعدة البيانات
@@ -213,12 +287,14 @@ def handle_settings():
         return jsonify(settings)
 
 @app.route('/api/exchange-rates', methods=['GET'])
+@response_cache.cached('rates')
 def get_exchange_rates():
     """الحصول على جميع أسعار الصرف عبر API"""
     rates = db.get_exchange_rates()
     return jsonify(rates)
 
 @app.route('/api/exchange-rates/<currency>', methods=['PUT'])
+@response_cache.invalidates('rates')
 def update_exchange_rate(currency):
     """تحديث سعر الصرف لعملة معينة عبر API"""
     data = request.json
@@ -232,6 +308,7 @@ def update_exchange_rate(currency):
         return jsonify({'error': 'Invalid rate value'}), 400
 
 @app.route('/api/exchange-rates/<currency>', methods=['DELETE'])
+@response_cache.invalidates('rates')
 def delete_exchange_rate(currency):
     """حذف سعر الصرف لعملة معينة عبر API"""
     success = db.delete_exchange_rate(currency)
@@ -324,6 +401,7 @@ def export_codes():
         return jsonify({'error': 'حدث خطأ أثناء تصدير الأكواد'}), 500
 
 @app.route('/import-codes', methods=['POST'])
+@response_cache.invalidates('codes')
 def import_codes():
     """استيراد الأكواد من ملف إكسل"""
     try:
@@ -351,6 +429,7 @@ def import_codes():
         return jsonify({'error': str(e)}), 500
 
 @app.route('/add-test-codes')
+@response_cache.invalidates('codes')
 def add_test_codes():
     """إضافة أكواد اختبار للتجربة"""
     try:
@@ -364,44 +443,104 @@ def add_test_codes():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/tasker/callback', methods=['POST'])
+@app.route('/tasker_callback', methods=['POST'])
 def tasker_callback():
     """
     نقطة نهاية لاستقبال نتائج التحويل من Tasker
+    تقبل نتيجة تحويل واحد، أو نتائج دفعة كاملة في قائمة results.
+    النتائج تحفظ في صندوق وارد يتجاهل المكرر، وتطبق على التحويلات في الخلفية.
     """
     try:
-        data = request.json
+        if not tasker_callbacks.signing_enabled:
+            app.logger.error("رفض استدعاء Tasker: TASKER_CALLBACK_SECRET غير محدد")
+            return jsonify({'success': False, 'error': 'signing not configured'}), 503
+        
+        body = request.get_data(cache=True)
+        if not tasker_callbacks.verify_signature(body, request.headers.get(SIGNATURE_HEADER)):
+            app.logger.warning("تم رفض استدعاء Tasker بتوقيع غير صالح")
+            return jsonify({'success': False, 'error': 'invalid signature'}), 401
+        
+        data = request.get_json(silent=True)
         if not data:
             return jsonify({'success': False, 'error': 'No data provided'}), 400
         
-        # التحقق من وجود معرف التحويل
-        if 'transfer_id' not in data:
-            return jsonify({'success': False, 'error': 'transfer_id is required'}), 400
+        callbacks, error = tasker_callbacks.parse(data, request.headers.get(ATTEMPT_HEADER))
+        if error:
+            return jsonify({'success': False, 'error': error}), 400
         
-        # معالجة نتيجة التحويل
-        result = tasker.handle_tasker_callback(data)
+        inserted = tasker_callbacks.ingest(callbacks)
+        if inserted is None:
+            # Tasker يعيد المحاولة عند فشل الحفظ
+            return jsonify({'success': False, 'error': 'فشل في حفظ النتيجة'}), 503
         
-        # تحديث حالة التحويل في قاعدة البيانات
-        transfer_id = data.get('transfer_id')
-        success = data.get('success', False)
-        error_message = data.get('error')
+        return jsonify({
+            'success': True,
+            'accepted': inserted,
+            'duplicates': len(callbacks) - inserted
+        }), 202
         
-        if success:
-            # تحديث حالة التحويل إلى "مكتمل"
-            db.update_transfer_status(transfer_id, 'completed')
-            app.logger.info(f"تم تحديث حالة التحويل {transfer_id} إلى مكتمل")
-        else:
-            # تحديث حالة التحويل إلى "فشل" مع سبب الفشل
-            db.update_transfer_status(
-                transfer_id, 
-                'failed', 
-                rejection_reason=error_message or "فشل التحويل التلقائي"
-            )
-            app.logger.error(f"فشل التحويل {transfer_id}: {error_message}")
+    except Exception as e:
+        app.logger.error(f"خطأ في معالجة استدعاء Tasker: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/tasker/heartbeat', methods=['POST'])
+def tasker_heartbeat():
+    """
+    نبضة جهاز Tasker: يعلن الجهاز عنوانه وأنواع المحافظ التي يخدمها وسعته.
+    تتطلب نفس توقيع HMAC المستخدم في الاستدعاءات العكسية لأن العنوان المعلن يستقبل بيانات التحويلات.
+    """
+    try:
+        if not tasker_callbacks.signing_enabled:
+            app.logger.error("رفض نبضة جهاز Tasker: TASKER_CALLBACK_SECRET غير محدد")
+            return jsonify({'success': False, 'error': 'signing not configured'}), 503
+        
+        body = request.get_data(cache=True)
+        if not tasker_callbacks.verify_signature(body, request.headers.get(SIGNATURE_HEADER)):
+            app.logger.warning("تم رفض نبضة جهاز Tasker بتوقيع غير صالح")
+            return jsonify({'success': False, 'error': 'invalid signature'}), 401
+        
+        data = request.get_json(silent=True)
+        if not data:
+            return jsonify({'success': False, 'error': 'No data provided'}), 400
         
-        return jsonify(result)
+        success, error = tasker_devices.heartbeat(data)
+        if not success:
+            return jsonify({'success': False, 'error': error}), 400
+        
+        return jsonify({'success': True, 'heartbeat_ttl': tasker_devices.heartbeat_ttl})
         
     except Exception as e:
-        app.logger.error(f"خطأ في معالجة استدعاء Tasker: {e}")
+        app.logger.error(f"خطأ في معالجة نبضة جهاز Tasker: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/tasker/devices')
+def get_tasker_devices():
+    """
+    عرض أجهزة Tasker المسجلة وحالتها
+    """
+    try:
+        devices = tasker_devices.list_devices()
+        now = datetime.now()
+        for device in devices:
+            last_heartbeat = device.get('last_heartbeat')
+            device['healthy'] = bool(
+                device.get('enabled') and last_heartbeat
+                and (now - last_heartbeat).total_seconds() < tasker_devices.heartbeat_ttl
+            )
+            if last_heartbeat:
+                device['last_heartbeat'] = last_heartbeat.isoformat()
+        return jsonify({'success': True, 'devices': devices})
+    except Exception as e:
+        app.logger.error(f"خطأ في عرض أجهزة Tasker: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/tasker/latency')
+def get_tasker_latency():
+    """مدرج زمن التنفيذ من الإرسال حتى الاستدعاء العكسي لكل جهاز ومحفظة"""
+    try:
+        return jsonify({'success': True, 'latency': summarize_latency(db.get_tasker_latency())})
+    except Exception as e:
+        app.logger.error(f"خطأ في جلب زمن تنفيذ Tasker: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/transfers/<transfer_id>/automate', methods=['POST'])
@@ -422,61 +561,25 @@ def automate_transfer(transfer_id):
                 'error': f"لا يمكن أتمتة التحويل في الحالة {transfer.get('status')}"
             }), 400
         
-        # تحديث حالة التحويل إلى "جاري المعالجة"
-        db.update_transfer_status(transfer_id, 'processing')
-        
-        # إرسال التحويل إلى Tasker
-        result = tasker.send_transfer_to_tasker(transfer)
+        # تحديث الحالة وإضافة مهمة Tasker في نفس المعاملة، وعمال البوت يتولون الإرسال
+        if not tasker_outbox.enqueue(transfer):
+            return jsonify({
+                'success': False,
+                'error': 'تعذرت جدولة التحويل (تغيرت حالته أو توجد مهمة نشطة له)'
+            }), 409
         
-        # إذا كان هناك رابط Tasker، نقوم بإرجاعه
-        tasker_link = result.get('tasker_link', '')
+        # رابط Tasker معروف مسبقاً من بيانات التحويل
+        tasker_link = tasker.build_tasker_link(transfer)
         
         return jsonify({
             'success': True,
             'message': 'تم بدء عملية التحويل التلقائي',
-            'tasker_result': result,
             'tasker_link': tasker_link
-        })
+        }), 202
         
     except Exception as e:
         app.logger.error(f"خطأ في بدء التحويل التلقائي: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
-@app.route('/tasker_callback', methods=['POST'])
-def tasker_callback():
-    """
-    نقطة نهاية لاستقبال نتائج التحويل من Tasker
-    """
-    try:
-        data = request.json
-        
-        if not data:
-            return jsonify({'success': False, 'error': 'No data received'}), 400
-        
-        transfer_id = data.get('transfer_id')
-        status = data.get('status')
-        result = data.get('result')
-        error = data.get('error')
-        
-        if not transfer_id or not status:
-            return jsonify({'success': False, 'error': 'Missing required fields'}), 400
-        
-        # تحديث حالة التحويل في قاعدة البيانات
-        if status == 'completed':
-            db.update_transfer_status(transfer_id, 'completed')
-            app.logger.info(f"تم اكتمال التحويل بنجاح: {transfer_id}")
-        elif status == 'failed':
-            db.update_transfer_status(transfer_id, 'failed', error)
-            app.logger.error(f"فشل التحويل: {transfer_id} - {error}")
-        else:
-            db.update_transfer_status(transfer_id, status)
-            app.logger.info(f"تم تحديث حالة التحويل: {transfer_id} - {status}")
-        
-        return jsonify({'success': True, 'message': 'تم استلام النتيجة بنجاح'})
-        
-    except Exception as e:
-        app.logger.error(f"خطأ في معالجة استدعاء Tasker: {e}")
-        return jsonify({'success': False, 'error': str(e)}), 500
-
 if __name__ == '__main__':
     print("Please run the application using run.py")
@@ -0,0 +1,134 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from functools import wraps
+from typing import Dict, Optional, Tuple
+
+from flask import Response, make_response, request
+
+logger = logging.getLogger(__name__)
+
+
+class _CachedResponse:
+    __slots__ = ('expires_at', 'generation', 'body', 'etag', 'mimetype', 'headers')
+
+    def __init__(self, expires_at: float, generation: Tuple, body: bytes, etag: str, mimetype: str, headers: Dict):
+        self.expires_at = expires_at
+        self.generation = generation
+        self.body = body
+        self.etag = etag
+        self.mimetype = mimetype
+        self.headers = headers
+
+
+class ResponseCache:
+    """
+    تخزين مؤقت لاستجابات لوحة التحكم لمدة قصيرة مع ETag.
+    الطلب المتكرر يعاد من الذاكرة دون قاعدة بيانات أو تحويل JSON، ويرد بـ 304 إذا لم يتغير المحتوى.
+
+    كل مسار يرتبط بمجموعات (codes، settings...) ونقاط الكتابة تبطل مجموعاتها.
+    الإبطال يسجل كتوقيت ملف في DASHBOARD_CACHE_DIR فيصل لكل عمال gunicorn بدون قاعدة البيانات.
+    """
+
+    def __init__(self, ttl: float = None, state_dir: str = None, max_entries: int = None):
+        self.ttl = ttl if ttl is not None else float(os.getenv('DASHBOARD_CACHE_TTL', '10'))
+        self.state_dir = state_dir or os.getenv('DASHBOARD_CACHE_DIR', os.path.join('data', 'dashboard_cache'))
+        self.max_entries = max_entries or int(os.getenv('DASHBOARD_CACHE_ENTRIES', '256'))
+        self._entries: 'OrderedDict[Tuple, _CachedResponse]' = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(self.state_dir, exist_ok=True)
+
+    def _generation(self, groups: Tuple[str, ...]) -> Tuple:
+        generation = []
+        for group in groups:
+            try:
+                generation.append(os.stat(os.path.join(self.state_dir, group)).st_mtime_ns)
+            except OSError:
+                generation.append(0)
+        return tuple(generation)
+
+    def invalidate(self, *groups: str) -> None:
+        """إبطال المجموعات في كل العمليات"""
+        for group in groups:
+            path = os.path.join(self.state_dir, group)
+            try:
+                with open(path, 'w') as f:
+                    f.write(str(time.time_ns()))
+            except OSError as e:
+                logger.error(f"خطأ في إبطال التخزين المؤقت للمجموعة {group}: {e}")
+        with self._lock:
+            self._entries = OrderedDict(
+                (key, entry) for key, entry in self._entries.items() if not set(key[0]) & set(groups)
+            )
+
+    @staticmethod
+    def _not_modified(etag: str) -> Optional[Response]:
+        if request.if_none_match and request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return None
+
+    @staticmethod
+    def _build(entry: _CachedResponse) -> Response:
+        response = Response(entry.body, mimetype=entry.mimetype, headers=entry.headers)
+        response.set_etag(entry.etag)
+        # المتصفح يعيد التحقق بـ If-None-Match مع كل طلب بدلاً من استخدام نسخة قديمة
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    def cached(self, *groups: str):
+        """تخزين استجابات GET لهذا المسار، مفتاحها المسار ومعاملات الاستعلام"""
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if request.method not in ('GET', 'HEAD'):
+                    return view(*args, **kwargs)
+
+                key = (groups, request.path, tuple(sorted(request.args.items(multi=True))))
+                generation = self._generation(groups)
+                now = time.monotonic()
+
+                with self._lock:
+                    entry = self._entries.get(key)
+                    if entry is not None and entry.expires_at > now and entry.generation == generation:
+                        self._entries.move_to_end(key)
+                    else:
+                        entry = None
+
+                if entry is None:
+                    response = make_response(view(*args, **kwargs))
+                    # الأخطاء لا تخزن، فخطأ عابر في قاعدة البيانات لا يعرض طوال مدة التخزين
+                    if response.status_code != 200 or response.direct_passthrough:
+                        return response
+                    body = response.get_data()
+                    entry = _CachedResponse(
+                        now + self.ttl, generation, body,
+                        hashlib.sha1(body).hexdigest(), response.mimetype,
+                        {name: value for name, value in response.headers.items()
+                         if name not in ('Content-Length', 'Content-Type', 'ETag', 'Cache-Control')}
+                    )
+                    with self._lock:
+                        self._entries[key] = entry
+                        while len(self._entries) > self.max_entries:
+                            self._entries.popitem(last=False)
+
+                return self._not_modified(entry.etag) or self._build(entry)
+            return wrapper
+        return decorator
+
+    def invalidates(self, *groups: str):
+        """إبطال المجموعات بعد تنفيذ نقطة كتابة"""
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    self.invalidate(*groups)
+            return wrapper
+        return decorator
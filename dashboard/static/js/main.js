@@ -30,6 +30,10 @@ function showCodeModal(isEdit = false, code = null) {
     }
 }
 
+function editCode(code) {
+    showCodeModal(true, code);
+}
+
 function hideCodeModal() {
     const modal = document.getElementById('codeModal');
     const hasChanges = document.getElementById('codeInput').value || 
@@ -203,6 +207,96 @@ async function deleteCode(code) {
     }
 }
 
+// قائمة الأكواد: صفحات بالمفتاح مع بحث وتصفية
+let codesSearchTimer = null;
+
+function renderCodeRow(code) {
+    const row = document.createElement('tr');
+    row.className = 'hover:bg-gray-50';
+
+    const cell = (className, text) => {
+        const td = document.createElement('td');
+        td.className = className;
+        if (text !== undefined) td.textContent = text;
+        row.appendChild(td);
+        return td;
+    };
+
+    cell('px-6 py-4 font-medium', code.code);
+    cell('px-6 py-4', code.description || '');
+
+    const statusBadge = document.createElement('span');
+    statusBadge.className = `px-3 py-1 ${code.status === 'active' ? 'bg-green-100 text-green-800' : 'bg-red-100 text-red-800'} rounded-full text-sm`;
+    statusBadge.textContent = code.status === 'active' ? '✅ نشط' : '❌ متوقف';
+    cell('px-6 py-4').appendChild(statusBadge);
+
+    const usage = document.createElement('div');
+    usage.className = 'flex items-center';
+    usage.innerHTML = code.max_uses > 0
+        ? `<span class="font-medium"></span>
+           <span class="text-gray-500 text-sm mr-1">/ ${Number(code.max_uses)}</span>
+           <div class="w-20 bg-gray-200 rounded-full h-2 mr-2">
+               <div class="bg-blue-500 rounded-full h-2" style="width: ${Math.round(code.used_count / code.max_uses * 100)}%"></div>
+           </div>`
+        : '<span class="font-medium"></span><span class="text-gray-500 text-sm mr-1">/ ∞</span>';
+    usage.querySelector('.font-medium').textContent = code.used_count;
+    cell('px-6 py-4').appendChild(usage);
+
+    cell('px-6 py-4 text-gray-500', code.created_at || '');
+
+    const totals = document.createElement('div');
+    totals.className = 'flex flex-col';
+    totals.innerHTML = `
+        <span class="font-medium">${Number(code.total_usdt || 0).toFixed(2)} USDT</span>
+        <span class="text-sm text-gray-500">${Number(code.total_amount || 0).toFixed(2)} USD</span>
+    `;
+    cell('px-6 py-4').appendChild(totals);
+
+    const actions = document.createElement('div');
+    actions.className = 'flex space-x-2 space-x-reverse';
+    const addAction = (className, label, handler) => {
+        const button = document.createElement('button');
+        button.className = `${className} px-2 py-1 rounded`;
+        button.innerHTML = `<span class="text-sm">${label}</span>`;
+        button.addEventListener('click', () => handler(code.code));
+        actions.appendChild(button);
+    };
+    addAction('text-yellow-500 hover:text-yellow-600', '✏️ تعديل', editCode);
+    if (code.status === 'active') {
+        addAction('text-orange-500 hover:text-orange-600', '🚫 إيقاف', deactivateCode);
+    } else {
+        addAction('text-green-500 hover:text-green-600', '✅ تفعيل', activateCode);
+    }
+    addAction('text-red-500 hover:text-red-600', '🗑️ حذف', deleteCode);
+    cell('px-6 py-4').appendChild(actions);
+
+    return row;
+}
+
+async function loadCodes(reset = true) {
+    const tbody = document.getElementById('codesList');
+    const loadMore = document.getElementById('loadMoreCodes');
+    const params = new URLSearchParams();
+    const query = document.getElementById('codeSearch').value.trim();
+    const status = document.getElementById('codeStatusFilter').value;
+    if (query) params.set('q', query);
+    if (status) params.set('status', status);
+    if (!reset && tbody.dataset.nextCursor) params.set('after', tbody.dataset.nextCursor);
+
+    try {
+        const response = await fetch(`/api/codes?${params}`);
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        const data = await response.json();
+        if (reset) tbody.innerHTML = '';
+        data.codes.forEach(code => tbody.appendChild(renderCodeRow(code)));
+        tbody.dataset.nextCursor = data.next_cursor || '';
+        loadMore.classList.toggle('hidden', !data.next_cursor);
+    } catch (error) {
+        console.error('Error loading codes:', error);
+        alert('حدث خطأ في تحميل الأكواد');
+    }
+}
+
 // حفظ الإعدادات
 async function saveSettings() {
     // التحقق من وجود تغييرات
@@ -399,6 +493,13 @@ async function loadExchangeRates() {
 }
 
 window.onload = async function() {
+    // البحث والتصفية في قائمة الأكواد
+    document.getElementById('codeSearch').addEventListener('input', () => {
+        clearTimeout(codesSearchTimer);
+        codesSearchTimer = setTimeout(() => loadCodes(true), 300);
+    });
+    document.getElementById('codeStatusFilter').addEventListener('change', () => loadCodes(true));
+
     // تحميل أسعار الصرف
     await loadExchangeRates();
 
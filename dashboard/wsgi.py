@@ -0,0 +1,14 @@
+"""
+نقطة دخول لوحة التحكم لخوادم WSGI (gunicorn) في عملية مستقلة عن البوت:
+
+    gunicorn -c gunicorn.conf.py dashboard.wsgi:app
+"""
+import os
+import sys
+
+# جذر المشروع في المسار حتى تعمل استيرادات utils عند التشغيل من أي مجلد
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dashboard.dashboard import app  # noqa: E402
+
+application = app
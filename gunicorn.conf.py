@@ -0,0 +1,31 @@
+# إعدادات gunicorn للوحة التحكم (python run.py dashboard)
+import os
+import multiprocessing
+
+bind = os.getenv('DASHBOARD_BIND', f"0.0.0.0:{os.getenv('PORT', '5000')}")
+
+# عدة عمليات حتى لا تحجز تصديرات pandas والإحصائيات الثقيلة بقية الطلبات،
+# وخيوط داخل كل عملية لأن أغلب الطلبات تنتظر قاعدة البيانات،
+# وكل متصفح مفتوح على البث المباشر (/api/transfers/stream) يشغل خيطاً،
+# لذلك يقتصر البث افتراضياً على نصف الخيوط (DASHBOARD_MAX_STREAMS = threads // 2)
+workers = int(os.getenv('DASHBOARD_WORKERS', str(min(4, multiprocessing.cpu_count() * 2 + 1))))
+worker_class = 'gthread'
+threads = int(os.getenv('DASHBOARD_THREADS', '16'))
+
+# التصدير إلى Excel قد يستغرق وقتاً
+timeout = int(os.getenv('DASHBOARD_TIMEOUT', '120'))
+graceful_timeout = 30
+keepalive = 5
+
+# إعادة تشغيل العامل دورياً لتحرير ذاكرة pandas
+max_requests = int(os.getenv('DASHBOARD_MAX_REQUESTS', '1000'))
+max_requests_jitter = 100
+
+# الخيوط لا تنتقل عبر fork: خيط تطبيق استدعاءات Tasker يبدأ عند استيراد dashboard.py،
+# وخيط الاستماع لأحداث التحويلات (LISTEN) يبدأ مع أول متصفح على البث المباشر،
+# لذلك يستورد كل عامل التطبيق بنفسه فيشغل هذه الخيوط ويفتح اتصالاته الخاصة
+preload_app = False
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.getenv('DASHBOARD_LOG_LEVEL', 'info')
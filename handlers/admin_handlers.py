@@ -4,12 +4,19 @@ from telegram.ext import ContextTypes, ConversationHandler
 from config.config import States, ADMIN_GROUP_ID
 from utils.database import Database
 from utils.message_utils import send_message_with_retry, edit_message_with_retry, edit_message_reply_markup_with_retry, round_local_amount
+import os
 import logging
 import re
+import html
 import asyncio
+from functools import partial
 from datetime import datetime
 from pytz import timezone
 from utils.tasker_automation import TaskerAutomation
+from utils.tasker_outbox import TaskerOutboxWorker
+from utils.tasker_devices import TaskerDeviceRegistry
+from utils.tasker_reaper import TaskerReaper
+from utils.transfer_pipeline import TransferPipeline
 
 __all__ = [
     'admin_response_handler',
@@ -21,116 +28,57 @@ __all__ = [
 
 db = Database()
 tasker = TaskerAutomation()
+tasker_devices = TaskerDeviceRegistry(db)
+tasker_outbox = TaskerOutboxWorker(db, tasker, tasker_devices)
+tasker_reaper = TaskerReaper(db, tasker)
+# خط معالجة التحويلات بعد التحقق (Tasker، الإشعارات، التسجيل)
+transfer_pipeline = TransferPipeline()
 logger = logging.getLogger(__name__)
 
-async def edit_message_with_retry(context, chat_id, message_id, text, parse_mode=None, reply_markup=None):
-    """
-    Intenta editar un mensaje y maneja los errores comunes.
-    Si no se puede editar, intenta enviar un nuevo mensaje.
-    """
-    try:
-        await context.bot.edit_message_text(
-            chat_id=chat_id,
-            message_id=message_id,
-            text=text,
-            parse_mode=parse_mode,
-            reply_markup=reply_markup
+# ----- مراحل خط معالجة التحويل بعد حفظه -----
+
+async def dispatch_transfer(transfer_data: dict):
+    """مرحلة Tasker: جدولة التحويل للمعالجة التلقائية إن أمكن"""
+    transfer_id = transfer_data.get('transfer_id')
+    if transfer_data.get('recovered'):
+        # تحويل أعيد إدخاله بعد إعادة التشغيل: الحالة المحفوظة تحدد هل جدول سابقاً، فلا يعاد إرساله
+        transfer_data['automated'] = transfer_data.get('status') == 'processing'
+        return
+    # تغيير الحالة إلى "جاري المعالجة" وإضافة مهمة Tasker في نفس المعاملة
+    queued = await tasker_outbox.enqueue_async(transfer_data)
+    transfer_data['automated'] = queued
+    if queued:
+        logger.info(f"تمت جدولة التحويل التلقائي: {transfer_id}")
+    else:
+        logger.warning(f"تعذرت جدولة التحويل تلقائياً، سيرسل للمشرفين: {transfer_id}")
+
+async def notify_transfer_user(bot, transfer_data: dict):
+    """مرحلة إشعار المستخدم بأن التحويل يعالج تلقائياً"""
+    if not transfer_data.get('automated') or transfer_data.get('recovered'):
+        return
+    await bot.send_message(
+        chat_id=transfer_data.get('user_id'),
+        text=(
+            "🤖 تم استلام طلب التحويل الخاص بك وجاري معالجته تلقائياً.\n"
+            "سيتم إعلامك بالنتيجة النهائية قريباً."
         )
-    except telegram.error.BadRequest as e:
-        if "There is no text in the message to edit" in str(e):
-            logger.info("El mensaje no tiene texto para editar, enviando un nuevo mensaje")
-            try:
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=text,
-                    parse_mode=parse_mode,
-                    reply_markup=reply_markup
-                )
-            except Exception as send_err:
-                logger.error(f"Error al enviar nuevo mensaje: {send_err}")
-        else:
-            logger.error(f"خطأ في تعديل رسالة: {e}")
-            # Si falla la edición, intentamos eliminar el mensaje y enviar uno nuevo
-            try:
-                await context.bot.delete_message(
-                    chat_id=chat_id,
-                    message_id=message_id
-                )
-            except Exception:
-                pass
-                
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=text,
-                parse_mode=parse_mode,
-                reply_markup=reply_markup
-            )
-    except Exception as e:
-        logger.error(f"خطأ في تعديل رسالة: {e}")
+    )
 
-async def send_admin_notification(context: ContextTypes.DEFAULT_TYPE, transfer_data: dict):
-    """
-    إرسال إشعار للمشرفين عن طلب تحويل جديد
-    
-    :param context: سياق المحادثة
-    :param transfer_data: بيانات التحويل
-    """
-    try:
-        transfer_id = transfer_data.get('transfer_id')
-        user_id = transfer_data.get('user_id')
-        
-        # محاولة معالجة التحويل تلقائياً أولاً
-        try:
-            logger.info(f"محاولة معالجة التحويل تلقائياً: {transfer_id}")
-            
-            # تحديث حالة التحويل إلى "جاري المعالجة"
-            db.update_transfer_status(transfer_id, 'processing')
-            
-            # إرسال التحويل إلى Tasker
-            result = tasker.send_transfer_to_tasker(transfer_data)
-            
-            if result.get('success', False):
-                # تم بدء العملية بنجاح
-                logger.info(f"تم بدء عملية التحويل التلقائي بنجاح: {transfer_id}")
-                
-                # إرسال إشعار للمستخدم
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=(
-                        "🤖 تم استلام طلب التحويل الخاص بك وجاري معالجته تلقائياً.\n"
-                        "سيتم إعلامك بالنتيجة النهائية قريباً."
-                    )
-                )
-                
-                # إرسال إشعار للمشرفين
-                admin_message = (
-                    f"🔄 جاري معالجة التحويل تلقائياً:\n\n"
-                    f"{format_transfer_details(transfer_data)}\n\n"
-                    f"🤖 سيتم إعلامكم بالنتيجة النهائية قريباً."
-                )
-                
-                await context.bot.send_message(
-                    chat_id=ADMIN_GROUP_ID,
-                    text=admin_message
-                )
-                
-                return True  # تم المعالجة بنجاح
-            else:
-                # فشل في المعالجة التلقائية، إرسال الطلب للمشرفين
-                error_message = result.get('error', 'خطأ غير معروف')
-                logger.warning(f"فشل في معالجة التحويل تلقائياً: {transfer_id} - {error_message}")
-                
-                # إعادة التحويل إلى حالة معلق
-                db.update_transfer_status(transfer_id, 'pending')
-        except Exception as e:
-            logger.error(f"خطأ في محاولة المعالجة التلقائية: {e}")
-            # إعادة التحويل إلى حالة معلق
-            db.update_transfer_status(transfer_id, 'pending')
-        
-        # إذا وصلنا إلى هنا، فقد فشلت المعالجة التلقائية، نرسل الطلب للمشرفين
-        admin_message = format_transfer_details(transfer_data)
-        
-        # إنشاء أزرار التحكم
+async def notify_transfer_admins(bot, transfer_data: dict):
+    """مرحلة إشعار المشرفين: للمتابعة عند المعالجة التلقائية، أو مع أزرار التحكم للمعالجة اليدوية"""
+    transfer_id = transfer_data.get('transfer_id')
+
+    if transfer_data.get('automated'):
+        message = await bot.send_message(
+            chat_id=ADMIN_GROUP_ID,
+            text=(
+                f"🔄 جاري معالجة التحويل تلقائياً:\n\n"
+                f"{format_transfer_details(transfer_data)}\n\n"
+                f"🤖 سيتم إعلامكم بالنتيجة النهائية قريباً."
+            ),
+            parse_mode='HTML'
+        )
+    else:
         keyboard = [
             [
                 InlineKeyboardButton("✅ معالجة الطلب", callback_data=f"admin_approve_{transfer_id}"),
@@ -138,24 +86,103 @@ async def send_admin_notification(context: ContextTypes.DEFAULT_TYPE, transfer_d
             ],
             [InlineKeyboardButton("🤖 تحويل تلقائي", callback_data=f"admin_automate_{transfer_id}")]
         ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        # إرسال الإشعار للمشرفين
-        await context.bot.send_message(
+        message = await bot.send_message(
             chat_id=ADMIN_GROUP_ID,
-            text=admin_message,
-            reply_markup=reply_markup
+            text=format_transfer_details(transfer_data),
+            reply_markup=InlineKeyboardMarkup(keyboard),
+            parse_mode='HTML'
         )
-        
-        logger.info(f"تم إرسال إشعار للمشرفين عن التحويل: {transfer_id}")
-        return False  # تم إرسال الطلب للمشرفين
-        
-    except Exception as e:
-        logger.error(f"خطأ في إرسال إشعار للمشرفين: {e}")
+
+    transfer_data['admin_message_id'] = message.message_id
+    logger.info(f"تم إرسال إشعار للمشرفين عن التحويل: {transfer_id}")
+
+async def record_transfer_notification(transfer_data: dict):
+    """مرحلة التسجيل: حفظ رسالة المشرفين حتى لا يعاد الإشعار عند إعادة التشغيل"""
+    transfer_id = transfer_data.get('transfer_id')
+    admin_message_id = transfer_data.get('admin_message_id')
+    if not admin_message_id:
+        # فشل إشعار المشرفين نهائياً: يبقى التحويل غير مسجل فيعاد إدخاله عند إعادة التشغيل
+        logger.warning(f"لم يصل إشعار المشرفين للتحويل {transfer_id}، لن يسجل كمُشعَر")
         return False
+    if not await asyncio.to_thread(db.mark_transfer_notified, transfer_id, admin_message_id):
+        raise RuntimeError(f"تعذر تسجيل إشعار التحويل {transfer_id}")
+
+def start_transfer_pipeline(bot):
+    """تشغيل مراحل خط المعالجة وإعادة إدخال التحويلات التي لم يكتمل إشعارها"""
+    if not transfer_pipeline.stages:
+        (transfer_pipeline
+            .add_stage('dispatch', dispatch_transfer, workers=4, max_retries=3)
+            .add_stage('notify_user', partial(notify_transfer_user, bot), workers=4, max_retries=3)
+            .add_stage('notify_admins', partial(notify_transfer_admins, bot), workers=2, max_retries=5, retry_delay=5)
+            .add_stage('bookkeeping', record_transfer_notification, workers=1, max_retries=5))
+    transfer_pipeline.start()
+
+    window = int(os.getenv('PIPELINE_RECOVERY_WINDOW', '3600'))
+    for transfer in db.get_unnotified_transfers(window):
+        logger.info(f"إعادة إدخال التحويل {transfer['transfer_id']} إلى خط المعالجة")
+        transfer['recovered'] = True
+        transfer_pipeline.submit(transfer)
+
+async def notify_tasker_dead_letter(bot, job: dict):
+    """
+    إشعار المشرفين بفشل مهمة Tasker نهائياً بعد استنفاد المحاولات،
+    التحويل أعيد إلى حالة معلق لمعالجته يدوياً.
+    """
+    transfer_id = job.get('transfer_id')
+    transfer = db.get_transfer(transfer_id) or job.get('payload', {})
+    
+    keyboard = [
+        [
+            InlineKeyboardButton("✅ معالجة الطلب", callback_data=f"admin_approve_{transfer_id}"),
+            InlineKeyboardButton("❌ رفض الطلب", callback_data=f"admin_reject_{transfer_id}")
+        ],
+        [InlineKeyboardButton("🤖 تحويل تلقائي", callback_data=f"admin_automate_{transfer_id}")]
+    ]
+    
+    await bot.send_message(
+        chat_id=ADMIN_GROUP_ID,
+        text=(
+            f"{format_transfer_details(transfer)}\n\n"
+            f"⚠️ فشل التحويل التلقائي بعد {job.get('attempts')} محاولات: {html.escape(str(job.get('error') or '-'))}\n"
+            "يرجى معالجة الطلب يدوياً."
+        ),
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode='HTML'
+    )
+
+async def notify_tasker_stuck(bot, item: dict):
+    """
+    إشعار المشرفين بتحويل لم يصل رد Tasker عليه خلال مهلة المحفظة،
+    التحويل أعيد إلى حالة معلق لمعالجته يدوياً أو إعادة أتمتته.
+    """
+    transfer_id = item.get('transfer_id')
+    transfer = db.get_transfer(transfer_id) or item
+    device = html.escape(str(item.get('device_id') or 'الافتراضي'))
+    
+    keyboard = [
+        [
+            InlineKeyboardButton("✅ معالجة الطلب", callback_data=f"admin_approve_{transfer_id}"),
+            InlineKeyboardButton("❌ رفض الطلب", callback_data=f"admin_reject_{transfer_id}")
+        ],
+        [InlineKeyboardButton("🤖 تحويل تلقائي", callback_data=f"admin_automate_{transfer_id}")]
+    ]
+    
+    await bot.send_message(
+        chat_id=ADMIN_GROUP_ID,
+        text=(
+            f"{format_transfer_details(transfer)}\n\n"
+            f"⏰ لم يصل رد من جهاز Tasker ({device}) خلال {item.get('sla_seconds', 0):.0f} ثانية.\n"
+            "⚠️ تحقق من المحفظة قبل إعادة المعالجة لتجنب التحويل مرتين."
+        ),
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode='HTML'
+    )
 
 def format_transfer_details(transfer: dict) -> str:
-    """تنسيق تفاصيل التحويل في رسالة"""
+    """تنسيق تفاصيل التحويل في رسالة HTML، مع تهريب كل القيم لأن بعضها يدخله المستخدم"""
+    def esc(value) -> str:
+        return html.escape(str(value))
+
     details = (
         "📝 <b>تفاصيل التحويل:</b>\n"
         f"🔹 <b>نوع التحويل:</b> {'تحويل عبر الاسم' if transfer.get('transfer_type') == 'name_transfer' else 'إيداع لرقم حساب'}\n"
@@ -164,27 +191,27 @@ def format_transfer_details(transfer: dict) -> str:
     # إضافة معلومات المحفظة ورقم الحساب فقط لتحويلات الحساب
     if transfer.get('transfer_type') != 'name_transfer':
         details += (
-            f"🏦 <b>المحفظة:</b> <code>{transfer.get('wallet_name', '-')}</code>\n"
-            f"📊 <b>رقم الحساب:</b> <code>{transfer.get('account_number', '-')}</code>\n"
+            f"🏦 <b>المحفظة:</b> <code>{esc(transfer.get('wallet_name', '-'))}</code>\n"
+            f"📊 <b>رقم الحساب:</b> <code>{esc(transfer.get('account_number', '-'))}</code>\n"
         )
 
     details += (
-        f"💱 <b>العملة المحلية:</b> {transfer.get('local_currency', '-')}\n"
-        f"🌐 <b>الشبكة:</b> {transfer.get('usdt_network', '-')}\n"
+        f"💱 <b>العملة المحلية:</b> {esc(transfer.get('local_currency', '-'))}\n"
+        f"🌐 <b>الشبكة:</b> {esc(transfer.get('usdt_network', '-'))}\n"
         f"💎 <b>العملة الرقمية:</b> USDT\n"
-        f"💰 <b>المبلغ المحول:</b> <code>{transfer.get('amount', 0)}</code> USDT\n"
-        f"💸 <b>المبلغ بالعملة المحلية:</b> <code>{round_local_amount(transfer.get('local_amount', 0))}</code> {transfer.get('local_currency', '')}\n"
+        f"💰 <b>المبلغ المحول:</b> <code>{esc(transfer.get('amount', 0))}</code> USDT\n"
+        f"💸 <b>المبلغ بالعملة المحلية:</b> <code>{esc(round_local_amount(transfer.get('local_amount', 0)))}</code> {esc(transfer.get('local_currency', ''))}\n"
     )
 
     # إضافة معلومات المستلم للتحويل عبر الاسم
     if transfer.get('transfer_type') == 'name_transfer':
         details += (
             f"\n👤 <b>معلومات المستلم:</b>\n"
-            f"<b>الاسم:</b> <code>{transfer.get('recipient_name', '-')}</code>\n"
-            f"📱 <b>رقم الهاتف:</b> <code>{transfer.get('recipient_number', '-')}</code>\n"
+            f"<b>الاسم:</b> <code>{esc(transfer.get('recipient_name', '-'))}</code>\n"
+            f"📱 <b>رقم الهاتف:</b> <code>{esc(transfer.get('recipient_number', '-'))}</code>\n"
         )
         if agency := transfer.get('transfer_agency'):
-            details += f"📍 <b>جهة التحويل:</b> {agency}\n"
+            details += f"📍 <b>جهة التحويل:</b> {esc(agency)}\n"
 
     return details
 
@@ -290,7 +317,7 @@ async def admin_response_handler(update: Update, context: ContextTypes.DEFAULT_T
            )
            
            try:
-               await query.message.edit_text(new_message_text, reply_markup=reply_markup)
+               await edit_message_with_retry(context, query.message.chat_id, query.message.message_id, new_message_text, reply_markup=reply_markup)
            except telegram.error.BadRequest as e:
                if "Message is not modified" not in str(e):
                    try:
@@ -305,7 +332,8 @@ async def admin_response_handler(update: Update, context: ContextTypes.DEFAULT_T
            reply_markup = InlineKeyboardMarkup(keyboard)
            
            try:
-               await query.message.edit_text(
+               await edit_message_with_retry(
+                   context, query.message.chat_id, query.message.message_id,
                    f"{query.message.text}\n\n❌ الرجاء كتابة سبب الرفض:",
                    reply_markup=reply_markup
                )
@@ -335,9 +363,9 @@ async def admin_response_handler(update: Update, context: ContextTypes.DEFAULT_T
            original_message = context.user_data.get('admin_info', {}).get('original_message')
            try:
                if original_message:
-                   await query.message.edit_text(text=original_message, reply_markup=reply_markup)
+                   await edit_message_with_retry(context, query.message.chat_id, query.message.message_id, text=original_message, reply_markup=reply_markup)
                else:
-                   await query.message.edit_reply_markup(reply_markup=reply_markup)
+                   await edit_message_reply_markup_with_retry(context, query.message.chat_id, query.message.message_id, reply_markup=reply_markup)
            except telegram.error.BadRequest:
                try:
                    await query.message.reply_text(
@@ -480,7 +508,8 @@ async def handle_rejection_reason(update: Update, context: ContextTypes.DEFAULT_
                         chat_id=update.effective_chat.id,
                         message_id=admin_info['message_id'],
                         text=admin_confirmation,
-                        parse_mode='HTML'
+                        parse_mode='HTML',
+                        fallback_send=True
                     )
                     logger.info(f"تم تحديث رسالة المشرف في المجموعة")
                 except telegram.error.BadRequest as e:
@@ -539,7 +568,8 @@ async def start_new(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    await query.message.edit_text(
+    await edit_message_with_retry(
+        context, query.message.chat_id, query.message.message_id,
         "👋 مرحباً بكم في خدمة السحب الالي من MetaBit 🔷\n\n"
         "💸 الرجاء اختيار طريقة التحويل:",
         reply_markup=reply_markup
@@ -737,7 +767,6 @@ async def handle_transfer_info_message(update: Update, context: ContextTypes.DEF
         # حفظ البيانات في context.user_data للمراجعة
         context.user_data['transfer_info'] = {
             'transfer_id': transfer_id,
-            'transfer': transfer,
             'file_id': file_id,
             'message_type': message_type,
             'message_text': message_text
@@ -842,7 +871,8 @@ async def handle_receipt_upload(update: Update, context: ContextTypes.DEFAULT_TY
                     chat_id=user_id,
                     message_id=verification_msg_id,
                     text=confirmation_message,
-                    parse_mode='HTML'
+                    parse_mode='HTML',
+                    fallback_send=True
                 )
             except Exception as e:
                 logger.error(f"خطأ في تعديل رسالة التحقق: {e}")
@@ -887,7 +917,8 @@ async def handle_receipt_upload(update: Update, context: ContextTypes.DEFAULT_TY
         admin_info = context.user_data.get('admin_info', {})
         if admin_info and 'message_id' in admin_info:
             try:
-                await context.bot.edit_message_text(
+                await edit_message_with_retry(
+                    context=context,
                     chat_id=update.effective_chat.id,
                     message_id=admin_info['message_id'],
                     text=admin_confirmation,
@@ -954,7 +985,8 @@ async def handle_transfer_info(update: Update, context: ContextTypes.DEFAULT_TYP
                     chat_id=user_id,
                     message_id=verification_msg_id,
                     text=confirmation_message,
-                    parse_mode='HTML'
+                    parse_mode='HTML',
+                    fallback_send=True
                 )
             except Exception as e:
                 logger.error(f"خطأ في تعديل رسالة التحقق: {e}")
@@ -993,7 +1025,8 @@ async def handle_transfer_info(update: Update, context: ContextTypes.DEFAULT_TYP
         admin_info = context.user_data.get('admin_info', {})
         if admin_info and 'message_id' in admin_info:
             try:
-                await context.bot.edit_message_text(
+                await edit_message_with_retry(
+                    context=context,
                     chat_id=update.effective_chat.id,
                     message_id=admin_info['message_id'],
                     text=admin_confirmation,
@@ -1050,7 +1083,8 @@ async def handle_admin_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 message_id=query.message.message_id,
                 text=admin_message,
                 parse_mode='HTML',
-                reply_markup=reply_markup
+                reply_markup=reply_markup,
+                fallback_send=True
             )
         except Exception as e:
             logger.error(f"خطأ في تحديث رسالة المشرف: {e}")
@@ -1076,7 +1110,8 @@ async def cancel_admin_action(update: Update, context: ContextTypes.DEFAULT_TYPE
                 chat_id=query.message.chat_id,
                 message_id=query.message.message_id,
                 text="تم إلغاء العملية.",
-                parse_mode='HTML'
+                parse_mode='HTML',
+                fallback_send=True
             )
         except Exception as e:
             logger.error(f"خطأ في تحديث رسالة الإلغاء: {e}")
@@ -1101,7 +1136,7 @@ async def confirm_transfer_info(update: Update, context: ContextTypes.DEFAULT_TY
             return ConversationHandler.END
             
         transfer_id = transfer_info.get('transfer_id')
-        transfer = transfer_info.get('transfer')
+        transfer = db.get_transfer(transfer_id) if transfer_id else None
         file_id = transfer_info.get('file_id')
         message_type = transfer_info.get('message_type')
         message_text = transfer_info.get('message_text')
@@ -1167,7 +1202,8 @@ async def confirm_transfer_info(update: Update, context: ContextTypes.DEFAULT_TY
                     
                 # إرسال تأكيد للمشرف
                 try:
-                    await query.message.edit_text(
+                    await edit_message_with_retry(
+                        context, query.message.chat_id, query.message.message_id,
                         "✅ تم إرسال المعلومات للعميل بنجاح!",
                         reply_markup=None
                     )
@@ -1242,7 +1278,8 @@ async def confirm_transfer_info(update: Update, context: ContextTypes.DEFAULT_TY
                         chat_id=ADMIN_GROUP_ID,  
                         message_id=admin_info['message_id'],
                         text=admin_confirmation,
-                        parse_mode='HTML'
+                        parse_mode='HTML',
+                        fallback_send=True
                     )
             except telegram.error.BadRequest as e:
                 if "There is no text in the message to edit" in str(e):
@@ -1343,6 +1380,7 @@ async def handle_automate_transfer(update: Update, context: ContextTypes.DEFAULT
     :param transfer_id: معرف التحويل (اختياري، يمكن استخراجه من البيانات)
     """
     query = update.callback_query
+    queued = False
     
     try:
         # استخراج معرف التحويل إذا لم يتم تمريره
@@ -1352,30 +1390,29 @@ async def handle_automate_transfer(update: Update, context: ContextTypes.DEFAULT
         # الحصول على تفاصيل التحويل
         transfer = db.get_transfer(transfer_id)
         if not transfer:
-            await query.message.edit_text("⚠️ لم يتم العثور على التحويل المطلوب.")
+            await edit_message_with_retry(context, query.message.chat_id, query.message.message_id, "⚠️ لم يتم العثور على التحويل المطلوب.")
             return
         
         # التحقق من أن التحويل في حالة معلقة
         if transfer.get('status') != 'pending':
-            await query.message.edit_text(
+            await edit_message_with_retry(
+                context, query.message.chat_id, query.message.message_id,
                 f"⚠️ لا يمكن أتمتة التحويل في الحالة {transfer.get('status')}."
             )
             return
             
         # إرسال رسالة انتظار
-        await query.message.edit_text(
+        await edit_message_with_retry(
+            context, query.message.chat_id, query.message.message_id,
             "🤖 جاري بدء عملية التحويل التلقائي...\n"
             "سيتم إعلامك بالنتيجة قريباً."
         )
         
-        # تحديث حالة التحويل إلى "جاري المعالجة"
-        db.update_transfer_status(transfer_id, 'processing')
-        
-        # إرسال التحويل إلى Tasker
-        result = tasker.send_transfer_to_tasker(transfer)
+        # تحديث حالة التحويل إلى "جاري المعالجة" وإضافة مهمة Tasker في نفس المعاملة
+        queued = await tasker_outbox.enqueue_async(transfer)
         
-        if result.get('success', False):
-            # تم بدء العملية بنجاح
+        if queued:
+            # تمت جدولة العملية بنجاح
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
                 text=(
@@ -1398,7 +1435,7 @@ async def handle_automate_transfer(update: Update, context: ContextTypes.DEFAULT
                     logger.error(f"خطأ في إرسال إشعار للمستخدم: {e}")
         else:
             # فشل في بدء العملية
-            error_message = result.get('error', 'خطأ غير معروف')
+            error_message = 'تعذرت جدولة التحويل (تغيرت حالته أو توجد مهمة نشطة له)'
             
             # إرسال رسالة للمشرف
             await context.bot.send_message(
@@ -1409,9 +1446,6 @@ async def handle_automate_transfer(update: Update, context: ContextTypes.DEFAULT
                 )
             )
             
-            # إعادة التحويل إلى حالة معلق
-            db.update_transfer_status(transfer_id, 'pending')
-            
             # إعادة عرض أزرار التحكم
             keyboard = [
                 [
@@ -1436,6 +1470,6 @@ async def handle_automate_transfer(update: Update, context: ContextTypes.DEFAULT
             chat_id=update.effective_chat.id,
             text="⚠️ حدث خطأ أثناء معالجة طلب التحويل التلقائي. الرجاء المحاولة مرة أخرى."
         )
-        # إعادة التحويل إلى حالة معلق في حالة الخطأ
-        if transfer_id:
+        # إعادة التحويل إلى حالة معلق في حالة الخطأ ما لم تكن المهمة قد جدولت
+        if transfer_id and not queued:
             db.update_transfer_status(transfer_id, 'pending')
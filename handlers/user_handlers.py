@@ -35,17 +35,20 @@ import uuid
 import logging
 from decimal import Decimal
 import asyncio
-from typing import Dict
 
 from config.config import States, WALLETS, USDT_NETWORKS, ADMIN_GROUP_ID, NETWORK_INFO, COMMISSION_SETTINGS, CURRENCIES, DIGITAL_CURRENCIES,CURRENCY_SYMBOLS,NETWORK_ADDRESSES
 from utils.database import Database
 from utils.blockchain_scanner import BlockchainScanner
-from handlers.admin_handlers import send_admin_notification
+from utils.binance_verifier import create_binance_verifier
+from handlers.admin_handlers import transfer_pipeline
 
 logger = logging.getLogger(__name__)
 
 db = Database()
 
+# التحقق من سجل Binance المحلي قبل مستكشفات الشبكات (None بدون مفاتيح Binance)، يشغله run.py
+binance_verifier = create_binance_verifier(db)
+
 def add_cancel_button(keyboard: list) -> list:
     """إضافة زر الإلغاء إلى لوحة المفاتيح"""
     keyboard.append([InlineKeyboardButton("❌ إلغاء", callback_data="cancel")])
@@ -86,9 +89,7 @@ async def update_registration_code(update: Update, context: ContextTypes.DEFAULT
         )
         
         # تخزين معرف الرسالة للحذف لاحقاً
-        if 'bot_messages' not in context.user_data:
-            context.user_data['bot_messages'] = []
-        context.user_data['bot_messages'].append(msg.message_id)
+        context.user_data.track_message(msg.message_id)
         
         return States.CONFIRM_CODE_UPDATE
         
@@ -158,9 +159,6 @@ async def handle_code_update(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return ConversationHandler.END
 
 
-last_start_time: Dict[int, datetime] = {}
-START_COOLDOWN = 2  # ثواني بين كل تنفيذ
-
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """بداية المحادثة مع منع الاستخدام في المجموعات"""
     try:
@@ -172,20 +170,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
         chat_id = update.effective_chat.id
 
-        # التحقق من الوقت المنقضي منذ آخر تنفيذ
+        # تكرار /start السريع يتم تقييده مسبقاً في ThrottleMiddleware
         current_time = datetime.now()
-        if user_id in last_start_time:
-            time_diff = (current_time - last_start_time[user_id]).total_seconds()
-            if time_diff < START_COOLDOWN:
-                try:
-                    if update.message:
-                        await update.message.delete()
-                except Exception:
-                    pass
-                return
-        
-        # تحديث وقت آخر تنفيذ
-        last_start_time[user_id] = current_time
 
         # حذف جميع الرسائل السابقة للبوت
         if 'bot_messages' in context.user_data:
@@ -198,7 +184,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # تنظيف البيانات السابقة
         context.user_data.clear()
-        context.user_data['last_start_time'] = current_time
+        context.user_data['last_start_time'] = current_time.timestamp()
 
         # حذف رسالة /start
         if update.message:
@@ -302,13 +288,11 @@ async def handle_pending_operation(update: Update, context: ContextTypes.DEFAULT
         if current_state:
             # إظهار آخر رسالة كان المستخدم عندها
             last_message = context.user_data.get('last_message')
-            last_markup = context.user_data.get('last_markup')
 
             if last_message:
                 await context.bot.send_message(
                     chat_id=query.message.chat_id,
-                    text=last_message,
-                    reply_markup=last_markup
+                    text=last_message
                 )
             return current_state
         else:
@@ -372,9 +356,7 @@ async def any_handler_function(update: Update, context: ContextTypes.DEFAULT_TYP
         )
         
         # تتبع معرف الرسالة
-        if 'bot_messages' not in context.user_data:
-            context.user_data['bot_messages'] = []
-        context.user_data['bot_messages'].append(new_message.message_id)
+        context.user_data.track_message(new_message.message_id)
         
         # تحديد الحالة التالية
         return States.NEXT_STATE  # استخدم حالة محددة من States class
@@ -691,14 +673,6 @@ async def handle_back_to_currencies(update: Update, context: ContextTypes.DEFAUL
     """معالجة الرجوع إلى اختيار العملات"""
     try:
         query = update.callback_query
-        
-        # التحقق من وجود معالجة جارية
-        if context.user_data.get('processing_action'):
-            await query.answer("⏳ جاري معالجة الطلب السابق...")
-            return
-        
-        # تعيين علامة المعالجة
-        context.user_data['processing_action'] = True
         await query.answer()
         
         keyboard = []
@@ -718,13 +692,9 @@ async def handle_back_to_currencies(update: Update, context: ContextTypes.DEFAUL
             text="💱 الرجاء اختيار عملة التحويل :",
             reply_markup=reply_markup
         )
-        # إعادة تعيين علامة المعالجة
-        context.user_data['processing_action'] = False
         return States.SELECT_LOCAL_CURRENCY
     except Exception as e:
         logger.error(f"خطأ في دالة handle_back_to_currencies: {e}")
-        # إعادة تعيين علامة المعالجة في حالة الخطأ
-        context.user_data['processing_action'] = False
         await query.message.reply_text("عذراً، حدث خطأ. الرجاء المحاولة مرة أخرى.")
         return ConversationHandler.ENDndler.END
 
@@ -1255,12 +1225,6 @@ async def handle_recipient_confirmation(update: Update, context: ContextTypes.DE
 async def amount_entered(update: Update, context: ContextTypes.DEFAULT_TYPE):
    try:
        user_id = update.message.from_user.id
-       
-       if context.user_data.get('processing_amount'):
-           await update.message.reply_text("⚠️ يتم معالجة طلبك السابق. الرجاء الانتظار...")
-           return States.ENTER_AMOUNT
-           
-       context.user_data['processing_amount'] = True
 
        try:
            amount = float(update.message.text)
@@ -1276,12 +1240,10 @@ async def amount_entered(update: Update, context: ContextTypes.DEFAULT_TYPE):
            
            if amount < min_withdrawal:
                await update.message.reply_text(f"❌ عذراً، المبلغ أقل من الحد الأدنى ({min_withdrawal} USDT)")
-               context.user_data['processing_amount'] = False
                return States.ENTER_AMOUNT
                
            if amount > max_withdrawal:
                await update.message.reply_text(f"❌ عذراً، المبلغ أعلى من الحد الأقصى ({max_withdrawal} USDT)")
-               context.user_data['processing_amount'] = False
                return States.ENTER_AMOUNT
 
            from random import uniform
@@ -1303,13 +1265,12 @@ async def amount_entered(update: Update, context: ContextTypes.DEFAULT_TYPE):
                'final_usdt_amount': final_amount,
                'local_amount': local_amount,
                'rounded_local_amount': rounded_local_amount,
-               'deposit_start_time': datetime.now()
+               'deposit_start_time': datetime.now().timestamp()
            })
 
            network = context.user_data.get('usdt_network')
            if not network:
                await update.message.reply_text("عذراً، حدث خطأ في تحديد الشبكة.")
-               context.user_data['processing_amount'] = False
                return ConversationHandler.END
 
            deposit_address = NETWORK_ADDRESSES.get(network)
@@ -1348,17 +1309,14 @@ async def amount_entered(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
            await update.message.reply_text(amount_message, parse_mode='HTML', reply_markup=reply_markup)
 
-           context.user_data['processing_amount'] = False
            return States.WAITING_DEPOSIT
 
        except ValueError:
            await update.message.reply_text("⚠️ الرجاء إدخال مبلغ صحيح (مثال: 100.5)")
-           context.user_data['processing_amount'] = False
            return States.ENTER_AMOUNT
 
    except Exception as e:
        logger.error(f"خطأ في معالجة إدخال المبلغ: {e}")
-       context.user_data['processing_amount'] = False
        await update.message.reply_text("عذراً، حدث خطأ. الرجاء المحاولة مرة أخرى.")
        return States.ENTER_AMOUNT
 
@@ -1407,7 +1365,8 @@ async def verify_txid(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return States.ENTER_TXID
 
-        transfer_data = context.user_data
+        # نسخة مؤقتة حتى لا تحفظ نتائج التحقق في حالة المستخدم
+        transfer_data = context.user_data.to_dict()
         
         # محاولة إرسال رسالة مع معالجة خطأ انتهاء المهلة
         try:
@@ -1428,7 +1387,8 @@ async def verify_txid(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
             
-            await status_message.edit_text(
+            await edit_message_with_retry(
+                context, status_message.chat_id, status_message.message_id,
                 "❌ رمز المعاملة مستخدم بالفعل!\n\n"
                 "⚠️ لقد تم استخدام رمز المعاملة هذا في عملية سابقة.\n"
                 "يرجى التأكد من إدخال رمز معاملة صحيح وغير مستخدم من قبل.",
@@ -1441,12 +1401,21 @@ async def verify_txid(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # التحقق من المعاملة مع جميع الشروط
         try:
-            tx = await scanner.verify_transaction_by_hash(
-                transfer_data.get('usdt_network', 'TRC20'),  # نوع الشبكة
-                tx_id,  # رمز المعاملة
-                Decimal(str(transfer_data['unique_amount'])),  # المبلغ المتوقع
-                transfer_data['deposit_address']  # عنوان الإيداع
-            )
+            tx = None
+            if binance_verifier is not None:
+                tx = await binance_verifier.verify_deposit(
+                    transfer_data.get('usdt_network', 'TRC20'),
+                    tx_id,
+                    Decimal(str(transfer_data['unique_amount'])),
+                    transfer_data['deposit_address']
+                )
+            if tx is None:
+                tx = await scanner.verify_transaction_by_hash(
+                    transfer_data.get('usdt_network', 'TRC20'),  # نوع الشبكة
+                    tx_id,  # رمز المعاملة
+                    Decimal(str(transfer_data['unique_amount'])),  # المبلغ المتوقع
+                    transfer_data['deposit_address']  # عنوان الإيداع
+                )
         except (telegram.error.TimedOut, httpx.ConnectTimeout, asyncio.TimeoutError) as e:
             logger.error(f"خطأ في التحقق من المعاملة: {type(e).__name__} - {str(e)}")
             
@@ -1466,7 +1435,8 @@ async def verify_txid(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 reply_markup = InlineKeyboardMarkup(keyboard)
                 
                 try:
-                    await status_message.edit_text(
+                    await edit_message_with_retry(
+                        context, status_message.chat_id, status_message.message_id,
                         "⚠️ انتهت مهلة الاتصال أثناء التحقق من المعاملة!\n\n"
                         "قد يكون هناك مشكلة في الاتصال بخدمة التحقق أو بطء في الشبكة.\n"
                         "يرجى المحاولة مرة أخرى بعد قليل.",
@@ -1492,7 +1462,8 @@ async def verify_txid(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup = InlineKeyboardMarkup(keyboard)
             
             try:
-                await status_message.edit_text(
+                await edit_message_with_retry(
+                    context, status_message.chat_id, status_message.message_id,
                     "⚠️ حدث خطأ أثناء التحقق من المعاملة!\n\n"
                     "قد يكون هناك مشكلة في الاتصال بخدمة التحقق.\n"
                     "يرجى المحاولة مرة أخرى بعد قليل.",
@@ -1517,7 +1488,8 @@ async def verify_txid(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
             
-            await status_message.edit_text(
+            await edit_message_with_retry(
+                context, status_message.chat_id, status_message.message_id,
                 "❌ لم يتم العثور على المعاملة!\n\n"
                 "⚠️ لقد تم التحقق من المعاملة، ولكن لم يتم العثور على المعاملة.\n"
                 "يرجى التأكد من:\n"
@@ -1537,7 +1509,8 @@ async def verify_txid(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
             
-            await status_message.edit_text(
+            await edit_message_with_retry(
+                context, status_message.chat_id, status_message.message_id,
                 "❌ خطأ في التحقق من المعاملة!\n\n"
                 "لم يتم العثور على معلومات العقد. يرجى التأكد من:\n"
                 "• استخدام عملة USDT\n"
@@ -1578,7 +1551,8 @@ async def verify_txid(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 'ARB20': 'Arbitrum One'
             }
             
-            await status_message.edit_text(
+            await edit_message_with_retry(
+                context, status_message.chat_id, status_message.message_id,
                 f"❌ لم يتم التعرف على عقد USDT!\n\n"
                 f"⚠️ تأكد من استخدام عقد USDT الصحيح:\n"
                 f"• الشبكة المطلوبة: {expected_network} ({network_contracts_info.get(expected_network, '')})\n"
@@ -1594,7 +1568,8 @@ async def verify_txid(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
             
-            await status_message.edit_text(
+            await edit_message_with_retry(
+                context, status_message.chat_id, status_message.message_id,
                 "❌ الشبكة المستخدمة غير صحيحة!\n\n"
                 "⚠️ تفاصيل الخطأ:\n"
                 f"• الشبكة المطلوبة: {expected_network}\n"
@@ -1653,10 +1628,12 @@ async def verify_txid(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "⏳ <b>جاري مراجعة طلبك .....، سيتم إرسال تأكيد التحويل قريباً...</b>"
         )
 
-        await status_message.edit_text(verification_message, parse_mode='HTML')
+        await edit_message_with_retry(context, status_message.chat_id, status_message.message_id, verification_message, parse_mode='HTML')
 
-        # إرسال إشعار للمشرفين
-        await send_admin_notification(context, transfer_data)
+        # Tasker وإشعار المشرفين والتسجيل تتم في الخلفية، والتحويل المحفوظ يعاد إدخاله عند إعادة التشغيل إن لم يكتمل
+        if not transfer_pipeline.submit(transfer_data):
+            # الطابور ممتلئ أو الخط متوقف: تنفيذ المراحل مباشرة حتى يصل الطلب للمشرفين الآن
+            await transfer_pipeline.run_inline(transfer_data)
 
         context.user_data['verification_message_id'] = status_message.message_id
         return ConversationHandler.END
@@ -1666,7 +1643,8 @@ async def verify_txid(update: Update, context: ContextTypes.DEFAULT_TYPE):
         error_message = "⚠️ حدث خطأ أثناء التحقق من المعاملة.\n"
         
         if 'status_message' in locals():
-            await status_message.edit_text(
+            await edit_message_with_retry(
+                context, status_message.chat_id, status_message.message_id,
                 error_message + "الرجاء المحاولة مرة أخرى بعد قليل.",
                 parse_mode='HTML'
             )
@@ -1764,6 +1742,40 @@ def calculate_commission(amount: float, settings: dict) -> float:
     if amount <= settings['fixed_fee_threshold']:
         return settings['fixed_fee_amount']
     return amount * settings['percentage_fee']
+
+
+async def conversation_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """انتهاء مهلة المحادثة الخاملة: تحرير حجز الإيداع وتنظيف حالة المستخدم"""
+    try:
+        released_amount = context.user_data.release_deposit()
+        bot_messages = context.user_data.get('bot_messages', [])
+        context.user_data.clear()
+
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            return
+        if released_amount:
+            logger.info(f"تم تحرير المبلغ المحجوز {released_amount} للمحادثة {chat.id} بعد انتهاء المهلة")
+
+        # حذف رسائل البوت القديمة
+        for msg_id in bot_messages:
+            try:
+                await context.bot.delete_message(chat_id=chat.id, message_id=msg_id)
+            except Exception:
+                pass
+
+        keyboard = [[InlineKeyboardButton("🔄 بدء عملية جديدة", callback_data="start_new")]]
+        new_message = await context.bot.send_message(
+            chat_id=chat.id,
+            text="⌛ انتهت مهلة العملية بسبب عدم النشاط.\n"
+                 "إذا قمت بالتحويل بالفعل يرجى بدء عملية جديدة والتواصل مع الدعم.",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        context.user_data['bot_messages'] = [new_message.message_id]
+
+    except Exception as e:
+        logger.error(f"خطأ في معالجة انتهاء مهلة المحادثة: {e}")
+
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """إلغاء العملية الحالية وبدء عملية جديدة"""
     try:
@@ -3,14 +3,22 @@
 import os
 import sys
 import time
-import threading
+import signal
+import subprocess
 import logging
 import asyncio
+from functools import partial
 from dotenv import load_dotenv
 import codecs
 import psycopg2
 import re
 from utils.database import Database
+from utils.send_scheduler import SendScheduler
+from utils.pg_persistence import PostgresPersistence
+from utils.update_processor import UserOrderedUpdateProcessor
+from utils.volume_rollup import VolumeRollup
+from utils.throttle import build_throttle
+from utils.user_state import UserState
 import platform
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, ReplyKeyboardMarkup, KeyboardButton
@@ -22,7 +30,7 @@ from telegram.ext import (
     CallbackQueryHandler,
     ConversationHandler,
     ContextTypes,
-    PicklePersistence
+    TypeHandler
 )
 from werkzeug.serving import make_server
 
@@ -58,7 +66,7 @@ from handlers.user_handlers import (
     recipient_name_entered, recipient_number_entered, verify_txid,
     request_txid, cancel, handle_pending_operation, handle_recipient_confirmation,
     handle_recipient_notes, digital_currency_selected, handle_transfer_agency, start_new_transfer,
-    show_help
+    show_help, conversation_timeout, binance_verifier
 )
 
 from handlers.admin_handlers import (
@@ -68,19 +76,98 @@ from handlers.admin_handlers import (
     cancel_admin_action,
     handle_transfer_info,
     confirm_transfer_info,
-    edit_transfer_info
+    edit_transfer_info,
+    tasker,
+    tasker_outbox,
+    tasker_reaper,
+    notify_tasker_dead_letter,
+    notify_tasker_stuck,
+    transfer_pipeline,
+    start_transfer_pipeline
 )
 
 
 def run_dashboard():
-    """تشغيل لوحة التحكم في خيط (Thread) منفصل."""
-    try:
+    """
+    تشغيل لوحة التحكم في عملية مستقلة عبر gunicorn بعدة عمال،
+    أو خادم werkzeug متعدد الخيوط على Windows حيث لا يعمل gunicorn.
+    """
+    if platform.system() == 'Windows':
         from dashboard.dashboard import app
-        logger.info("🌐 جاري تشغيل لوحة التحكم...")
-        server = make_server('0.0.0.0', 5000, app)
-        server.serve_forever()
-    except Exception as e:
-        logger.error(f"❌ خطأ في تشغيل لوحة التحكم: {e}", exc_info=True)
+        port = int(os.getenv('PORT', '5000'))
+        logger.info(f"🌐 جاري تشغيل لوحة التحكم على المنفذ {port}...")
+        make_server('0.0.0.0', port, app, threaded=True).serve_forever()
+        return
+
+    logger.info("🌐 جاري تشغيل لوحة التحكم عبر gunicorn...")
+    config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gunicorn.conf.py')
+    # استبدال العملية الحالية حتى تصل إشارات الإيقاف إلى gunicorn مباشرة
+    os.execvp(sys.executable, [sys.executable, '-m', 'gunicorn', '-c', config_path, 'dashboard.wsgi:app'])
+
+def run_supervisor():
+    """
+    تشغيل البوت ولوحة التحكم كعمليتين منفصلتين ومراقبتهما،
+    فلا يؤثر ضغط لوحة التحكم على زمن استجابة البوت، وتعاد العملية التي تتوقف.
+    """
+    script = os.path.abspath(__file__)
+    commands = {
+        'bot': [sys.executable, script, 'bot'],
+        'dashboard': [sys.executable, script, 'dashboard'],
+    }
+    restart_delay = float(os.getenv('SUPERVISOR_RESTART_DELAY', '5'))
+    max_restart_delay = float(os.getenv('SUPERVISOR_MAX_RESTART_DELAY', '300'))
+    # العملية التي تعمل أطول من هذه المدة تعتبر مستقرة ويعاد تأخير إعادة تشغيلها للبداية
+    stable_after = 60
+
+    processes = {}
+    started_at = {}
+    delays = {name: restart_delay for name in commands}
+    restart_at = {}
+    stopping = False
+
+    def start(name):
+        processes[name] = subprocess.Popen(commands[name])
+        started_at[name] = time.monotonic()
+        logger.info(f"▶️ تم تشغيل {name} (PID {processes[name].pid})")
+
+    def stop(signum=None, frame=None):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    for name in commands:
+        start(name)
+
+    try:
+        while not stopping:
+            now = time.monotonic()
+            for name, process in list(processes.items()):
+                if process is None:
+                    if now >= restart_at[name]:
+                        start(name)
+                    continue
+                code = process.poll()
+                if code is None:
+                    continue
+                if now - started_at[name] >= stable_after:
+                    delays[name] = restart_delay
+                logger.error(f"⚠️ توقف {name} برمز {code}، إعادة التشغيل بعد {delays[name]:.0f} ثانية")
+                processes[name] = None
+                restart_at[name] = now + delays[name]
+                delays[name] = min(max_restart_delay, delays[name] * 2)
+            time.sleep(1)
+    finally:
+        logger.info("🔄 جاري إيقاف العمليات...")
+        running = [process for process in processes.values() if process is not None and process.poll() is None]
+        for process in running:
+            process.terminate()
+        for process in running:
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     """معالجة الأخطاء"""
@@ -129,6 +216,15 @@ def check_environment():
         'ETHERSCAN_API_KEY': 'ERC20'
     }
 
+    if BOT_MODE == 'webhook':
+        if not os.getenv('WEBHOOK_URL'):
+            logger.error("❌ WEBHOOK_URL مطلوب عند تشغيل البوت بوضع webhook")
+            return False
+        # Telegram يقبل من 1 إلى 256 حرفاً من A-Z a-z 0-9 _ -
+        if not re.fullmatch(r'[A-Za-z0-9_-]{1,256}', os.getenv('WEBHOOK_SECRET', '')):
+            logger.error("❌ WEBHOOK_SECRET مطلوب بوضع webhook ويجب أن يتكون من 1-256 حرفاً من A-Z a-z 0-9 _ -")
+            return False
+
     missing_apis = [key for key, network in blockchain_vars.items() if not os.getenv(key)]
     if missing_apis:
         affected_networks = [blockchain_vars[key] for key in missing_apis]
@@ -146,22 +242,90 @@ def create_directories():
 # إنشاء كائن قاعدة البيانات عالمي
 db = Database()
 
+# تجميع تغييرات أحجام التحويلات في دلاء السلاسل الزمنية للوحة التحكم
+volume_rollup = VolumeRollup(db)
+
+# طريقة استقبال التحديثات: polling أو webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+ALLOWED_UPDATES = ["message", "callback_query", "chat_member"]
+
+# الخدمات التي تعمل في الخلفية ضمن حلقة أحداث البوت
+background_services = {}
+
+async def post_init(application):
+    """تشغيل الخدمات الخلفية بعد تهيئة التطبيق"""
+    # عمال صندوق صادر Tasker
+    tasker_outbox.start(on_dead_letter=partial(notify_tasker_dead_letter, application.bot))
+    # إعادة التحويلات التي لم يرد عليها Tasker خلال مهلة المحفظة
+    tasker_reaper.start(on_reaped=partial(notify_tasker_stuck, application.bot))
+    # مراحل ما بعد التحقق من التحويل
+    start_transfer_pipeline(application.bot)
+    # دلاء أحجام التحويلات
+    volume_rollup.start()
+
+    # نفس المتحقق الذي تستخدمه verify_txid، فالسجل المتزامن هنا هو ما يبحث فيه التحقق
+    if binance_verifier is not None:
+        try:
+            verifier = binance_verifier
+            verifier.client.start()
+            verifier.ledger.start()
+            background_services['binance_verifier'] = verifier
+            logger.info("✅ تم بدء مزامنة سجل Binance")
+
+            if os.getenv('BINANCE_USER_STREAM', 'true').lower() == 'true':
+                from utils.binance_stream import BinanceUserDataStream
+                stream = BinanceUserDataStream(verifier.client, verifier.ledger)
+                stream.start()
+                background_services['binance_stream'] = stream
+                logger.info("✅ تم بدء بث بيانات المستخدم من Binance")
+        except Exception as e:
+            logger.error(f"❌ خطأ في بدء مزامنة سجل Binance: {e}", exc_info=True)
+
+async def post_shutdown(application):
+    """إيقاف الخدمات الخلفية عند إيقاف التطبيق"""
+    stream = background_services.pop('binance_stream', None)
+    if stream:
+        await stream.stop()
+    verifier = background_services.pop('binance_verifier', None)
+    if verifier:
+        if verifier.ledger:
+            await verifier.ledger.stop()
+        await verifier.close()
+    await transfer_pipeline.stop()
+    await tasker_reaper.stop()
+    await volume_rollup.stop()
+    await tasker_outbox.stop()
+    await tasker.close()
+
 def run_bot():
     """تشغيل البوت"""
-    # استخدام Persistence لحفظ الحالة
-    persistence = PicklePersistence(filepath="bot_data.pkl")
+    # حفظ الحالة في PostgreSQL لكل مستخدم، ويمكن مشاركتها بين عدة نسخ من البوت
+    persistence = PostgresPersistence(db)
+    persistence.migrate_from_pickle("bot_data.pkl")
+
+    # طابور التحديثات محدود الحجم، لكن مع المعالجة المتزامنة يسحب PTB كل تحديث فوراً،
+    # لذا يطبق UserOrderedUpdateProcessor نفس الحد (UPDATE_QUEUE_SIZE) على التحديثات المعلقة
+    update_queue = asyncio.Queue(maxsize=int(os.getenv('UPDATE_QUEUE_SIZE', '1000')))
 
     application = (
         ApplicationBuilder()
         .token(BOT_TOKEN)
+        .update_queue(update_queue)
         .persistence(persistence)
-        .concurrent_updates(True)
+        # حالة المستخدم بحقول ثابتة وقيم أساسية بدلاً من قاموس مفتوح
+        .context_types(ContextTypes(user_data=UserState))
+        # تحديثات المستخدم الواحد بالترتيب، والمستخدمون المختلفون بالتوازي، مع مسار مستقل للمشرفين
+        .concurrent_updates(UserOrderedUpdateProcessor(admin_chat_ids=[ADMIN_GROUP_ID]))
+        # كل الطلبات الصادرة تمر عبر مجدول يطبق حدود تيليجرام ويقدم رسائل المستخدمين
+        .rate_limiter(SendScheduler(admin_chat_ids=[ADMIN_GROUP_ID]))
         .connection_pool_size(8)
         .get_updates_connection_pool_size(8)
         .get_updates_read_timeout(30.0)
         .get_updates_write_timeout(30.0)
         .get_updates_connect_timeout(30.0)
         .get_updates_pool_timeout(30.0)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
         .build()
     )
     async def menu_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -290,6 +454,10 @@ def run_bot():
         States.ENTER_RECIPIENT_NOTES: [
             MessageHandler(filters.TEXT & ~filters.COMMAND, handle_recipient_notes),
             CallbackQueryHandler(cancel, pattern='^cancel$')
+        ],
+        # المحادثة الخاملة تنتهي ويتم تحرير حجز الإيداع
+        ConversationHandler.TIMEOUT: [
+            TypeHandler(Update, conversation_timeout)
         ]
     },
 
@@ -304,6 +472,7 @@ def run_bot():
     per_chat=True,           # محادثة مستقلة لكل محادثة (chat)
     per_user=True,           # أو لكل مستخدم
     allow_reentry=True,      # السماح بدخول المحادثة من جديد
+    conversation_timeout=int(os.getenv('CONVERSATION_TIMEOUT', '900')),  # ثواني عدم النشاط قبل إنهاء المحادثة
     name="main_conversation",
     persistent=True          # حفظ حالة المحادثة في التخزين (persistence) إذا تم تفعيله
 )
@@ -352,6 +521,9 @@ def run_bot():
         name="admin_conversation"
     )
 
+    # تقييد المستخدمين قبل أي معالج آخر
+    application.add_handler(build_throttle(db, exempt_chat_ids=[ADMIN_GROUP_ID]).handler, group=-1)
+
     # إضافة المعالجات
     application.add_handler(conv_handler, group=0)  # مجموعة 0 للمحادثات الرئيسية
     application.add_handler(admin_conv_handler, group=0)
@@ -365,10 +537,36 @@ def run_bot():
     application.add_handler(CommandHandler("help", show_help))
     application.add_error_handler(error_handler)
 
-    logger.info("🤖 جاري تشغيل البوت...")
-    application.run_polling(
-        drop_pending_updates=True,
-        allowed_updates=["message", "callback_query", "chat_member"]
+    if BOT_MODE == 'webhook':
+        run_webhook(application)
+    else:
+        logger.info("🤖 جاري تشغيل البوت...")
+        application.run_polling(
+            drop_pending_updates=True,
+            allowed_updates=ALLOWED_UPDATES
+        )
+
+def run_webhook(application):
+    """
+    تشغيل البوت بوضع webhook عبر خادم HTTP غير متزامن داخل نفس العملية.
+    Telegram يرسل WEBHOOK_SECRET في ترويسة X-Telegram-Bot-Api-Secret-Token ويرفض الخادم أي طلب بدونه،
+    والتحديثات المعلقة لا تحذف عند إعادة التشغيل، ويمكن تشغيل عدة نسخ خلف موزع أحمال بنفس WEBHOOK_URL.
+    """
+    webhook_url = os.getenv('WEBHOOK_URL').rstrip('/')
+    url_path = os.getenv('WEBHOOK_PATH', 'telegram').strip('/')
+    if not webhook_url.endswith(f"/{url_path}"):
+        webhook_url = f"{webhook_url}/{url_path}"
+
+    logger.info(f"🤖 جاري تشغيل البوت بوضع webhook على {webhook_url}...")
+    application.run_webhook(
+        listen=os.getenv('WEBHOOK_LISTEN', '0.0.0.0'),
+        port=int(os.getenv('WEBHOOK_PORT', '8443')),
+        url_path=url_path,
+        webhook_url=webhook_url,
+        secret_token=os.getenv('WEBHOOK_SECRET'),
+        max_connections=int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40')),
+        allowed_updates=ALLOWED_UPDATES,
+        drop_pending_updates=os.getenv('DROP_PENDING_UPDATES', 'false').lower() == 'true'
     )
 
 def check_transfer_exists(db: 'Database', transfer_id: str) -> bool:
@@ -380,12 +578,22 @@ def check_transfer_exists(db: 'Database', transfer_id: str) -> bool:
     return exists
 
 def main():
-    logger.info("🚀 بدء تشغيل النظام...")
+    # bot: البوت فقط، dashboard: لوحة التحكم فقط، supervisor: العمليتان مع المراقبة
+    mode = (sys.argv[1] if len(sys.argv) > 1 else os.getenv('RUN_MODE', 'supervisor')).lower()
+    if mode not in ('bot', 'dashboard', 'supervisor'):
+        logger.error(f"❌ وضع تشغيل غير معروف: {mode} (bot أو dashboard أو supervisor)")
+        return
+
+    logger.info(f"🚀 بدء تشغيل النظام (الوضع: {mode})...")
 
     if not check_requirements():
         logger.error("❌ فشل التحقق من المتطلبات")
         return
 
+    if mode == 'dashboard':
+        run_dashboard()
+        return
+
     if not check_environment():
         logger.error("❌ فشل التحقق من متغيرات البيئة")
         return
@@ -393,14 +601,10 @@ def main():
     create_directories()
 
     try:
-        # تشغيل لوحة التحكم في خيط منفصل
-        dashboard_thread = threading.Thread(target=run_dashboard)
-        dashboard_thread.daemon = True
-        dashboard_thread.start()
-        logger.info("✅ تم بدء تشغيل لوحة التحكم")
-
-        # تشغيل البوت في الخيط الرئيسي
-        run_bot()
+        if mode == 'supervisor':
+            run_supervisor()
+        else:
+            run_bot()
     except KeyboardInterrupt:
         logger.info("🔒 تم إيقاف البوت بواسطة المستخدم")
     except Exception as e:
@@ -0,0 +1,113 @@
+import json
+import asyncio
+import secrets
+import socket
+from datetime import datetime
+from typing import Dict, Optional, Set
+
+from aiohttp import web
+
+from utils.binance_stream import LISTEN_KEY_PATH
+
+
+class LocalUserDataStreamServer:
+    """
+    خادم محلي بديل لواجهة بث بيانات المستخدم للاختبار.
+    يوفر نقاط مفتاح الاستماع ووقت الخادم واتصال websocket يمكن دفع الأحداث إليه.
+    """
+
+    def __init__(self, host: str = '127.0.0.1'):
+        self.host = host
+        self.port: Optional[int] = None
+        self.listen_keys: Set[str] = set()
+        self.keepalive_count = 0
+        self._clients: Set[web.WebSocketResponse] = set()
+        self._runner: Optional[web.AppRunner] = None
+
+        self.app = web.Application()
+        self.app.router.add_get('/api/v3/time', self._handle_time)
+        self.app.router.add_post(LISTEN_KEY_PATH, self._handle_create_key)
+        self.app.router.add_put(LISTEN_KEY_PATH, self._handle_keepalive)
+        self.app.router.add_delete(LISTEN_KEY_PATH, self._handle_delete_key)
+        self.app.router.add_get('/ws/{listen_key}', self._handle_ws)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def ws_base_url(self) -> str:
+        return f"ws://{self.host}:{self.port}/ws"
+
+    async def _handle_time(self, request):
+        return web.json_response({'serverTime': int(datetime.now().timestamp() * 1000)})
+
+    async def _handle_create_key(self, request):
+        listen_key = secrets.token_hex(16)
+        self.listen_keys.add(listen_key)
+        return web.json_response({'listenKey': listen_key})
+
+    async def _handle_keepalive(self, request):
+        if request.query.get('listenKey') not in self.listen_keys:
+            return web.json_response({'code': -1125, 'msg': 'This listenKey does not exist.'}, status=400)
+        self.keepalive_count += 1
+        return web.json_response({})
+
+    async def _handle_delete_key(self, request):
+        self.listen_keys.discard(request.query.get('listenKey'))
+        return web.json_response({})
+
+    async def _handle_ws(self, request):
+        if request.match_info['listen_key'] not in self.listen_keys:
+            raise web.HTTPNotFound()
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self._clients.add(ws)
+        try:
+            async for _ in ws:
+                pass
+        finally:
+            self._clients.discard(ws)
+        return ws
+
+    async def push(self, event: Dict) -> int:
+        """إرسال حدث إلى جميع المتصلين وإرجاع عددهم"""
+        clients = list(self._clients)
+        for ws in clients:
+            await ws.send_str(json.dumps(event))
+        return len(clients)
+
+    async def push_balance_update(self, amount, coin: str = 'USDT') -> int:
+        now_ms = int(datetime.now().timestamp() * 1000)
+        return await self.push({'e': 'balanceUpdate', 'E': now_ms, 'a': coin, 'd': str(amount), 'T': now_ms})
+
+    async def expire_listen_keys(self) -> int:
+        """محاكاة انتهاء صلاحية جميع مفاتيح الاستماع"""
+        now_ms = int(datetime.now().timestamp() * 1000)
+        self.listen_keys.clear()
+        return await self.push({'e': 'listenKeyExpired', 'E': now_ms})
+
+    async def wait_for_clients(self, count: int = 1, timeout: float = 5) -> None:
+        """انتظار اتصال عدد من المستهلكين بالبث"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while len(self._clients) < count:
+            if loop.time() > deadline:
+                raise TimeoutError(f"لم يتصل {count} مستهلك بالبث خلال {timeout} ثانية")
+            await asyncio.sleep(0.01)
+
+    async def start(self) -> None:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, 0))
+        self.port = sock.getsockname()[1]
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.SockSite(self._runner, sock).start()
+
+    async def stop(self) -> None:
+        for ws in list(self._clients):
+            await ws.close()
+        if self._runner:
+            await self._runner.cleanup()
+        self._runner = None
@@ -0,0 +1,99 @@
+import asyncio
+from decimal import Decimal
+
+import pytest
+
+pytest.importorskip('aiohttp')
+
+from utils.binance_client import BinanceSignedClient
+from utils.binance_stream import BinanceUserDataStream
+from tests.binance_stream_server import LocalUserDataStreamServer
+
+
+class RecordingDatabase:
+    def __init__(self):
+        self.entries = []
+
+    def upsert_binance_ledger_entries(self, entries):
+        self.entries.extend(entries)
+        return len(entries)
+
+
+class RecordingLedger:
+    """بديل BinanceLedger يسجل الصفوف وطلبات المزامنة دون قاعدة بيانات"""
+
+    def __init__(self):
+        self.db = RecordingDatabase()
+        self.sync_requests = 0
+
+    def request_sync(self):
+        self.sync_requests += 1
+
+
+async def wait_until(predicate, timeout: float = 5):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not predicate():
+        if loop.time() > deadline:
+            raise TimeoutError('انتهت مهلة انتظار الشرط')
+        await asyncio.sleep(0.01)
+
+
+async def run_stream(scenario):
+    server = LocalUserDataStreamServer()
+    await server.start()
+    client = BinanceSignedClient('test-key', 'test-secret', server.base_url)
+    ledger = RecordingLedger()
+    stream = BinanceUserDataStream(client, ledger, ws_base_url=server.ws_base_url)
+    stream.min_backoff = 0.01
+    stream.start()
+    try:
+        await server.wait_for_clients()
+        await scenario(server, stream, ledger)
+    finally:
+        await stream.stop()
+        await client.close()
+        await server.stop()
+
+
+def test_balance_update_writes_ledger_row_and_requests_sync():
+    async def scenario(server, stream, ledger):
+        await wait_until(lambda: ledger.sync_requests == 1)
+
+        assert await server.push_balance_update('12.5') == 1
+        await wait_until(lambda: ledger.db.entries)
+
+        entry = ledger.db.entries[0]
+        assert entry['source'] == 'stream'
+        assert entry['coin'] == 'USDT'
+        assert entry['amount'] == Decimal('12.5')
+        await wait_until(lambda: ledger.sync_requests == 2)
+
+    asyncio.run(run_stream(scenario))
+
+
+def test_other_coins_and_withdrawals_do_not_request_sync():
+    async def scenario(server, stream, ledger):
+        await wait_until(lambda: ledger.sync_requests == 1)
+
+        await server.push_balance_update('3', coin='BTC')
+        await server.push_balance_update('-5')
+        await wait_until(lambda: len(ledger.db.entries) == 1)
+
+        assert ledger.db.entries[0]['amount'] == Decimal('-5')
+        assert ledger.sync_requests == 1
+
+    asyncio.run(run_stream(scenario))
+
+
+def test_expired_listen_key_reconnects_with_new_key():
+    async def scenario(server, stream, ledger):
+        first_key = stream.listen_key
+        await server.expire_listen_keys()
+
+        await wait_until(lambda: stream.listen_key != first_key and server.listen_keys)
+        await server.wait_for_clients()
+        assert stream.listen_key in server.listen_keys
+        await wait_until(lambda: ledger.sync_requests == 2)
+
+    asyncio.run(run_stream(scenario))
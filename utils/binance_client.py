@@ -0,0 +1,227 @@
+import os
+import asyncio
+import hmac
+import hashlib
+import json
+import logging
+import time
+import urllib.parse
+from typing import Any, Dict, Optional, Tuple
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# رؤوس الوزن المستخدم التي تعيدها Binance لكل نوع من نقاط النهاية
+API_WEIGHT_HEADER = 'X-MBX-USED-WEIGHT-1M'
+SAPI_WEIGHT_HEADER = 'X-SAPI-USED-IP-WEIGHT-1M'
+
+# رمز الخطأ عند خروج الطابع الزمني عن نافذة recvWindow
+TIMESTAMP_ERROR_CODE = -1021
+
+
+class BinanceSignedClient:
+    """
+    عميل طلبات Binance الموقعة بجلسة HTTP مشتركة.
+    يحتفظ بتقدير محلي لفرق الساعة مع الخادم ويضبط وتيرة الطلبات
+    حسب رؤوس الوزن المستخدم بدلاً من فاصل زمني ثابت.
+    """
+
+    def __init__(self, api_key: str, api_secret: str, base_url: str = 'https://api.binance.com'):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.recv_window = int(os.getenv('BINANCE_RECV_WINDOW', '5000'))
+        self.timeout = aiohttp.ClientTimeout(
+            total=float(os.getenv('BINANCE_HTTP_TIMEOUT', '10')),
+            connect=float(os.getenv('BINANCE_CONNECT_TIMEOUT', '3'))
+        )
+
+        # حالة HMAC المحسوبة مسبقاً من المفتاح السري، تنسخ لكل توقيع
+        self._mac = hmac.new(api_secret.encode('utf-8'), digestmod=hashlib.sha256)
+
+        # فرق الساعة بالملي ثانية (وقت الخادم - الوقت المحلي)
+        self.time_offset_ms = 0
+        self.time_sync_interval = float(os.getenv('BINANCE_TIME_SYNC_INTERVAL', '300'))
+        self._last_time_sync = 0.0
+        self._time_sync_task: Optional[asyncio.Task] = None
+
+        # حدود الوزن لكل دقيقة ونسبة الأمان قبل التوقف
+        self.weight_limits = {
+            API_WEIGHT_HEADER: int(os.getenv('BINANCE_API_WEIGHT_LIMIT', '6000')),
+            SAPI_WEIGHT_HEADER: int(os.getenv('BINANCE_SAPI_WEIGHT_LIMIT', '12000'))
+        }
+        self.weight_safety_ratio = float(os.getenv('BINANCE_WEIGHT_SAFETY_RATIO', '0.8'))
+        self._used_weight: Dict[str, Tuple[int, int]] = {}
+        self._backoff_until = 0.0
+
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """إرجاع الجلسة المشتركة وإنشاؤها عند الحاجة"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=self.timeout,
+                connector=aiohttp.TCPConnector(limit=20, ttl_dns_cache=300),
+                headers={'X-MBX-APIKEY': self.api_key}
+            )
+        return self._session
+
+    def now_ms(self) -> int:
+        """الوقت الحالي بتوقيت الخادم المقدر"""
+        return int(time.time() * 1000) + self.time_offset_ms
+
+    def sign(self, query_string: str) -> str:
+        """توقيع نص الاستعلام باستخدام نسخة من حالة HMAC المحسوبة مسبقاً"""
+        mac = self._mac.copy()
+        mac.update(query_string.encode('utf-8'))
+        return mac.hexdigest()
+
+    async def sync_time(self) -> bool:
+        """تحديث فرق الساعة من منتصف زمن الرحلة لطلب /api/v3/time"""
+        try:
+            session = await self._get_session()
+            sent = time.time()
+            async with session.get(f"{self.base_url}/api/v3/time") as response:
+                received = time.time()
+                if response.status != 200:
+                    logger.error(f"Failed to get server time: {response.status}")
+                    return False
+                data = await response.json()
+            midpoint_ms = (sent + received) / 2 * 1000
+            self.time_offset_ms = int(int(data['serverTime']) - midpoint_ms)
+            self._last_time_sync = time.time()
+            logger.debug(f"Binance clock offset: {self.time_offset_ms}ms, RTT: {(received - sent) * 1000:.0f}ms")
+            return True
+        except Exception as e:
+            logger.error(f"Error getting server time: {e}")
+            return False
+
+    async def _time_sync_loop(self) -> None:
+        """تحديث فرق الساعة دورياً في الخلفية"""
+        while True:
+            await self.sync_time()
+            await asyncio.sleep(self.time_sync_interval)
+
+    def start(self) -> None:
+        """تشغيل مهمة تحديث فرق الساعة في الخلفية"""
+        if self._time_sync_task is None or self._time_sync_task.done():
+            self._time_sync_task = asyncio.create_task(self._time_sync_loop())
+
+    async def close(self) -> None:
+        """إيقاف مهمة الخلفية وإغلاق الجلسة"""
+        if self._time_sync_task and not self._time_sync_task.done():
+            self._time_sync_task.cancel()
+            try:
+                await self._time_sync_task
+            except asyncio.CancelledError:
+                pass
+        self._time_sync_task = None
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def _weight_header_for(self, path: str) -> str:
+        return SAPI_WEIGHT_HEADER if path.startswith('/sapi/') else API_WEIGHT_HEADER
+
+    async def _wait_for_capacity(self, path: str) -> None:
+        """الانتظار عند الحظر المؤقت أو عند اقتراب الوزن المستخدم من الحد"""
+        delay = self._backoff_until - time.time()
+        if delay > 0:
+            logger.warning(f"Binance backoff active, waiting {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+        header = self._weight_header_for(path)
+        used = self._used_weight.get(header)
+        if not used:
+            return
+        weight, minute = used
+        current_minute = self.now_ms() // 60000
+        if minute != current_minute:
+            return
+        if weight >= self.weight_limits[header] * self.weight_safety_ratio:
+            # الوزن يعاد ضبطه مع بداية الدقيقة التالية بتوقيت الخادم
+            delay = (current_minute + 1) * 60 - self.now_ms() / 1000
+            logger.warning(f"Binance used weight {weight} near limit, waiting {delay:.1f}s")
+            await asyncio.sleep(max(0.0, delay))
+
+    def _record_response(self, path: str, response: aiohttp.ClientResponse) -> None:
+        """تسجيل الوزن المستخدم وفترة الانتظار المطلوبة من رؤوس الاستجابة"""
+        header = self._weight_header_for(path)
+        value = response.headers.get(header)
+        if value is not None:
+            try:
+                self._used_weight[header] = (int(value), self.now_ms() // 60000)
+            except ValueError:
+                pass
+
+        if response.status in (418, 429):
+            try:
+                retry_after = float(response.headers.get('Retry-After', '60'))
+            except ValueError:
+                retry_after = 60.0
+            self._backoff_until = max(self._backoff_until, time.time() + retry_after)
+            logger.error(f"Binance rate limit hit ({response.status}) on {path}, backing off {retry_after:.0f}s")
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        params: Optional[Dict] = None,
+        signed: bool = True
+    ) -> Tuple[int, Any]:
+        """
+        تنفيذ طلب إلى Binance وإرجاع (رمز الحالة، البيانات).
+        عند فشل الاتصال يعاد الرمز 0.
+        """
+        if not self._last_time_sync:
+            await self.sync_time()
+
+        retried_clock = False
+        while True:
+            await self._wait_for_capacity(path)
+
+            query = {k: str(v) for k, v in (params or {}).items()}
+            if signed:
+                query['timestamp'] = str(self.now_ms())
+                query['recvWindow'] = str(self.recv_window)
+            query_string = urllib.parse.urlencode(sorted(query.items()))
+            if signed:
+                query_string = f"{query_string}&signature={self.sign(query_string)}"
+            url = f"{self.base_url}{path}"
+            if query_string:
+                url = f"{url}?{query_string}"
+
+            try:
+                session = await self._get_session()
+                async with session.request(method, url) as response:
+                    self._record_response(path, response)
+                    body = await response.read()
+                    status = response.status
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error requesting {path}: {str(e)}")
+                return 0, None
+
+            try:
+                data = json.loads(body) if body else None
+            except ValueError:
+                data = body.decode('utf-8', errors='replace')
+
+            # إعادة المحاولة مرة واحدة بعد تحديث الساعة إذا رفض الخادم الطابع الزمني
+            if (signed and not retried_clock and status == 400
+                    and isinstance(data, dict) and data.get('code') == TIMESTAMP_ERROR_CODE):
+                retried_clock = True
+                await self.sync_time()
+                continue
+
+            return status, data
+
+    async def signed_get(self, path: str, params: Optional[Dict] = None) -> Optional[Any]:
+        """تنفيذ طلب GET موقع وإرجاع البيانات أو None عند الفشل"""
+        status, data = await self.request('GET', path, params)
+        if status == 200:
+            return data
+        if status:
+            logger.error(f"Failed to retrieve data from {path}: {status}, Response: {data}")
+        return None
@@ -0,0 +1,293 @@
+import os
+import asyncio
+import logging
+import time
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from typing import Dict, List, Optional, Any
+
+logger = logging.getLogger(__name__)
+
+# حقول المعرفات التي تعيدها واجهات Binance المختلفة
+ID_FIELDS = ('txId', 'tranId', 'orderId', 'transactionId')
+
+# أعمدة جدول السجل المقابلة لكل حقل معرف
+ID_COLUMNS = {
+    'txId': 'tx_id',
+    'tranId': 'tran_id',
+    'orderId': 'order_id',
+    'transactionId': 'transaction_id'
+}
+
+# مصادر السجل ونقاط النهاية الخاصة بها
+LEDGER_SOURCES = {
+    'deposit': {
+        'url': '/sapi/v1/capital/deposit/hisrec',
+        'extra_params': {'coin': 'USDT', 'limit': '1000'},
+        'page_size': 1000
+    },
+    'transfer': {
+        'url': '/sapi/v1/asset/transfer',
+        'extra_params': {'type': 'MAIN_FUNDING', 'size': '100'},
+        'page_size': 100
+    },
+    'withdraw': {
+        'url': '/sapi/v1/capital/withdraw/history',
+        'extra_params': {'coin': 'USDT', 'limit': '1000'},
+        'page_size': 1000
+    },
+    'pay': {
+        'url': '/sapi/v1/pay/transactions',
+        'extra_params': {'limit': '100'},
+        'page_size': 100
+    }
+}
+
+OFFCHAIN_SOURCES = ('deposit', 'transfer', 'withdraw')
+PAY_SOURCES = ('pay',)
+
+
+def clean_binance_id(value: Any) -> str:
+    """توحيد صيغة معرف Binance بإزالة البادئة والمسافات"""
+    if value is None:
+        return ''
+    return str(value).replace('Off-chain transfer ', '').strip()
+
+
+def extract_row_time_ms(row: Dict) -> Optional[int]:
+    """استخراج وقت الحركة بالملي ثانية من صف Binance"""
+    for field in ('insertTime', 'timestamp', 'transactionTime', 'completeTime'):
+        value = row.get(field)
+        if value not in (None, ''):
+            try:
+                return int(value)
+            except (TypeError, ValueError):
+                continue
+
+    # سجل السحب يعيد applyTime كنص بتوقيت UTC
+    apply_time = row.get('applyTime')
+    if apply_time:
+        try:
+            parsed = datetime.strptime(str(apply_time), "%Y-%m-%d %H:%M:%S")
+            return int((parsed - datetime(1970, 1, 1)).total_seconds() * 1000)
+        except ValueError:
+            pass
+    return None
+
+
+def extract_row_amount(row: Dict) -> Decimal:
+    """استخراج مبلغ الحركة من صف Binance"""
+    try:
+        return Decimal(str(row.get('amount', row.get('transactionAmount', 0))))
+    except (InvalidOperation, TypeError):
+        return Decimal('0')
+
+
+def extract_rows(data: Any) -> List[Dict]:
+    """استخراج قائمة الصفوف من استجابة Binance بأشكالها المختلفة"""
+    if isinstance(data, list):
+        return data
+    if isinstance(data, dict):
+        return data.get('rows', data.get('data', [])) or []
+    return []
+
+
+class BinanceLedger:
+    """
+    سجل محلي لحركات حساب Binance يتم مزامنته تدريجياً باستخدام مؤشرات startTime
+    بحيث يصبح التحقق من المعاملات بحثاً مفهرساً في قاعدة البيانات.
+    """
+
+    def __init__(self, client, db, sync_interval: float = None):
+        """
+        :param client: كائن يوفر الدالة signed_get للطلبات الموقعة
+        :param db: كائن قاعدة البيانات
+        :param sync_interval: الفترة بين كل مزامنة بالثواني
+        """
+        self.client = client
+        self.db = db
+        self.sync_interval = sync_interval or float(os.getenv('BINANCE_LEDGER_SYNC_INTERVAL', '30'))
+        # تداخل بسيط مع المؤشر السابق لالتقاط تحديثات الحالة المتأخرة
+        self.overlap_ms = int(float(os.getenv('BINANCE_LEDGER_OVERLAP_SECONDS', '300')) * 1000)
+        # الفترة التي يتم سحبها عند أول تشغيل
+        self.bootstrap_ms = int(float(os.getenv('BINANCE_LEDGER_BOOTSTRAP_HOURS', '24')) * 3600 * 1000)
+        # أقل فترة بين مزامنتين عند الطلب
+        self.min_refresh_interval = float(os.getenv('BINANCE_LEDGER_MIN_REFRESH', '10'))
+        self.max_pages = 10
+        # أقصى طول لنافذة المزامنة الواحدة، فتلحق المزامنات التالية بالباقي
+        self.max_window_ms = int(float(os.getenv('BINANCE_LEDGER_MAX_WINDOW_HOURS', '24')) * 3600 * 1000)
+
+        self._sync_lock = asyncio.Lock()
+        self._last_sync = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._sync_requested = False
+        self._requested_task: Optional[asyncio.Task] = None
+
+    async def _sync_source(self, source: str, spec: Dict) -> int:
+        """
+        مزامنة مصدر واحد من آخر مؤشر محفوظ.
+        معظم واجهات السجل في Binance تعيد الأحدث أولاً، فالصفحة الممتلئة تكمل بتحريك endTime للأقدم،
+        والمؤشر لا يتقدم إلا بعد استلام كل صفوف النافذة.
+        """
+        now_ms = int(time.time() * 1000)
+        cursor = await asyncio.to_thread(self.db.get_binance_sync_cursor, source)
+        if cursor is None:
+            cursor = now_ms - self.bootstrap_ms
+
+        start_ms = max(0, cursor - self.overlap_ms)
+        # نافذة محدودة حتى تكتمل في عدد محدود من الصفحات بعد توقف طويل
+        window_end = min(now_ms, start_ms + self.max_window_ms)
+        end_ms = window_end
+        total = 0
+        complete = False
+        newest_first = None
+
+        for _ in range(self.max_pages):
+            params = {
+                **spec['extra_params'],
+                'startTime': str(start_ms),
+                'endTime': str(end_ms)
+            }
+            data = await self.client.signed_get(spec['url'], params)
+            if data is None:
+                # فشل الطلب، نحتفظ بالمؤشر الحالي ونعيد المحاولة لاحقاً
+                return total
+
+            rows = extract_rows(data)
+            entries = [self._to_entry(source, row) for row in rows]
+            entries = [entry for entry in entries if entry]
+            if entries:
+                total += await asyncio.to_thread(self.db.upsert_binance_ledger_entries, entries)
+
+            row_times = [t for t in (extract_row_time_ms(row) for row in rows) if t]
+            if len(rows) < spec['page_size'] or not row_times:
+                complete = True
+                break
+
+            # الصفحة ممتلئة: نحدد ترتيب الصفوف ونكمل من الطرف الذي لم يستلم بعد
+            if newest_first is None:
+                newest_first = row_times[0] >= row_times[-1]
+            if newest_first:
+                # صفوف بنفس الملي ثانية قد تكون في الصفحة التالية، فنعيد الحد الأدنى ما لم يتكرر
+                end_ms = min(row_times) if min(row_times) < end_ms else end_ms - 1
+                if end_ms < start_ms:
+                    complete = True
+                    break
+            else:
+                start_ms = max(row_times) if max(row_times) > start_ms else start_ms + 1
+                if start_ms > end_ms:
+                    complete = True
+                    break
+
+        if complete:
+            new_cursor = window_end
+        elif newest_first:
+            # الجزء الأقدم من النافذة لم يستلم بعد، فلا يتقدم المؤشر
+            logger.warning(f"لم تكتمل مزامنة سجل Binance للمصدر {source} خلال {self.max_pages} صفحات")
+            new_cursor = cursor
+        else:
+            # الصفوف مرتبة من الأقدم، فكل ما قبل start_ms تم استلامه
+            new_cursor = max(cursor, start_ms)
+        await asyncio.to_thread(self.db.update_binance_sync_cursor, source, new_cursor)
+        return total
+
+    def _to_entry(self, source: str, row: Dict) -> Optional[Dict]:
+        """تحويل صف Binance إلى سجل محلي"""
+        ids = {ID_COLUMNS[field]: clean_binance_id(row.get(field)) or None for field in ID_FIELDS}
+        time_ms = extract_row_time_ms(row)
+        record_key = clean_binance_id(row.get('id')) or next((v for v in ids.values() if v), None)
+        if not record_key:
+            if time_ms is None:
+                return None
+            record_key = f"{time_ms}:{extract_row_amount(row)}"
+
+        return {
+            'source': source,
+            'record_key': record_key,
+            **ids,
+            'coin': row.get('coin', row.get('asset', row.get('currency'))),
+            'amount': extract_row_amount(row),
+            'status': str(row.get('status', row.get('transactionStatus', ''))),
+            'event_time': datetime.fromtimestamp(time_ms / 1000) if time_ms else None,
+            'raw': row
+        }
+
+    async def sync_once(self) -> int:
+        """مزامنة جميع المصادر مرة واحدة"""
+        async with self._sync_lock:
+            total = 0
+            for source, spec in LEDGER_SOURCES.items():
+                try:
+                    total += await self._sync_source(source, spec)
+                except Exception as e:
+                    logger.error(f"خطأ في مزامنة سجل Binance للمصدر {source}: {e}", exc_info=True)
+            self._last_sync = time.time()
+            if total:
+                logger.info(f"تمت مزامنة {total} حركة من سجل Binance")
+            return total
+
+    async def refresh(self) -> None:
+        """
+        مزامنة فورية عند عدم العثور على معرف في السجل.
+        الطلبات المتزامنة تنتظر نفس المزامنة ولا تتكرر خلال min_refresh_interval.
+        """
+        if self._sync_lock.locked():
+            async with self._sync_lock:
+                return
+        if time.time() - self._last_sync < self.min_refresh_interval:
+            return
+        await self.sync_once()
+
+    def request_sync(self) -> None:
+        """
+        طلب مزامنة فورية من مصادر الأحداث (مثل بث بيانات المستخدم).
+        الطلبات التي تصل أثناء مزامنة جارية تدمج في مزامنة واحدة تالية.
+        """
+        self._sync_requested = True
+        if self._requested_task is None or self._requested_task.done():
+            self._requested_task = asyncio.create_task(self._run_requested_syncs())
+
+    async def _run_requested_syncs(self) -> None:
+        while self._sync_requested:
+            self._sync_requested = False
+            try:
+                await self.sync_once()
+            except Exception as e:
+                logger.error(f"خطأ في المزامنة المطلوبة لسجل Binance: {e}", exc_info=True)
+
+    def lookup(self, transfer_id: str, sources=None) -> List[Dict]:
+        """البحث عن معرف في السجل المحلي"""
+        transfer_id = clean_binance_id(transfer_id)
+        if not transfer_id:
+            return []
+        return self.db.find_binance_ledger_entries(transfer_id, list(sources) if sources else None)
+
+    async def run(self) -> None:
+        """حلقة المزامنة في الخلفية"""
+        logger.info("بدء مزامنة سجل Binance في الخلفية")
+        while True:
+            try:
+                await self.sync_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"خطأ في حلقة مزامنة سجل Binance: {e}", exc_info=True)
+            await asyncio.sleep(self.sync_interval)
+
+    def start(self) -> asyncio.Task:
+        """تشغيل المزامنة كمهمة في الخلفية"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def stop(self) -> None:
+        """إيقاف مهمة المزامنة"""
+        for task in (self._task, self._requested_task):
+            if task and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = None
+        self._requested_task = None
@@ -0,0 +1,186 @@
+import os
+import asyncio
+import json
+import logging
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from typing import Dict, Optional
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+LISTEN_KEY_PATH = '/api/v3/userDataStream'
+
+
+class BinanceUserDataStream:
+    """
+    مستهلك بث بيانات المستخدم من Binance.
+    يستقبل أحداث تغير الرصيد لحظياً ويسجلها في سجل الحركات المحلي
+    ثم يطلب مزامنة فورية للحصول على معرف الحركة قبل أن يرسله المستخدم.
+    """
+
+    def __init__(self, client, ledger, ws_base_url: str = None, coin: str = 'USDT'):
+        """
+        :param client: عميل Binance الموقع (BinanceSignedClient)
+        :param ledger: سجل الحركات المحلي (BinanceLedger)
+        :param ws_base_url: عنوان خادم البث، يمكن توجيهه إلى خادم محلي للاختبار
+        :param coin: العملة التي يتم تتبعها
+        """
+        self.client = client
+        self.ledger = ledger
+        self.coin = coin
+        self.ws_base_url = (ws_base_url or os.getenv('BINANCE_STREAM_URL', 'wss://stream.binance.com:9443/ws')).rstrip('/')
+        # Binance تنهي مفتاح الاستماع بعد 60 دقيقة بدون تجديد
+        self.keepalive_interval = float(os.getenv('BINANCE_LISTEN_KEY_KEEPALIVE', '1800'))
+        self.min_backoff = 1.0
+        self.max_backoff = float(os.getenv('BINANCE_STREAM_MAX_BACKOFF', '60'))
+
+        self.listen_key: Optional[str] = None
+        self._ws: Optional[aiohttp.ClientWebSocketResponse] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """جلسة مستقلة للبث بدون مهلة إجمالية لأن الاتصال طويل العمر"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=None, connect=10)
+            )
+        return self._session
+
+    async def _create_listen_key(self) -> Optional[str]:
+        status, data = await self.client.request('POST', LISTEN_KEY_PATH, signed=False)
+        if status == 200 and isinstance(data, dict) and data.get('listenKey'):
+            return data['listenKey']
+        logger.error(f"فشل في إنشاء مفتاح الاستماع من Binance: {status}, {data}")
+        return None
+
+    async def _keepalive_listen_key(self, listen_key: str) -> bool:
+        status, data = await self.client.request(
+            'PUT', LISTEN_KEY_PATH, {'listenKey': listen_key}, signed=False
+        )
+        if status == 200:
+            return True
+        logger.error(f"فشل في تجديد مفتاح الاستماع: {status}, {data}")
+        return False
+
+    async def _close_listen_key(self, listen_key: str) -> None:
+        try:
+            await self.client.request('DELETE', LISTEN_KEY_PATH, {'listenKey': listen_key}, signed=False)
+        except Exception as e:
+            logger.warning(f"تعذر حذف مفتاح الاستماع: {e}")
+
+    async def _keepalive_loop(self, listen_key: str) -> None:
+        """تجديد مفتاح الاستماع دورياً، وإغلاق الاتصال لإعادة إنشائه عند الفشل"""
+        while True:
+            await asyncio.sleep(self.keepalive_interval)
+            if not await self._keepalive_listen_key(listen_key):
+                if self._ws is not None and not self._ws.closed:
+                    await self._ws.close()
+                return
+
+    def _to_entry(self, event: Dict) -> Optional[Dict]:
+        """تحويل حدث تغير الرصيد إلى سجل محلي"""
+        try:
+            amount = Decimal(str(event.get('d')))
+        except (InvalidOperation, TypeError):
+            return None
+        event_ms = event.get('T') or event.get('E')
+        return {
+            'source': 'stream',
+            'record_key': f"{event_ms}:{event.get('a')}:{event.get('d')}",
+            'coin': event.get('a'),
+            'amount': amount,
+            'status': event.get('e'),
+            'event_time': datetime.fromtimestamp(int(event_ms) / 1000) if event_ms else None,
+            'raw': event
+        }
+
+    async def handle_event(self, event: Dict) -> bool:
+        """
+        معالجة حدث واحد من البث.
+        :return: False إذا انتهت صلاحية مفتاح الاستماع ويجب إعادة الاتصال
+        """
+        event_type = event.get('e')
+
+        if event_type == 'listenKeyExpired':
+            logger.warning("انتهت صلاحية مفتاح الاستماع، سيتم إنشاء مفتاح جديد")
+            return False
+
+        if event_type == 'balanceUpdate' and event.get('a') == self.coin:
+            entry = self._to_entry(event)
+            if entry:
+                await asyncio.to_thread(self.ledger.db.upsert_binance_ledger_entries, [entry])
+                logger.info(f"حدث رصيد من Binance: {entry['amount']} {entry['coin']}")
+                if entry['amount'] > 0:
+                    # حدث الرصيد لا يحمل معرف الحركة، لذا نجلبه من السجل فوراً
+                    self.ledger.request_sync()
+
+        return True
+
+    async def _consume(self, listen_key: str) -> None:
+        session = await self._get_session()
+        async with session.ws_connect(f"{self.ws_base_url}/{listen_key}", heartbeat=60) as ws:
+            self._ws = ws
+            logger.info("✅ تم الاتصال ببث بيانات المستخدم من Binance")
+            # مزامنة بعد كل اتصال لالتقاط ما فات أثناء الانقطاع
+            self.ledger.request_sync()
+            async for msg in ws:
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    try:
+                        event = json.loads(msg.data)
+                    except ValueError:
+                        logger.warning(f"رسالة غير صالحة من البث: {msg.data}")
+                        continue
+                    if not await self.handle_event(event):
+                        break
+                elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                    break
+        self._ws = None
+
+    async def run(self) -> None:
+        """حلقة الاتصال مع إعادة المحاولة التصاعدية"""
+        backoff = self.min_backoff
+        while True:
+            keepalive_task = None
+            try:
+                self.listen_key = await self._create_listen_key()
+                if self.listen_key:
+                    keepalive_task = asyncio.create_task(self._keepalive_loop(self.listen_key))
+                    await self._consume(self.listen_key)
+                    backoff = self.min_backoff
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"خطأ في بث بيانات المستخدم من Binance: {e}", exc_info=True)
+            finally:
+                if keepalive_task:
+                    keepalive_task.cancel()
+
+            logger.info(f"إعادة الاتصال ببث Binance بعد {backoff:.0f} ثانية")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def start(self) -> asyncio.Task:
+        """تشغيل المستهلك كمهمة في الخلفية"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def stop(self) -> None:
+        """إيقاف المستهلك وإغلاق مفتاح الاستماع والجلسة"""
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        if self.listen_key:
+            await self._close_listen_key(self.listen_key)
+            self.listen_key = None
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
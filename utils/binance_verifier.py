@@ -1,22 +1,46 @@
 from dotenv import load_dotenv
 import os
 import logging
-import hmac
-import hashlib
 import aiohttp
 import asyncio
 import re
 from datetime import datetime, timedelta
 from decimal import Decimal
-from typing import Optional, Dict, Tuple
+from typing import Optional, Dict, Tuple, List, Any
 import time
-import urllib.parse
+from utils.binance_client import BinanceSignedClient
+from utils.binance_ledger import (
+    BinanceLedger, OFFCHAIN_SOURCES, PAY_SOURCES, ID_FIELDS,
+    clean_binance_id, extract_rows, extract_row_amount, extract_row_time_ms
+)
 
 load_dotenv()
 logger = logging.getLogger(__name__)
 
+# شبكات USDT في البوت: اسم الشبكة في سجل إيداعات Binance وعقد USDT عليها
+DEPOSIT_NETWORKS = {
+    'TRC20': ('TRX', 'TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t'),
+    'BEP20': ('BSC', '0x55d398326f99059ff775485246999027b3197955'),
+    'ERC20': ('ETH', '0xdac17f958d2ee523a2206206994597c13d831ec7'),
+    'ARB20': ('ARBITRUM', '0xfd086bc7cd5c481dcc9c85ebe478a1c0b69fcbb9'),
+}
+
+# حالات الإيداع المكتمل في Binance (1: نجاح، 6: مضاف للرصيد)
+DEPOSIT_SUCCESS_STATUSES = ('1', '6')
+
+
+def create_binance_verifier(db=None) -> Optional['BinanceVerifier']:
+    """إنشاء BinanceVerifier إذا توفرت مفاتيح Binance، وإلا None"""
+    if not (os.getenv('BINANCE_API_KEY') and os.getenv('BINANCE_API_SECRET')):
+        return None
+    try:
+        return BinanceVerifier(db)
+    except ValueError as e:
+        logger.warning(f"لن يستخدم سجل Binance في التحقق: {e}")
+        return None
+
 class BinanceVerifier:
-    def __init__(self):
+    def __init__(self, db=None):
         # التحقق من المتغيرات البيئية المطلوبة
         self.api_key = os.getenv('BINANCE_API_KEY')
         if not self.api_key:
@@ -34,21 +58,15 @@ class BinanceVerifier:
         self.bsc_url = 'https://api.bscscan.com/api'
         self.usdt_contract = '0x55d398326f99059fF775485246999027B3197955'
         
-        # Rate limiting settings
-        self.last_api_call = 0
-        self.min_call_interval = 0.1  # 100ms between calls
+        # عميل الطلبات الموقعة: جلسة مشتركة، فرق ساعة محلي، وضبط الوتيرة حسب الوزن المستخدم
+        self.client = BinanceSignedClient(self.api_key, self.api_secret, self.base_url)
         self.max_retries = 3
         
         # Cache settings
         self._cache = {}
 
-    async def _wait_for_rate_limit(self):
-        """التحكم في معدل الطلبات"""
-        now = time.time()
-        time_since_last_call = now - self.last_api_call
-        if time_since_last_call < self.min_call_interval:
-            await asyncio.sleep(self.min_call_interval - time_since_last_call)
-        self.last_api_call = time.time()
+        # سجل الحركات المحلي (اختياري) للتحقق دون استهلاك وزن API لكل مستخدم
+        self.ledger = BinanceLedger(self.client, db) if db is not None else None
 
     def _get_cache_key(self, method: str, params: dict) -> str:
         """إنشاء مفتاح للتخزين المؤقت"""
@@ -67,46 +85,117 @@ class BinanceVerifier:
         """إضافة البيانات إلى التخزين المؤقت"""
         self._cache[cache_key] = (data, time.time())
 
-    async def _get_server_time(self) -> int:
-        """الحصول على وقت الخادم مع التخزين المؤقت"""
-        cache_key = self._get_cache_key('server_time', {})
-        cached_data = self._get_from_cache(cache_key)
-        if cached_data:
-            return cached_data
+    async def signed_get(self, path: str, params: dict) -> Optional[Any]:
+        """تنفيذ طلب GET موقع وإرجاع البيانات أو None عند الفشل"""
+        return await self.client.signed_get(path, params)
 
-        await self._wait_for_rate_limit()
-        
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f"{self.base_url}/api/v3/time") as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        server_time = int(data['serverTime'])
-                        self._add_to_cache(cache_key, server_time)
-                        return server_time
-                    else:
-                        logger.error(f"Failed to get server time: {response.status}")
-        except Exception as e:
-            logger.error(f"Error getting server time: {e}")
-        
-        # Fallback to local time
-        return int(time.time() * 1000)
+    async def close(self):
+        """إغلاق جلسة عميل Binance"""
+        await self.client.close()
 
-    def _generate_signature(self, params: dict) -> Tuple[str, str]:
-        # تحويل جميع القيم إلى سلاسل نصية
-        params = {k: str(v) for k, v in params.items()}
-        query_string = urllib.parse.urlencode(sorted(params.items()))
-        signature = hmac.new(
-            self.api_secret.encode('utf-8'),
-            query_string.encode('utf-8'),
-            hashlib.sha256
-        ).hexdigest()
+    async def _lookup_ledger(self, transfer_id: str, sources) -> List[Dict]:
+        """البحث في السجل المحلي مع مزامنة واحدة مشتركة عند عدم العثور على المعرف"""
+        rows = await asyncio.to_thread(self.ledger.lookup, transfer_id, sources)
+        if not rows:
+            await self.ledger.refresh()
+            rows = await asyncio.to_thread(self.ledger.lookup, transfer_id, sources)
+        return rows
 
-        # تسجيل معلومات التصحيح
-        logger.debug(f"Query String: {query_string}")
-        logger.debug(f"Signature: {signature}")
+    async def verify_deposit(
+        self,
+        network: str,
+        tx_hash: str,
+        expected_amount: Decimal,
+        deposit_address: str
+    ) -> Optional[Dict]:
+        """
+        التحقق من إيداع على الشبكة من سجل Binance المحلي: الإيداع على عنوان Binance
+        يظهر في سجل الإيداعات بنفس الهاش، فيكفي بحث مفهرس بدل طلبات مستكشف الشبكة.
+        يعيد نتيجة بصيغة BlockchainScanner، أو None ليكمل المستدعي بالتحقق من الشبكة.
+        """
+        if not self.ledger:
+            return None
+        binance_network, contract_address = DEPOSIT_NETWORKS.get((network or '').upper(), (None, None))
+        if not binance_network:
+            return None
+
+        tx_hash = tx_hash.strip()
+        try:
+            # بحث مفهرس فقط: معظم الإيداعات على الشبكة ليست لعناوين Binance فلا تستدعي مزامنة،
+            # والمزامنة الدورية وبث بيانات المستخدم يبقيان السجل محدثاً
+            rows = await asyncio.to_thread(self.ledger.lookup, tx_hash, ('deposit',))
+            if not rows and tx_hash.lower() != tx_hash:
+                rows = await asyncio.to_thread(self.ledger.lookup, tx_hash.lower(), ('deposit',))
+
+            for row in rows:
+                raw = row.get('raw') or {}
+                address = str(raw.get('address', ''))
+                if str(raw.get('network', '')).upper() != binance_network:
+                    continue
+                if str(row.get('coin') or '').upper() != 'USDT':
+                    continue
+                if str(row.get('status')) not in DEPOSIT_SUCCESS_STATUSES:
+                    logger.info(f"الإيداع {tx_hash} في سجل Binance لم يكتمل بعد (الحالة {row.get('status')})")
+                    continue
+                if deposit_address and address.lower() != deposit_address.lower():
+                    logger.warning(f"الإيداع {tx_hash} في سجل Binance على عنوان مختلف: {address}")
+                    continue
+
+                amount = Decimal(str(row['amount']))
+                if amount != expected_amount:
+                    logger.warning(f"رفض الإيداع {tx_hash} - المبلغ غير متطابق: متوقع {expected_amount}, فعلي {amount}")
+                    continue
+
+                logger.info(f"تم التحقق من الإيداع {tx_hash} من سجل Binance")
+                return {
+                    'txid': tx_hash,
+                    'amount': float(amount),
+                    'timestamp': row.get('event_time'),
+                    'contract_address': contract_address,
+                    'to_address': address,
+                    'from_address': '',
+                    'confirmed': True,
+                    'type': 'binance_deposit'
+                }
+            return None
+        except Exception as e:
+            logger.error(f"Error verifying deposit from Binance ledger: {str(e)}", exc_info=True)
+            return None
 
-        return signature, query_string
+    def _match_ledger_rows(
+        self,
+        rows: List[Dict],
+        transfer_id: str,
+        expected_amount: Decimal,
+        deposit_time: datetime
+    ) -> Optional[Dict]:
+        """التحقق من المبلغ والوقت لصفوف السجل المحلي"""
+        for row in rows:
+            if not row.get('event_time'):
+                continue
+            amount = Decimal(str(row['amount']))
+            tx_time = row['event_time']
+
+            if self._verify_amount_and_time(amount, tx_time, expected_amount, deposit_time):
+                if row['source'] == 'pay':
+                    return {
+                        'txid': transfer_id,
+                        'amount': float(amount),
+                        'timestamp': tx_time,
+                        'type': 'binance_pay',
+                        'status': row.get('status'),
+                        'confirmed': True
+                    }
+                return {
+                    'txid': transfer_id,
+                    'amount': float(amount),
+                    'timestamp': tx_time,
+                    'type': 'internal',
+                    'transfer_type': 'off-chain',
+                    'status': 'completed',
+                    'confirmed': True
+                }
+        return None
 
     def _verify_amount_and_time(
         self,
@@ -175,49 +264,40 @@ class BinanceVerifier:
         expected_amount: Decimal,
         deposit_time: datetime
     ) -> Optional[Dict]:
+        if self.ledger:
+            try:
+                rows = await self._lookup_ledger(transfer_id, PAY_SOURCES)
+                return self._match_ledger_rows(rows, transfer_id, expected_amount, deposit_time)
+            except Exception as e:
+                logger.error(f"Error verifying Binance Pay transaction from ledger: {str(e)}", exc_info=True)
+                return None
+
         try:
-            timestamp = await self._get_server_time()
             params = {
-                'timestamp': str(timestamp),
-                'recvWindow': '5000',
                 'startTime': str(int((deposit_time - timedelta(minutes=60)).timestamp() * 1000)),
                 'limit': '100'
             }
 
-            signature, query_string = self._generate_signature(params)
-            full_query_string = f"{query_string}&signature={signature}"
-            headers = {'X-MBX-APIKEY': self.api_key}
-
-            async with aiohttp.ClientSession() as session:
-                async with session.get(
-                    f"{self.base_url}/sapi/v1/pay/transactions?{full_query_string}",
-                    headers=headers
-                ) as response:
-                    response_text = await response.text()
-                    if response.status == 200:
-                        data = await response.json()
-                        transactions = data.get('data', [])
-                        logger.info(f"Found Binance Pay transactions: {transactions}")
-
-                        for transaction in transactions:
-                            order_id = str(transaction.get('orderId', '')).strip()
-                            if order_id == transfer_id:
-                                amount = Decimal(str(transaction.get('amount')))
-                                tx_time = datetime.fromtimestamp(int(transaction['transactionTime']) / 1000)
-
-                                if self._verify_amount_and_time(amount, tx_time, expected_amount, deposit_time):
-                                    return {
-                                        'txid': transfer_id,
-                                        'amount': float(amount),
-                                        'timestamp': tx_time,
-                                        'type': 'binance_pay',
-                                        'status': transaction.get('transactionStatus'),
-                                        'confirmed': True
-                                    }
-                    else:
-                        logger.error(
-                            f"Failed to retrieve Binance Pay transactions: {response.status}, Response: {response_text}"
-                        )
+            data = await self.client.signed_get('/sapi/v1/pay/transactions', params)
+            if data is not None:
+                transactions = data.get('data', [])
+                logger.info(f"Found Binance Pay transactions: {transactions}")
+
+                for transaction in transactions:
+                    order_id = str(transaction.get('orderId', '')).strip()
+                    if order_id == transfer_id:
+                        amount = Decimal(str(transaction.get('amount')))
+                        tx_time = datetime.fromtimestamp(int(transaction['transactionTime']) / 1000)
+
+                        if self._verify_amount_and_time(amount, tx_time, expected_amount, deposit_time):
+                            return {
+                                'txid': transfer_id,
+                                'amount': float(amount),
+                                'timestamp': tx_time,
+                                'type': 'binance_pay',
+                                'status': transaction.get('transactionStatus'),
+                                'confirmed': True
+                            }
             return None
         except Exception as e:
             logger.error(f"Error verifying Binance Pay transaction: {str(e)}", exc_info=True)
@@ -229,13 +309,18 @@ class BinanceVerifier:
         expected_amount: Decimal,
         deposit_time: datetime
     ) -> Optional[Dict]:
+        if self.ledger:
+            try:
+                rows = await self._lookup_ledger(transfer_id, OFFCHAIN_SOURCES)
+                return self._match_ledger_rows(rows, transfer_id, expected_amount, deposit_time)
+            except Exception as e:
+                logger.error(f"Error verifying off-chain transfer from ledger: {str(e)}")
+                return None
+
         try:
-            timestamp = await self._get_server_time()
             base_params = {
-                'timestamp': str(timestamp),
-                'recvWindow': '5000',
                 'startTime': str(int((deposit_time - timedelta(minutes=60)).timestamp() * 1000)),
-                'endTime': str(timestamp)
+                'endTime': str(self.client.now_ms())
             }
 
             endpoints = [
@@ -253,57 +338,25 @@ class BinanceVerifier:
                 }
             ]
 
-            headers = {'X-MBX-APIKEY': self.api_key}
+            wanted_id = clean_binance_id(transfer_id)
 
-            async with aiohttp.ClientSession() as session:
-                for endpoint in endpoints:
-                    try:
-                        params = {**base_params, **endpoint['extra_params']}
-                        signature, query_string = self._generate_signature(params)
-                        full_query_string = f"{query_string}&signature={signature}"
-
-                        async with session.get(
-                            f"{self.base_url}{endpoint['url']}?{full_query_string}",
-                            headers=headers
-                        ) as response:
-                            response_text = await response.text()
-                            if response.status == 200:
-                                data = await response.json()
-                                logger.info(f"Response from {endpoint['url']}: {data}")
-
-                                transactions = data if isinstance(data, list) else data.get('rows', data.get('data', []))
-
-                                for tx in transactions:
-                                    for id_field in ['txId', 'tranId', 'orderId', 'transactionId']:
-                                        tx_id_value = str(tx.get(id_field, '')).strip()
-                                        # إزالة البادئة إذا وجدت
-                                        tx_id_clean = tx_id_value.replace('Off-chain transfer ', '').strip()
-                                        if tx_id_clean == transfer_id.strip():
-                                            amount = Decimal(str(tx.get('amount', tx.get('transactionAmount', 0))))
-
-                                            tx_timestamp = int(tx.get(
-                                                'insertTime',
-                                                tx.get('timestamp', time.time() * 1000)
-                                            ))
-                                            tx_time = datetime.fromtimestamp(tx_timestamp / 1000)
-
-                                            if self._verify_amount_and_time(amount, tx_time, expected_amount, deposit_time):
-                                                return {
-                                                    'txid': transfer_id,
-                                                    'amount': float(amount),
-                                                    'timestamp': tx_time,
-                                                    'type': 'internal',
-                                                    'transfer_type': 'off-chain',
-                                                    'status': 'completed',
-                                                    'confirmed': True
-                                                }
-                            else:
-                                logger.error(
-                                    f"Failed to retrieve data from {endpoint['url']}: {response.status}, Response: {response_text}"
-                                )
-                    except Exception as e:
-                        logger.error(f"Error checking endpoint {endpoint['url']}: {str(e)}")
-                        continue
+            # الاستعلام عن جميع نقاط النهاية بالتوازي والعودة عند أول تطابق
+            tasks = [
+                asyncio.create_task(self._check_offchain_endpoint(
+                    endpoint, base_params, wanted_id, expected_amount, deposit_time
+                ))
+                for endpoint in endpoints
+            ]
+            try:
+                for next_done in asyncio.as_completed(tasks):
+                    result = await next_done
+                    if result:
+                        return result
+            finally:
+                for task in tasks:
+                    if not task.done():
+                        task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
 
             return None
 
@@ -311,6 +364,61 @@ class BinanceVerifier:
             logger.error(f"Error verifying off-chain transfer: {str(e)}")
             return None
 
+    @staticmethod
+    def _index_rows_by_id(rows: List[Dict]) -> Dict[str, Dict]:
+        """بناء فهرس من المعرف إلى الصف لكل حقول المعرفات"""
+        index = {}
+        for row in rows:
+            for id_field in ID_FIELDS:
+                row_id = clean_binance_id(row.get(id_field))
+                if row_id and row_id not in index:
+                    index[row_id] = row
+        return index
+
+    async def _check_offchain_endpoint(
+        self,
+        endpoint: Dict,
+        base_params: Dict,
+        wanted_id: str,
+        expected_amount: Decimal,
+        deposit_time: datetime
+    ) -> Optional[Dict]:
+        """فحص نقطة نهاية واحدة بحثاً عن التحويل الداخلي"""
+        try:
+            params = {**base_params, **endpoint['extra_params']}
+            # العميل يقرأ جسم الاستجابة ويحلله مرة واحدة فقط
+            data = await self.client.signed_get(endpoint['url'], params)
+            if data is None:
+                return None
+
+            logger.debug(f"Response from {endpoint['url']}: {data}")
+
+            tx = self._index_rows_by_id(extract_rows(data)).get(wanted_id)
+            if not tx:
+                return None
+
+            amount = extract_row_amount(tx)
+            tx_timestamp = extract_row_time_ms(tx) or int(time.time() * 1000)
+            tx_time = datetime.fromtimestamp(tx_timestamp / 1000)
+
+            if self._verify_amount_and_time(amount, tx_time, expected_amount, deposit_time):
+                return {
+                    'txid': wanted_id,
+                    'amount': float(amount),
+                    'timestamp': tx_time,
+                    'type': 'internal',
+                    'transfer_type': 'off-chain',
+                    'status': 'completed',
+                    'confirmed': True
+                }
+            return None
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error checking endpoint {endpoint['url']}: {str(e)}")
+            return None
+
     async def _verify_internal_transfer(
         self,
         transfer_id: str,
@@ -318,53 +426,34 @@ class BinanceVerifier:
         deposit_time: datetime
     ) -> Optional[Dict]:
         try:
-            timestamp = await self._get_server_time()
             params = {
-                'timestamp': str(timestamp),
                 'startTime': str(int((deposit_time - timedelta(minutes=60)).timestamp() * 1000)),
-                'endTime': str(timestamp),
-                'recvWindow': '5000'
+                'endTime': str(self.client.now_ms())
             }
 
-            # تحويل القيم إلى سلاسل نصية
-            params = {k: str(v) for k, v in params.items()}
-
-            signature, query_string = self._generate_signature(params)
-            full_query_string = f"{query_string}&signature={signature}"
-            headers = {'X-MBX-APIKEY': self.api_key}
-
-            logger.debug(f"Request URL: {self.base_url}/sapi/v1/asset/transfer?{full_query_string}")
-
-            async with aiohttp.ClientSession() as session:
-                async with session.get(
-                    f"{self.base_url}/sapi/v1/asset/transfer?{full_query_string}",
-                    headers=headers
-                ) as response:
-                    response_text = await response.text()
-                    if response.status == 200:
-                        data = await response.json()
-                        for transfer in data.get('rows', []):
-                            tran_id = str(transfer.get('tranId', '')).strip()
-                            # إزالة البادئة إذا وجدت
-                            tran_id_clean = tran_id.replace('Off-chain transfer ', '').strip()
-                            if tran_id_clean == transfer_id.strip():
-                                amount = Decimal(str(transfer.get('amount', 0)))
-                                tx_time = datetime.fromtimestamp(transfer['timestamp'] / 1000)
-
-                                if self._verify_amount_and_time(amount, tx_time, expected_amount, deposit_time):
-                                    return {
-                                        'txid': transfer_id,
-                                        'amount': float(amount),
-                                        'timestamp': tx_time,
-                                        'type': 'internal',
-                                        'confirmed': True
-                                    }
-                    else:
-                        logger.error(
-                            f"Failed to retrieve internal transfers: {response.status}, Response: {response_text}"
-                        )
+            data = await self.client.signed_get('/sapi/v1/asset/transfer', params)
+            if data is None:
+                logger.error("Failed to retrieve internal transfers")
                 return None
 
+            for transfer in data.get('rows', []):
+                tran_id = str(transfer.get('tranId', '')).strip()
+                # إزالة البادئة إذا وجدت
+                tran_id_clean = tran_id.replace('Off-chain transfer ', '').strip()
+                if tran_id_clean == transfer_id.strip():
+                    amount = Decimal(str(transfer.get('amount', 0)))
+                    tx_time = datetime.fromtimestamp(transfer['timestamp'] / 1000)
+
+                    if self._verify_amount_and_time(amount, tx_time, expected_amount, deposit_time):
+                        return {
+                            'txid': transfer_id,
+                            'amount': float(amount),
+                            'timestamp': tx_time,
+                            'type': 'internal',
+                            'confirmed': True
+                        }
+            return None
+
         except Exception as e:
             logger.error(f"Error verifying internal transfer: {str(e)}")
             return None
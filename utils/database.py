@@ -1,11 +1,31 @@
 import psycopg2
 import os
+import time
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Tuple
-from psycopg2.extras import DictCursor, RealDictCursor
+from psycopg2.extras import DictCursor, RealDictCursor, Json, execute_values
 
 logger = logging.getLogger(__name__)
+
+# قناة NOTIFY لتغيرات التحويلات (تستمع لها لوحة التحكم)
+TRANSFER_EVENTS_CHANNEL = 'transfer_events'
+
+# حقول التحويل التي يبحث فيها كجزء من النص (بفهارس trigram)
+SEARCH_TEXT_COLUMNS = ('recipient_name', 'recipient_number', 'account_number')
+
+# دقة دلاء الأحجام بالثواني، والأبعاد التي يمكن التقسيم أو التصفية بها
+VOLUME_RESOLUTIONS = {'minute': 60, 'hour': 3600, 'day': 86400}
+VOLUME_DIMENSIONS = ('usdt_network', 'local_currency', 'wallet_name', 'status')
+
+
+def _like_escape(value: str) -> str:
+    """تهريب أحرف LIKE الخاصة في نص البحث"""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+# حدود فئات مدرج زمن تنفيذ Tasker بالثواني (من الإرسال حتى الاستدعاء العكسي)
+TASKER_LATENCY_BUCKETS = (15, 30, 60, 120, 300, 600, 1800, float('inf'))
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -14,6 +34,11 @@ logging.basicConfig(
 class Database:
     def __init__(self, db_url: str = None):
         self.db_url = db_url or os.getenv("DATABASE_URL")
+        # يفعّل في _init_db إذا توفر امتداد pg_trgm
+        self.trigram_search = False
+        # دلاء الدقائق تحذف بعد هذه المدة، والساعات والأيام تبقى
+        self.minute_retention_days = int(os.getenv('TIMESERIES_MINUTE_RETENTION_DAYS', '7'))
+        self._volume_pruned_at = float('-inf')
         self._init_db()
         
     def get_user(self, user_id: int) -> Optional[Dict]:
@@ -43,6 +68,9 @@ class Database:
             conn = self._connect()
             cursor = conn.cursor()
 
+            # البوت وعمال لوحة التحكم يبدؤون معاً، فالتهيئة تتم في عملية واحدة في كل مرة
+            cursor.execute("SELECT pg_advisory_xact_lock(hashtext('withdraw_init_db'))")
+
             # جداول PostgreSQL كما في النسخة السابقة
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS users (
@@ -115,12 +143,324 @@ class Database:
                 )
             ''')
 
+            # سجل حركات حساب Binance المتزامن محلياً
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS binance_ledger (
+                    source TEXT NOT NULL,
+                    record_key TEXT NOT NULL,
+                    tx_id TEXT,
+                    tran_id TEXT,
+                    order_id TEXT,
+                    transaction_id TEXT,
+                    coin TEXT,
+                    amount NUMERIC,
+                    status TEXT,
+                    event_time TIMESTAMP,
+                    raw JSONB,
+                    synced_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (source, record_key)
+                )
+            ''')
+
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS binance_sync_cursors (
+                    source TEXT PRIMARY KEY,
+                    cursor_ms BIGINT NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # صندوق صادر مهام Tasker، يكتب في نفس معاملة تغيير حالة التحويل
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS tasker_outbox (
+                    id BIGSERIAL PRIMARY KEY,
+                    transfer_id TEXT NOT NULL,
+                    idempotency_key TEXT NOT NULL UNIQUE,
+                    payload JSONB NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    last_error TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # أجهزة Tasker وأنواع المحافظ التي يخدمها كل جهاز
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS tasker_devices (
+                    device_id TEXT PRIMARY KEY,
+                    endpoint TEXT NOT NULL,
+                    wallet_types TEXT[] NOT NULL,
+                    max_in_flight INTEGER NOT NULL DEFAULT 1,
+                    in_flight INTEGER NOT NULL DEFAULT 0,
+                    enabled BOOLEAN NOT NULL DEFAULT TRUE,
+                    last_heartbeat TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            cursor.execute('ALTER TABLE tasker_outbox ADD COLUMN IF NOT EXISTS device_id TEXT')
+            cursor.execute('ALTER TABLE tasker_outbox ADD COLUMN IF NOT EXISTS device_released_at TIMESTAMP')
+
+            # صندوق وارد الاستدعاءات العكسية من Tasker، مفتاحه (التحويل، المحاولة) لمنع التكرار
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS tasker_callbacks (
+                    id BIGSERIAL PRIMARY KEY,
+                    transfer_id TEXT NOT NULL,
+                    attempt_id TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    error TEXT,
+                    payload JSONB,
+                    outcome TEXT,
+                    received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    applied_at TIMESTAMP,
+                    UNIQUE (transfer_id, attempt_id)
+                )
+            ''')
+
+            # وقت دخول التحويل حالة المعالجة، ووقت إرسال المهمة للجهاز لقياس زمن التنفيذ
+            cursor.execute('ALTER TABLE transfers ADD COLUMN IF NOT EXISTS processing_started_at TIMESTAMP')
+            cursor.execute('ALTER TABLE tasker_outbox ADD COLUMN IF NOT EXISTS wallet_type TEXT')
+            cursor.execute('ALTER TABLE tasker_outbox ADD COLUMN IF NOT EXISTS sent_at TIMESTAMP')
+
+            # رسالة إشعار المشرفين بالتحويل، وتبقى فارغة حتى تنجح مرحلة الإشعار
+            # (التحويلات الموجودة قبل إضافة العمود تعتبر مشعراً بها)
+            cursor.execute('ALTER TABLE transfers ADD COLUMN IF NOT EXISTS admin_message_id BIGINT')
+            cursor.execute('ALTER TABLE transfers ADD COLUMN IF NOT EXISTS admin_notified_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP')
+            cursor.execute('ALTER TABLE transfers ALTER COLUMN admin_notified_at DROP DEFAULT')
+
+            # مدرج زمن التنفيذ لكل جهاز ومحفظة ونتيجة
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS tasker_latency (
+                    device_id TEXT NOT NULL,
+                    wallet_type TEXT NOT NULL,
+                    outcome TEXT NOT NULL,
+                    bucket_le DOUBLE PRECISION NOT NULL,
+                    count BIGINT NOT NULL DEFAULT 0,
+                    sum_seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (device_id, wallet_type, outcome, bucket_le)
+                )
+            ''')
+
+            # حالة البوت (user_data و chat_data) صف لكل مستخدم أو محادثة بدلاً من ملف pickle واحد
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS bot_persistence (
+                    kind TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    data BYTEA NOT NULL,
+                    version BIGINT NOT NULL DEFAULT 1,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (kind, key)
+                )
+            ''')
+
+            # حالات المحادثات النشطة فقط، المحادثة المنتهية تحذف
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS bot_conversations (
+                    name TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    state JSONB NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (name, key)
+                )
+            ''')
+
+            # دلاء تقييد المستخدمين المشتركة بين نسخ البوت
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS throttle_buckets (
+                    key TEXT PRIMARY KEY,
+                    tokens DOUBLE PRECISION NOT NULL,
+                    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # أحجام التحويلات المجمعة لكل دقيقة/ساعة/يوم، يحدثها trigger على transfers
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS transfer_volume_buckets (
+                    resolution TEXT NOT NULL,
+                    bucket_start TIMESTAMP NOT NULL,
+                    usdt_network TEXT NOT NULL DEFAULT '',
+                    local_currency TEXT NOT NULL DEFAULT '',
+                    wallet_name TEXT NOT NULL DEFAULT '',
+                    status TEXT NOT NULL DEFAULT '',
+                    transfer_count INTEGER NOT NULL DEFAULT 0,
+                    usdt_volume DOUBLE PRECISION NOT NULL DEFAULT 0,
+                    local_volume DOUBLE PRECISION NOT NULL DEFAULT 0,
+                    PRIMARY KEY (resolution, bucket_start, usdt_network, local_currency, wallet_name, status)
+                )
+            ''')
+
+            # سجل تغييرات الأحجام يضيف إليه الـ trigger فقط، وتجمعه rollup_volume_deltas في الدلاء
+            # حتى لا تتزاحم تحديثات حالة التحويلات على صفوف الدلاء نفسها
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS transfer_volume_deltas (
+                    id BIGSERIAL PRIMARY KEY,
+                    created_at TIMESTAMP NOT NULL,
+                    usdt_network TEXT NOT NULL DEFAULT '',
+                    local_currency TEXT NOT NULL DEFAULT '',
+                    wallet_name TEXT NOT NULL DEFAULT '',
+                    status TEXT NOT NULL DEFAULT '',
+                    delta INTEGER NOT NULL,
+                    usdt_amount DOUBLE PRECISION NOT NULL DEFAULT 0,
+                    local_amount DOUBLE PRECISION NOT NULL DEFAULT 0
+                )
+            ''')
+
             # إنشاء الفهارس
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_transfers_processing_started
+                ON transfers(processing_started_at) WHERE status = 'processing'
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_tasker_callbacks_unapplied
+                ON tasker_callbacks(id) WHERE applied_at IS NULL
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_tasker_outbox_due ON tasker_outbox(status, next_attempt_at)')
+            # مهمة نشطة واحدة فقط لكل تحويل
+            cursor.execute('''
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_tasker_outbox_active_transfer
+                ON tasker_outbox(transfer_id) WHERE status IN ('pending', 'in_flight')
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_binance_ledger_tx_id ON binance_ledger(tx_id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_binance_ledger_tran_id ON binance_ledger(tran_id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_binance_ledger_order_id ON binance_ledger(order_id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_binance_ledger_transaction_id ON binance_ledger(transaction_id)')
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_transfers_user_id ON transfers(user_id)')
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_transfers_status ON transfers(status)')
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_transfers_created_at ON transfers(created_at)')
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_registration_codes_code ON registration_codes(code)')
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_registration_codes_status ON registration_codes(status)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_registration_code ON users(registration_code)')
+
+            # used_count هو عدد المستخدمين المسجلين بالكود، تحافظ عليه add_user وupdate_user_code
+            # ويصحح هنا ما تراكم سابقاً (كان يزداد مع كل تحقق من الكود)
+            cursor.execute('''
+                UPDATE registration_codes rc
+                SET used_count = counts.users
+                FROM (
+                    SELECT c.id, COUNT(u.user_id) AS users
+                    FROM registration_codes c
+                    LEFT JOIN users u ON u.registration_code = c.code
+                    GROUP BY c.id
+                ) counts
+                WHERE rc.id = counts.id AND rc.used_count IS DISTINCT FROM counts.users
+            ''')
+            if cursor.rowcount:
+                logger.info(f"تم تصحيح عدد الاستخدام لـ {cursor.rowcount} كود تسجيل")
+
+            # فهارس البحث في التحويلات: بادئة لمعرف التحويل والهاش، وtrigram للأسماء والأرقام
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_transfers_id_prefix ON transfers(transfer_id text_pattern_ops)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_transfers_tx_hash_prefix ON transfers(lower(tx_hash) text_pattern_ops)')
+            cursor.execute('SAVEPOINT trigram_search')
+            try:
+                cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+                for column in SEARCH_TEXT_COLUMNS:
+                    cursor.execute(f'''
+                        CREATE INDEX IF NOT EXISTS idx_transfers_{column}_trgm
+                        ON transfers USING GIN ({column} gin_trgm_ops)
+                    ''')
+                for column in ('code', 'description'):
+                    cursor.execute(f'''
+                        CREATE INDEX IF NOT EXISTS idx_registration_codes_{column}_trgm
+                        ON registration_codes USING GIN ({column} gin_trgm_ops)
+                    ''')
+                cursor.execute('RELEASE SAVEPOINT trigram_search')
+                self.trigram_search = True
+            except psycopg2.Error as e:
+                # قد لا يملك مستخدم قاعدة البيانات صلاحية إنشاء الامتداد، فيعمل البحث بدون فهارس التشابه
+                cursor.execute('ROLLBACK TO SAVEPOINT trigram_search')
+                logger.warning(f"تعذر تفعيل pg_trgm، سيعمل البحث في التحويلات بدون فهارس trigram: {e}")
+
+            # إشعار لوحة التحكم بالتحويلات الجديدة وتغير حالتها عبر LISTEN/NOTIFY
+            cursor.execute('''
+                CREATE OR REPLACE FUNCTION notify_transfer_change() RETURNS trigger AS $$
+                DECLARE
+                    old_status TEXT;
+                BEGIN
+                    IF TG_OP = 'UPDATE' THEN
+                        old_status := OLD.status;
+                    END IF;
+                    PERFORM pg_notify('transfer_events', json_build_object(
+                        'op', TG_OP,
+                        'transfer_id', NEW.transfer_id,
+                        'status', NEW.status,
+                        'old_status', old_status,
+                        'transfer_type', NEW.transfer_type,
+                        'amount', NEW.amount,
+                        'user_code', (SELECT registration_code FROM users WHERE user_id = NEW.user_id),
+                        'created_at', NEW.created_at,
+                        'updated_at', NEW.updated_at
+                    )::text);
+                    RETURN NEW;
+                END;
+                $$ LANGUAGE plpgsql
+            ''')
+            cursor.execute('''
+                DO $$
+                BEGIN
+                    IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'trg_transfers_notify_insert') THEN
+                        CREATE TRIGGER trg_transfers_notify_insert
+                        AFTER INSERT ON transfers
+                        FOR EACH ROW EXECUTE PROCEDURE notify_transfer_change();
+                    END IF;
+                    IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'trg_transfers_notify_status') THEN
+                        CREATE TRIGGER trg_transfers_notify_status
+                        AFTER UPDATE OF status ON transfers
+                        FOR EACH ROW WHEN (OLD.status IS DISTINCT FROM NEW.status)
+                        EXECUTE PROCEDURE notify_transfer_change();
+                    END IF;
+                END
+                $$
+            ''')
+
+            # تسجيل تغييرات الأحجام: التعديل يطرح مساهمة الصف القديم ويضيف الجديد.
+            # الـ trigger يضيف صفوفاً جديدة فقط ولا يقفل أي صف مشترك
+            cursor.execute('''
+                CREATE OR REPLACE FUNCTION track_transfer_volume() RETURNS trigger AS $$
+                BEGIN
+                    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.created_at IS NOT NULL THEN
+                        INSERT INTO transfer_volume_deltas
+                            (created_at, usdt_network, local_currency, wallet_name, status, delta, usdt_amount, local_amount)
+                        VALUES (OLD.created_at, coalesce(OLD.usdt_network, ''), coalesce(OLD.local_currency, ''),
+                                coalesce(OLD.wallet_name, ''), coalesce(OLD.status, ''), -1,
+                                coalesce(OLD.final_usdt_amount, OLD.amount, 0), coalesce(OLD.local_amount, 0));
+                    END IF;
+                    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.created_at IS NOT NULL THEN
+                        INSERT INTO transfer_volume_deltas
+                            (created_at, usdt_network, local_currency, wallet_name, status, delta, usdt_amount, local_amount)
+                        VALUES (NEW.created_at, coalesce(NEW.usdt_network, ''), coalesce(NEW.local_currency, ''),
+                                coalesce(NEW.wallet_name, ''), coalesce(NEW.status, ''), 1,
+                                coalesce(NEW.final_usdt_amount, NEW.amount, 0), coalesce(NEW.local_amount, 0));
+                    END IF;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql
+            ''')
+            cursor.execute("SELECT 1 FROM pg_trigger WHERE tgname = 'trg_transfers_volume'")
+            if cursor.fetchone() is None:
+                # إنشاء الـ trigger يقفل الكتابة على transfers حتى نهاية المعاملة، فالتعبئة الأولى لا تفقد أي تحويل
+                cursor.execute('''
+                    CREATE TRIGGER trg_transfers_volume
+                    AFTER INSERT OR DELETE OR UPDATE OF status, amount, final_usdt_amount, local_amount,
+                        usdt_network, local_currency, wallet_name, created_at ON transfers
+                    FOR EACH ROW EXECUTE PROCEDURE track_transfer_volume()
+                ''')
+                cursor.execute('''
+                    INSERT INTO transfer_volume_buckets
+                        (resolution, bucket_start, usdt_network, local_currency, wallet_name, status,
+                         transfer_count, usdt_volume, local_volume)
+                    SELECT r.res, date_trunc(r.res, t.created_at), coalesce(t.usdt_network, ''),
+                           coalesce(t.local_currency, ''), coalesce(t.wallet_name, ''), coalesce(t.status, ''),
+                           COUNT(*), SUM(coalesce(t.final_usdt_amount, t.amount, 0)), SUM(coalesce(t.local_amount, 0))
+                    FROM transfers t
+                    CROSS JOIN (VALUES ('minute'), ('hour'), ('day')) AS r(res)
+                    WHERE t.created_at IS NOT NULL
+                      AND (r.res <> 'minute' OR t.created_at >= CURRENT_TIMESTAMP - %s * INTERVAL '1 day')
+                    GROUP BY 1, 2, 3, 4, 5, 6
+                    ON CONFLICT DO NOTHING
+                ''', (self.minute_retention_days,))
+                logger.info(f"تمت تعبئة دلاء أحجام التحويلات: {cursor.rowcount} صف")
 
             conn.commit()
             cursor.close()
@@ -287,6 +627,10 @@ class Database:
             return False
 
     def verify_registration_code(self, code: str) -> bool:
+        """
+        التحقق من أن الكود موجود ونشط. يستدعى مع كل /start للمستخدمين المسجلين،
+        لذلك لا يغير used_count ولا يفحص max_uses (يتم ذلك عند التسجيل في add_user).
+        """
         if not code:
             logger.warning("تم تمرير كود تسجيل فارغ.")
             return False
@@ -294,30 +638,16 @@ class Database:
         try:
             with psycopg2.connect(self.db_url) as conn:
                 cursor = conn.cursor()
-                # تحسين استعلام التحقق من الكود
                 cursor.execute('''
-                    SELECT rc.status, rc.used_count, rc.max_uses, rc.description 
+                    SELECT rc.description
                     FROM registration_codes rc
                     WHERE TRIM(LOWER(rc.code)) = TRIM(LOWER(%s))
                     AND rc.status = 'active'
                 ''', (code,))
                 result = cursor.fetchone()
-                
+
                 if result:
-                    status, used_count, max_uses, description = result
-                    # التحقق من حد الاستخدام
-                    if max_uses != -1 and used_count >= max_uses:
-                        logger.warning(f"كود التسجيل {code} تجاوز الحد الأقصى للاستخدام.")
-                        return False
-                        
-                    # تحديث عدد مرات الاستخدام
-                    cursor.execute('''
-                        UPDATE registration_codes 
-                        SET used_count = used_count + 1 
-                        WHERE TRIM(LOWER(code)) = TRIM(LOWER(%s))
-                    ''', (code,))
-                    conn.commit()
-                    
+                    description = result[0]
                     logger.info(f"كود التسجيل {description} صالح.")
                     return True
                 else:
@@ -367,27 +697,25 @@ class Database:
         try:
             with psycopg2.connect(self.db_url) as conn:
                 cursor = conn.cursor(cursor_factory=DictCursor)
+                cursor.execute('SELECT * FROM registration_codes WHERE code = %s', (code,))
+                result = cursor.fetchone()
+                if not result:
+                    return None
+                details = dict(result)
+
+                # مستخدمو الكود وتحويلاتهم عبر فهرسي users(registration_code) وtransfers(user_id)
                 cursor.execute('''
-                    SELECT 
-                        rc.*,
-                        COUNT(u.user_id) as active_users,
-                        ARRAY_AGG(DISTINCT u.user_id) FILTER (WHERE u.user_id IS NOT NULL) as user_ids,
-                        (
-                            SELECT COUNT(*)
-                            FROM transfers t
-                            JOIN users u2 ON u2.user_id = t.user_id
-                            WHERE u2.registration_code = rc.code
-                        ) as total_transfers
-                    FROM registration_codes rc
-                    LEFT JOIN users u ON u.registration_code = rc.code
-                    WHERE rc.code = %s
-                    GROUP BY rc.id
+                    SELECT u.user_id, COUNT(t.transfer_id) AS transfers
+                    FROM users u
+                    LEFT JOIN transfers t ON t.user_id = u.user_id
+                    WHERE u.registration_code = %s
+                    GROUP BY u.user_id
                 ''', (code,))
-                
-                result = cursor.fetchone()
-                if result:
-                    return dict(result)
-                return None
+                users = cursor.fetchall()
+                details['active_users'] = details['used_count']
+                details['user_ids'] = [row['user_id'] for row in users] or None
+                details['total_transfers'] = sum(row['transfers'] for row in users)
+                return details
                 
         except psycopg2.Error as e:
             logger.error(f"خطأ في الحصول على تفاصيل الكود {code}: {e}")
@@ -414,6 +742,23 @@ class Database:
             logger.error(f"خطأ في حذف كود التسجيل {code}: {e}")
             return False
 
+    def _move_code_usage(self, cursor, old_code: Optional[str], new_code: Optional[str]) -> None:
+        """نقل استخدام المستخدم من كوده السابق إلى الجديد داخل معاملة المستدعي"""
+        if old_code == new_code:
+            return
+        if old_code:
+            cursor.execute('''
+                UPDATE registration_codes
+                SET used_count = GREATEST(used_count - 1, 0)
+                WHERE code = %s
+            ''', (old_code,))
+        if new_code:
+            cursor.execute('''
+                UPDATE registration_codes
+                SET used_count = used_count + 1
+                WHERE code = %s
+            ''', (new_code,))
+
     def update_user_code(self, user_id: int, new_code: str) -> bool:
         """تحديث كود التسجيل للمستخدم"""
         try:
@@ -421,20 +766,25 @@ class Database:
             with psycopg2.connect(self.db_url) as conn:
                 cursor = conn.cursor()
                 
-                # التحقق من وجود الكود الجديد وأنه نشط
+                # التحقق من وجود الكود الجديد وأنه نشط، مع قفله حتى نهاية المعاملة
                 cursor.execute('''
                     SELECT status, used_count, max_uses 
                     FROM registration_codes 
                     WHERE code = %s AND status = 'active'
+                    FOR UPDATE
                 ''', (new_code,))
                 code_info = cursor.fetchone()
                 
                 if not code_info:
                     logger.warning(f"الكود الجديد {new_code} غير صالح أو غير نشط.")
                     return False
-                    
+
+                cursor.execute('SELECT registration_code FROM users WHERE user_id = %s FOR UPDATE', (user_id,))
+                previous = cursor.fetchone()
+                old_code = previous[0] if previous else None
+
                 status, used_count, max_uses = code_info
-                if max_uses != -1 and used_count >= max_uses:
+                if old_code != new_code and max_uses != -1 and used_count >= max_uses:
                     logger.warning(f"الكود {new_code} تجاوز الحد الأقصى للاستخدام.")
                     return False
                 
@@ -446,12 +796,9 @@ class Database:
                     WHERE user_id = %s
                 ''', (new_code, now, user_id))
                 
-                # تحديث عدد مرات استخدام الكود الجديد
-                cursor.execute('''
-                    UPDATE registration_codes 
-                    SET used_count = used_count + 1 
-                    WHERE code = %s
-                ''', (new_code,))
+                # تحديث عدد مرات استخدام الكود القديم والجديد
+                if cursor.rowcount:
+                    self._move_code_usage(cursor, old_code, new_code)
                 
                 conn.commit()
                 logger.info(f"تم تحديث كود التسجيل للمستخدم {user_id} إلى {new_code}.")
@@ -466,12 +813,27 @@ class Database:
             now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             with psycopg2.connect(self.db_url) as conn:
                 cursor = conn.cursor()
+
+                # قفل صف الكود حتى نهاية المعاملة فلا يتجاوز تسجيلان متزامنان max_uses
+                cursor.execute('''
+                    SELECT used_count, max_uses
+                    FROM registration_codes
+                    WHERE code = %s
+                    FOR UPDATE
+                ''', (registration_code,))
+                code_info = cursor.fetchone()
+                if code_info and code_info[1] != -1 and code_info[0] >= code_info[1]:
+                    logger.warning(f"الكود {registration_code} تجاوز الحد الأقصى للاستخدام.")
+                    return False
                 
                 # التحقق من عدم وجود مستخدم آخر بنفس الكود
                 cursor.execute('SELECT COUNT(*) FROM users WHERE registration_code = %s', (registration_code,))
                 if cursor.fetchone()[0] > 0:
                     logger.warning(f"الكود {registration_code} مستخدم بالفعل.")
                     return False
+
+                cursor.execute('SELECT registration_code FROM users WHERE user_id = %s FOR UPDATE', (user_id,))
+                previous = cursor.fetchone()
                 
                 # إضافة المستخدم
                 # ملاحظة: PostgreSQL يستخدم ON CONFLICT المستخدم_id.
@@ -485,12 +847,8 @@ class Database:
                         last_activity = EXCLUDED.registration_date
                 ''', (user_id, registration_code, now))
                 
-                # تحديث عدد مرات استخدام الكود
-                cursor.execute('''
-                    UPDATE registration_codes 
-                    SET used_count = used_count + 1 
-                    WHERE code = %s
-                ''', (registration_code,))
+                # تحديث عدد مرات استخدام الكود (وإنقاص الكود السابق عند إعادة التسجيل)
+                self._move_code_usage(cursor, previous[0] if previous else None, registration_code)
                 
                 conn.commit()
                 logger.info(f"تم إضافة/تحديث المستخدم {user_id} مع كود التسجيل {registration_code}.")
@@ -755,6 +1113,81 @@ class Database:
                 'total_pages': 0
             }
 
+    def search_transfers(self, query: str, page: int = 1, per_page: int = 20,
+                         status: Optional[str] = None) -> Dict:
+        """
+        البحث في التحويلات باسم المستلم أو رقمه أو رقم الحساب أو الهاش أو معرف التحويل.
+        معرف التحويل والهاش يطابقان كبادئة والحقول الأخرى كجزء من النص،
+        والنتائج مرتبة: تطابق تام ثم بادئة ثم درجة التشابه ثم الأحدث.
+        """
+        query = (query or '').strip()
+        result = {'transfers': [], 'query': query, 'page': page, 'per_page': per_page, 'has_more': False}
+        if len(query) < 2:
+            return result
+
+        # الهاش يحفظ أحياناً مع 0x وأحياناً بدونها
+        lowered = query.lower()
+        if lowered.startswith('0x'):
+            lowered = lowered[2:]
+        escaped = _like_escape(lowered)
+        params = {
+            'query': query,
+            'exact': lowered,
+            'prefix': f"{escaped}%",
+            'hash_prefix': f"0x{escaped}%",
+            'contains': f"%{escaped}%",
+        }
+
+        prefix_match = ("t.transfer_id LIKE %(prefix)s OR lower(t.tx_hash) LIKE %(prefix)s "
+                        "OR lower(t.tx_hash) LIKE %(hash_prefix)s")
+        conditions = [prefix_match]
+        # أقل من 3 أحرف لا تستفيد من فهارس trigram فيكتفى بالبادئة
+        if len(query) >= 3:
+            conditions += [f"t.{column} ILIKE %(contains)s" for column in SEARCH_TEXT_COLUMNS]
+
+        if self.trigram_search:
+            similarity = 'GREATEST(' + ', '.join(
+                f"similarity(coalesce(t.{column}, ''), %(query)s)" for column in SEARCH_TEXT_COLUMNS
+            ) + ')'
+        else:
+            similarity = '0'
+
+        sql = f'''
+            SELECT
+                t.*,
+                u.registration_code AS user_code,
+                CASE
+                    WHEN t.transfer_id = %(exact)s OR lower(t.tx_hash) IN (%(exact)s, '0x' || %(exact)s)
+                         OR t.recipient_number = %(query)s OR t.account_number = %(query)s THEN 3
+                    WHEN {prefix_match} THEN 2
+                    ELSE 1
+                END + {similarity} AS rank
+            FROM transfers t
+            LEFT JOIN users u ON t.user_id = u.user_id
+            WHERE ({' OR '.join(conditions)})
+        '''
+        if status:
+            sql += ' AND t.status = %(status)s'
+            params['status'] = status
+        # صف إضافي لمعرفة وجود صفحة تالية بدلاً من COUNT على كل النتائج
+        sql += ' ORDER BY rank DESC, t.created_at DESC LIMIT %(limit)s OFFSET %(offset)s'
+        params['limit'] = per_page + 1
+        params['offset'] = (page - 1) * per_page
+
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor()
+                cursor.execute(sql, params)
+                columns = [desc[0] for desc in cursor.description]
+                transfers = [dict(zip(columns, row)) for row in cursor.fetchall()]
+                result['has_more'] = len(transfers) > per_page
+                result['transfers'] = transfers[:per_page]
+                logger.info(f"بحث التحويلات '{query}': {len(result['transfers'])} نتيجة في الصفحة {page}")
+                return result
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في البحث في التحويلات '{query}': {e}")
+            return result
+
     def get_transfer_details(self, transfer_id: str) -> Optional[Dict]:
         try:
             with psycopg2.connect(self.db_url) as conn:
@@ -782,28 +1215,65 @@ class Database:
             logger.error(f"خطأ في جلب تفاصيل التحويل {transfer_id}: {e}")
             return None
 
-    def get_all_codes(self) -> List[Dict]:
-        """الحصول على جميع الأكواد مع إحصائياتها"""
+    def list_codes(self, limit: int = 50, after: Optional[int] = None,
+                   query: Optional[str] = None, status: Optional[str] = None) -> Dict:
+        """
+        صفحة من أكواد التسجيل، الأحدث أولاً، مع بحث في الكود والوصف وتصفية بالحالة.
+        الترقيم بالمفتاح: after هو معرف آخر كود في الصفحة السابقة (next_cursor).
+        عدد الاستخدام من used_count مباشرة، ومبالغ التحويلات المكتملة تجمع لأكواد الصفحة فقط.
+        """
+        where = []
+        params = []
+        if after:
+            where.append('id < %s')
+            params.append(after)
+        if status:
+            where.append('status = %s')
+            params.append(status)
+        query = (query or '').strip()
+        if query:
+            where.append('(code ILIKE %s OR description ILIKE %s)')
+            params += [f"%{_like_escape(query)}%"] * 2
+        params.append(limit + 1)
+
+        result = {'codes': [], 'next_cursor': None}
         try:
             with psycopg2.connect(self.db_url) as conn:
                 cursor = conn.cursor(cursor_factory=RealDictCursor)
-                cursor.execute('''
-                    SELECT 
-                        c.*,
-                        COUNT(t.transfer_id) as used_count,
-                        COALESCE(SUM(t.amount), 0) as total_amount,
-                        COALESCE(SUM(t.final_usdt_amount), 0) as total_usdt
-                    FROM registration_codes c
-                    LEFT JOIN users u ON u.registration_code = c.code
-                    LEFT JOIN transfers t ON t.user_id = u.user_id AND t.status = 'completed'
-                    GROUP BY c.code, c.id, c.description, c.status, c.max_uses, c.created_at
-                    ORDER BY c.created_at DESC
-                ''')
+                cursor.execute(f'''
+                    WITH page AS (
+                        SELECT * FROM registration_codes
+                        {'WHERE ' + ' AND '.join(where) if where else ''}
+                        ORDER BY id DESC
+                        LIMIT %s
+                    ),
+                    totals AS (
+                        SELECT
+                            u.registration_code AS code,
+                            SUM(t.amount) AS total_amount,
+                            SUM(t.final_usdt_amount) AS total_usdt
+                        FROM users u
+                        JOIN transfers t ON t.user_id = u.user_id AND t.status = 'completed'
+                        WHERE u.registration_code IN (SELECT code FROM page)
+                        GROUP BY u.registration_code
+                    )
+                    SELECT
+                        page.*,
+                        COALESCE(totals.total_amount, 0) AS total_amount,
+                        COALESCE(totals.total_usdt, 0) AS total_usdt
+                    FROM page
+                    LEFT JOIN totals ON totals.code = page.code
+                    ORDER BY page.id DESC
+                ''', params)
                 codes = cursor.fetchall()
-                return codes
-        except Exception as e:
+                if len(codes) > limit:
+                    codes = codes[:limit]
+                    result['next_cursor'] = codes[-1]['id']
+                result['codes'] = codes
+                return result
+        except psycopg2.Error as e:
             logger.error(f"خطأ في الحصول على قائمة الأكواد: {e}")
-            return []
+            return result
 
     def check_transfer_exists(self, transfer_id: str) -> bool:
         try:
@@ -1060,3 +1530,926 @@ class Database:
         except psycopg2.Error as e:
             logger.error(f"خطأ في التحقق من تكرار رمز المعاملة {tx_hash}: {e}")
             return False
+
+    def upsert_binance_ledger_entries(self, entries: List[Dict]) -> int:
+        """إضافة أو تحديث حركات سجل Binance دفعة واحدة"""
+        if not entries:
+            return 0
+
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor()
+                values = [
+                    (
+                        entry['source'],
+                        entry['record_key'],
+                        entry.get('tx_id'),
+                        entry.get('tran_id'),
+                        entry.get('order_id'),
+                        entry.get('transaction_id'),
+                        entry.get('coin'),
+                        entry.get('amount'),
+                        entry.get('status'),
+                        entry.get('event_time'),
+                        Json(entry.get('raw') or {}),
+                        datetime.now()
+                    )
+                    for entry in entries
+                ]
+                execute_values(cursor, '''
+                    INSERT INTO binance_ledger (
+                        source, record_key, tx_id, tran_id, order_id, transaction_id,
+                        coin, amount, status, event_time, raw, synced_at
+                    ) VALUES %s
+                    ON CONFLICT (source, record_key) DO UPDATE SET
+                        tx_id = EXCLUDED.tx_id,
+                        tran_id = EXCLUDED.tran_id,
+                        order_id = EXCLUDED.order_id,
+                        transaction_id = EXCLUDED.transaction_id,
+                        amount = EXCLUDED.amount,
+                        status = EXCLUDED.status,
+                        event_time = EXCLUDED.event_time,
+                        raw = EXCLUDED.raw,
+                        synced_at = EXCLUDED.synced_at
+                ''', values)
+                conn.commit()
+                return len(values)
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في حفظ حركات سجل Binance: {e}")
+            return 0
+
+    def find_binance_ledger_entries(self, transfer_id: str, sources: Optional[List[str]] = None) -> List[Dict]:
+        """البحث عن حركة في سجل Binance بأي من حقول المعرفات المفهرسة"""
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor(cursor_factory=RealDictCursor)
+                query = '''
+                    SELECT source, record_key, tx_id, tran_id, order_id, transaction_id,
+                           coin, amount, status, event_time, raw
+                    FROM binance_ledger
+                    WHERE (tx_id = %s OR tran_id = %s OR order_id = %s OR transaction_id = %s)
+                '''
+                params = [transfer_id] * 4
+
+                if sources:
+                    query += ' AND source = ANY(%s)'
+                    params.append(sources)
+
+                cursor.execute(query, params)
+                return [dict(row) for row in cursor.fetchall()]
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في البحث في سجل Binance عن {transfer_id}: {e}")
+            return []
+
+    def get_binance_sync_cursor(self, source: str) -> Optional[int]:
+        """الحصول على آخر مؤشر مزامنة لمصدر في سجل Binance"""
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT cursor_ms FROM binance_sync_cursors WHERE source = %s', (source,))
+                row = cursor.fetchone()
+                return int(row[0]) if row else None
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في الحصول على مؤشر مزامنة Binance للمصدر {source}: {e}")
+            return None
+
+    def update_binance_sync_cursor(self, source: str, cursor_ms: int) -> bool:
+        """تحديث مؤشر مزامنة مصدر في سجل Binance"""
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    INSERT INTO binance_sync_cursors (source, cursor_ms, updated_at)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT(source) DO UPDATE SET
+                        cursor_ms = EXCLUDED.cursor_ms,
+                        updated_at = EXCLUDED.updated_at
+                ''', (source, cursor_ms, datetime.now()))
+                conn.commit()
+                return True
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في تحديث مؤشر مزامنة Binance للمصدر {source}: {e}")
+            return False
+
+    def enqueue_tasker_job(self, transfer_id: str, payload: Dict, idempotency_key: str,
+                           expected_status: str = 'pending', wallet_type: Optional[str] = None) -> bool:
+        """
+        تحويل حالة التحويل إلى "جاري المعالجة" وإضافة مهمة Tasker في نفس المعاملة.
+        لا يتم شيء إذا لم يكن التحويل في الحالة المتوقعة أو كانت له مهمة نشطة.
+        """
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor()
+                # processing_started_at بتوقيت قاعدة البيانات ليقارن مع NOW() عند البحث عن العالق
+                cursor.execute('''
+                    UPDATE transfers
+                    SET status = 'processing', processing_started_at = NOW(), updated_at = %s
+                    WHERE transfer_id = %s AND status = %s
+                ''', (datetime.now(), transfer_id, expected_status))
+                if cursor.rowcount == 0:
+                    conn.rollback()
+                    logger.warning(f"التحويل {transfer_id} ليس في الحالة {expected_status}، لم تتم إضافة مهمة Tasker")
+                    return False
+
+                cursor.execute('''
+                    INSERT INTO tasker_outbox (transfer_id, idempotency_key, payload, wallet_type)
+                    VALUES (%s, %s, %s, %s)
+                    ON CONFLICT DO NOTHING
+                ''', (transfer_id, idempotency_key, Json(payload), wallet_type))
+                if cursor.rowcount == 0:
+                    conn.rollback()
+                    logger.warning(f"توجد مهمة Tasker نشطة للتحويل {transfer_id}")
+                    return False
+
+                conn.commit()
+                logger.info(f"تمت إضافة مهمة Tasker للتحويل {transfer_id}")
+                return True
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في إضافة مهمة Tasker للتحويل {transfer_id}: {e}")
+            return False
+
+    def claim_tasker_jobs(self, limit: int = 1, lease_seconds: int = 60) -> List[Dict]:
+        """
+        حجز المهام المستحقة لعامل واحد.
+        المهام المحجوزة التي انتهت مهلتها (عامل توقف) تعود قابلة للحجز.
+        """
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor(cursor_factory=RealDictCursor)
+                cursor.execute('''
+                    UPDATE tasker_outbox
+                    SET status = 'in_flight',
+                        attempts = attempts + 1,
+                        next_attempt_at = NOW() + make_interval(secs => %s),
+                        updated_at = NOW()
+                    WHERE id IN (
+                        SELECT id FROM tasker_outbox
+                        WHERE status IN ('pending', 'in_flight') AND next_attempt_at <= NOW()
+                        ORDER BY next_attempt_at
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING id, transfer_id, idempotency_key, payload, attempts
+                ''', (lease_seconds, limit))
+                jobs = [dict(row) for row in cursor.fetchall()]
+                conn.commit()
+                return jobs
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في حجز مهام Tasker: {e}")
+            return []
+
+    def mark_tasker_job_sent(self, job_id: int) -> bool:
+        """تعليم مهمة Tasker كمرسلة"""
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    UPDATE tasker_outbox
+                    SET status = 'sent', last_error = NULL, sent_at = NOW(), updated_at = NOW()
+                    WHERE id = %s
+                ''', (job_id,))
+                conn.commit()
+                return cursor.rowcount > 0
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في تحديث مهمة Tasker {job_id}: {e}")
+            return False
+
+    def reschedule_tasker_job(self, job_id: int, delay_seconds: float, error: str,
+                              count_attempt: bool = True) -> bool:
+        """
+        إعادة جدولة مهمة Tasker بعد فشل مؤقت.
+        :param count_attempt: False عندما لم يتم الإرسال أصلاً (مثل عدم توفر جهاز) فلا تحتسب المحاولة
+        """
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    UPDATE tasker_outbox
+                    SET status = 'pending',
+                        attempts = attempts - %s,
+                        next_attempt_at = NOW() + make_interval(secs => %s),
+                        last_error = %s,
+                        updated_at = NOW()
+                    WHERE id = %s
+                ''', (0 if count_attempt else 1, delay_seconds, error, job_id))
+                conn.commit()
+                return cursor.rowcount > 0
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في إعادة جدولة مهمة Tasker {job_id}: {e}")
+            return False
+
+    def dead_letter_tasker_job(self, job_id: int, error: str) -> Optional[str]:
+        """
+        نقل مهمة Tasker إلى حالة الفشل النهائي وإعادة التحويل إلى "معلق"
+        في نفس المعاملة ليتمكن المشرف من معالجته يدوياً.
+        :return: معرف التحويل أو None
+        """
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    UPDATE tasker_outbox
+                    SET status = 'dead', last_error = %s, updated_at = NOW()
+                    WHERE id = %s
+                    RETURNING transfer_id
+                ''', (error, job_id))
+                row = cursor.fetchone()
+                if not row:
+                    conn.rollback()
+                    return None
+
+                cursor.execute('''
+                    UPDATE transfers
+                    SET status = 'pending', updated_at = %s
+                    WHERE transfer_id = %s AND status = 'processing'
+                ''', (datetime.now(), row[0]))
+                conn.commit()
+                logger.warning(f"تم نقل مهمة Tasker {job_id} للتحويل {row[0]} إلى الفشل النهائي: {error}")
+                return row[0]
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في نقل مهمة Tasker {job_id} إلى الفشل النهائي: {e}")
+            return None
+
+    def upsert_tasker_device(self, device_id: str, endpoint: str, wallet_types: List[str],
+                             max_in_flight: int, in_flight: Optional[int] = None) -> bool:
+        """تسجيل جهاز Tasker أو تحديث نبضته وإعداداته"""
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    INSERT INTO tasker_devices (
+                        device_id, endpoint, wallet_types, max_in_flight, in_flight, last_heartbeat, updated_at
+                    ) VALUES (%s, %s, %s, %s, COALESCE(%s, 0), NOW(), NOW())
+                    ON CONFLICT (device_id) DO UPDATE SET
+                        endpoint = EXCLUDED.endpoint,
+                        wallet_types = EXCLUDED.wallet_types,
+                        max_in_flight = EXCLUDED.max_in_flight,
+                        in_flight = COALESCE(%s, tasker_devices.in_flight),
+                        last_heartbeat = NOW(),
+                        updated_at = NOW()
+                ''', (device_id, endpoint, wallet_types, max_in_flight, in_flight, in_flight))
+                conn.commit()
+                return True
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في تسجيل جهاز Tasker {device_id}: {e}")
+            return False
+
+    def get_tasker_devices(self) -> List[Dict]:
+        """الحصول على جميع أجهزة Tasker المسجلة"""
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor(cursor_factory=RealDictCursor)
+                cursor.execute('''
+                    SELECT device_id, endpoint, wallet_types, max_in_flight, in_flight,
+                           enabled, last_heartbeat
+                    FROM tasker_devices
+                    ORDER BY device_id
+                ''')
+                return [dict(row) for row in cursor.fetchall()]
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في الحصول على أجهزة Tasker: {e}")
+            return []
+
+    def acquire_tasker_device(self, wallet_type: str, job_id: int, heartbeat_ttl: int) -> Optional[Dict]:
+        """
+        اختيار أقل الأجهزة السليمة حملاً لنوع المحفظة وحجز خانة عليه
+        وربط المهمة به في نفس المعاملة.
+        """
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor(cursor_factory=RealDictCursor)
+                cursor.execute('''
+                    UPDATE tasker_devices
+                    SET in_flight = in_flight + 1, updated_at = NOW()
+                    WHERE device_id = (
+                        SELECT device_id FROM tasker_devices
+                        WHERE enabled
+                          AND %s = ANY(wallet_types)
+                          AND last_heartbeat > NOW() - make_interval(secs => %s)
+                          AND in_flight < max_in_flight
+                        ORDER BY in_flight::float / max_in_flight, last_heartbeat DESC
+                        LIMIT 1
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING device_id, endpoint, in_flight, max_in_flight
+                ''', (wallet_type, heartbeat_ttl))
+                device = cursor.fetchone()
+                if not device:
+                    conn.rollback()
+                    return None
+
+                cursor.execute(
+                    'UPDATE tasker_outbox SET device_id = %s, device_released_at = NULL WHERE id = %s',
+                    (device['device_id'], job_id)
+                )
+                conn.commit()
+                return dict(device)
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في اختيار جهاز Tasker لنوع المحفظة {wallet_type}: {e}")
+            return None
+
+    def has_tasker_device_for(self, wallet_type: str) -> bool:
+        """التحقق من وجود جهاز مفعل يخدم نوع المحفظة بغض النظر عن حالته"""
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    'SELECT 1 FROM tasker_devices WHERE enabled AND %s = ANY(wallet_types) LIMIT 1',
+                    (wallet_type,)
+                )
+                return cursor.fetchone() is not None
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في البحث عن أجهزة Tasker لنوع المحفظة {wallet_type}: {e}")
+            return False
+
+    def release_tasker_job_device(self, job_id: int) -> Optional[str]:
+        """تحرير خانة الجهاز المحجوزة لمهمة فشل إرسالها"""
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT id, device_id FROM tasker_outbox
+                    WHERE id = %s AND device_id IS NOT NULL AND device_released_at IS NULL
+                    FOR UPDATE
+                ''', (job_id,))
+                job = cursor.fetchone()
+                if not job:
+                    conn.rollback()
+                    return None
+                self._release_job_device(cursor, job[0], job[1])
+                conn.commit()
+                return job[1]
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في تحرير جهاز مهمة Tasker {job_id}: {e}")
+            return None
+
+    def _release_job_device(self, cursor, job_id: int, device_id: str) -> None:
+        # تعليم التحرير على المهمة يمنع تحرير الجهاز مرتين
+        cursor.execute(
+            'UPDATE tasker_outbox SET device_released_at = NOW(), updated_at = NOW() WHERE id = %s',
+            (job_id,)
+        )
+        cursor.execute('''
+            UPDATE tasker_devices
+            SET in_flight = GREATEST(in_flight - 1, 0), updated_at = NOW()
+            WHERE device_id = %s
+        ''', (device_id,))
+
+    def release_tasker_device_for_transfer(self, transfer_id: str) -> Optional[str]:
+        """تحرير الجهاز الذي نفذ آخر مهمة مرسلة للتحويل عند وصول النتيجة"""
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT id, device_id FROM tasker_outbox
+                    WHERE transfer_id = %s AND status = 'sent'
+                      AND device_id IS NOT NULL AND device_released_at IS NULL
+                    ORDER BY id DESC
+                    LIMIT 1
+                    FOR UPDATE
+                ''', (transfer_id,))
+                job = cursor.fetchone()
+                if not job:
+                    conn.rollback()
+                    return None
+
+                self._release_job_device(cursor, job[0], job[1])
+                conn.commit()
+                return job[1]
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في تحرير جهاز Tasker للتحويل {transfer_id}: {e}")
+            return None
+
+    def record_tasker_callbacks(self, callbacks: List[Dict]) -> Optional[int]:
+        """
+        حفظ الاستدعاءات العكسية في صندوق الوارد مع تجاهل المكرر منها.
+        :return: عدد الاستدعاءات الجديدة، أو None عند الفشل
+        """
+        if not callbacks:
+            return 0
+
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor()
+                values = [
+                    (
+                        item['transfer_id'],
+                        item['attempt_id'],
+                        item['status'],
+                        item.get('error'),
+                        Json(item.get('payload') or {})
+                    )
+                    for item in callbacks
+                ]
+                inserted = execute_values(cursor, '''
+                    INSERT INTO tasker_callbacks (transfer_id, attempt_id, status, error, payload)
+                    VALUES %s
+                    ON CONFLICT (transfer_id, attempt_id) DO NOTHING
+                    RETURNING id
+                ''', values, fetch=True)
+                conn.commit()
+                return len(inserted)
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في حفظ استدعاءات Tasker: {e}")
+            return None
+
+    def apply_tasker_callbacks(self, limit: int = 100) -> List[Dict]:
+        """
+        تطبيق الاستدعاءات العكسية المعلقة على التحويلات في معاملة واحدة.
+        الحالات النهائية (مكتمل/مرفوض) لا تتغير أبداً، والفشل لا يطبق إلا على تحويل جاري المعالجة،
+        أما الاكتمال فيطبق أيضاً على تحويل أعيد للمشرفين لأن المبلغ أرسل فعلاً.
+        :return: الاستدعاءات التي تم تطبيقها مع نتيجتها
+        """
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor(cursor_factory=RealDictCursor)
+                cursor.execute('''
+                    SELECT id, transfer_id, attempt_id, status, error, received_at
+                    FROM tasker_callbacks
+                    WHERE applied_at IS NULL
+                    ORDER BY id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                ''', (limit,))
+                callbacks = [dict(row) for row in cursor.fetchall()]
+
+                for callback in callbacks:
+                    if callback['status'] == 'completed':
+                        allowed_from = ['processing', 'pending', 'failed']
+                    else:
+                        allowed_from = ['processing']
+
+                    now = datetime.now()
+                    cursor.execute('''
+                        UPDATE transfers
+                        SET status = %s,
+                            rejection_reason = COALESCE(%s, rejection_reason),
+                            completed_at = CASE WHEN %s = 'completed' THEN %s ELSE completed_at END,
+                            updated_at = %s
+                        WHERE transfer_id = %s AND status = ANY(%s)
+                        RETURNING transfer_id
+                    ''', (
+                        callback['status'],
+                        callback['error'] if callback['status'] == 'failed' else None,
+                        callback['status'], now, now,
+                        callback['transfer_id'], allowed_from
+                    ))
+                    applied = cursor.fetchone() is not None
+                    callback['outcome'] = 'applied' if applied else 'ignored'
+
+                    if applied and callback['status'] in ('completed', 'failed'):
+                        cursor.execute('''
+                            SELECT id, device_id, device_released_at, wallet_type, sent_at
+                            FROM tasker_outbox
+                            WHERE transfer_id = %s AND status IN ('sent', 'expired')
+                            ORDER BY id DESC
+                            LIMIT 1
+                            FOR UPDATE
+                        ''', (callback['transfer_id'],))
+                        job = cursor.fetchone()
+                        if job:
+                            # تحرير خانة الجهاز الذي نفذ التحويل
+                            if job['device_id'] and job['device_released_at'] is None:
+                                self._release_job_device(cursor, job['id'], job['device_id'])
+                            if job['sent_at']:
+                                latency = (callback['received_at'] - job['sent_at']).total_seconds()
+                                self._record_tasker_latency(
+                                    cursor, job['device_id'], job['wallet_type'], callback['status'], latency
+                                )
+
+                    cursor.execute(
+                        'UPDATE tasker_callbacks SET applied_at = %s, outcome = %s WHERE id = %s',
+                        (now, callback['outcome'], callback['id'])
+                    )
+
+                conn.commit()
+                return callbacks
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في تطبيق استدعاءات Tasker: {e}")
+            return []
+
+    def _record_tasker_latency(self, cursor, device_id: Optional[str], wallet_type: Optional[str],
+                               outcome: str, seconds: float) -> None:
+        seconds = max(0.0, seconds)
+        bucket = next(le for le in TASKER_LATENCY_BUCKETS if seconds <= le)
+        cursor.execute('''
+            INSERT INTO tasker_latency (device_id, wallet_type, outcome, bucket_le, count, sum_seconds, updated_at)
+            VALUES (%s, %s, %s, %s, 1, %s, NOW())
+            ON CONFLICT (device_id, wallet_type, outcome, bucket_le) DO UPDATE SET
+                count = tasker_latency.count + 1,
+                sum_seconds = tasker_latency.sum_seconds + EXCLUDED.sum_seconds,
+                updated_at = NOW()
+        ''', (device_id or 'default', wallet_type or 'unknown', outcome, bucket, seconds))
+
+    def get_tasker_latency(self) -> List[Dict]:
+        """صفوف مدرج زمن التنفيذ مرتبة حسب الجهاز والمحفظة والنتيجة والفئة"""
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor(cursor_factory=RealDictCursor)
+                cursor.execute('''
+                    SELECT device_id, wallet_type, outcome, bucket_le, count, sum_seconds
+                    FROM tasker_latency
+                    ORDER BY device_id, wallet_type, outcome, bucket_le
+                ''')
+                return [dict(row) for row in cursor.fetchall()]
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في جلب مدرج زمن تنفيذ Tasker: {e}")
+            return []
+
+    def find_stuck_tasker_transfers(self, min_age_seconds: float) -> List[Dict]:
+        """
+        التحويلات العالقة في حالة المعالجة منذ min_age_seconds على الأقل
+        وليست لها مهمة في الصندوق ما زالت قيد الإرسال أو إعادة المحاولة.
+        """
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor(cursor_factory=RealDictCursor)
+                cursor.execute('''
+                    SELECT t.transfer_id, t.wallet_name, t.processing_started_at,
+                           EXTRACT(EPOCH FROM NOW() - t.processing_started_at) AS age_seconds,
+                           j.id AS job_id, j.device_id, j.wallet_type, j.sent_at
+                    FROM transfers t
+                    LEFT JOIN LATERAL (
+                        SELECT id, device_id, wallet_type, sent_at, status
+                        FROM tasker_outbox
+                        WHERE transfer_id = t.transfer_id
+                        ORDER BY id DESC
+                        LIMIT 1
+                    ) j ON TRUE
+                    WHERE t.status = 'processing'
+                      AND t.processing_started_at < NOW() - make_interval(secs => %s)
+                      AND (j.status IS NULL OR j.status NOT IN ('pending', 'in_flight'))
+                    ORDER BY t.processing_started_at
+                ''', (min_age_seconds,))
+                return [dict(row) for row in cursor.fetchall()]
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في البحث عن التحويلات العالقة: {e}")
+            return []
+
+    def reap_stuck_tasker_transfer(self, transfer_id: str, processing_started_at: datetime,
+                                   reason: str) -> Optional[Dict]:
+        """
+        إعادة تحويل عالق إلى "معلق" وتعليم مهمته كمنتهية وتحرير جهازه في معاملة واحدة.
+        لا يتم شيء إذا تغيرت حالة التحويل أو أعيدت جدولته منذ اكتشافه.
+        :return: بيانات المهمة المنتهية أو None
+        """
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor(cursor_factory=RealDictCursor)
+                cursor.execute('''
+                    UPDATE transfers
+                    SET status = 'pending', updated_at = %s
+                    WHERE transfer_id = %s AND status = 'processing' AND processing_started_at = %s
+                ''', (datetime.now(), transfer_id, processing_started_at))
+                if cursor.rowcount == 0:
+                    conn.rollback()
+                    return None
+
+                cursor.execute('''
+                    SELECT id, device_id, device_released_at, wallet_type, sent_at,
+                           EXTRACT(EPOCH FROM NOW() - sent_at) AS age_seconds
+                    FROM tasker_outbox
+                    WHERE transfer_id = %s AND status = 'sent'
+                    ORDER BY id DESC
+                    LIMIT 1
+                    FOR UPDATE
+                ''', (transfer_id,))
+                job = cursor.fetchone()
+                if job:
+                    cursor.execute('''
+                        UPDATE tasker_outbox
+                        SET status = 'expired', last_error = %s, updated_at = NOW()
+                        WHERE id = %s
+                    ''', (reason, job['id']))
+                    if job['device_id'] and job['device_released_at'] is None:
+                        self._release_job_device(cursor, job['id'], job['device_id'])
+                    if job['sent_at']:
+                        self._record_tasker_latency(
+                            cursor, job['device_id'], job['wallet_type'], 'timeout', float(job['age_seconds'])
+                        )
+
+                conn.commit()
+                logger.warning(f"تمت إعادة التحويل العالق {transfer_id} إلى حالة معلق: {reason}")
+                return dict(job) if job else {}
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في إعادة التحويل العالق {transfer_id}: {e}")
+            return None
+
+    def load_persisted_data(self, kind: str, key: str, newer_than: int = 0) -> Optional[Tuple[int, bytes]]:
+        """
+        تحميل بيانات مستخدم أو محادثة إذا كانت نسختها أحدث من newer_than
+        :return: (النسخة، البيانات) أو None
+        """
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT version, data FROM bot_persistence
+                    WHERE kind = %s AND key = %s AND version > %s
+                ''', (kind, key, newer_than))
+                row = cursor.fetchone()
+                if row:
+                    return row[0], bytes(row[1])
+                return None
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في تحميل حالة البوت ({kind}:{key}): {e}")
+            return None
+
+    def save_persisted_data(self, rows: List[Tuple[str, str, bytes]]) -> Optional[Dict[Tuple[str, str], int]]:
+        """
+        حفظ دفعة من بيانات المستخدمين والمحادثات المتغيرة في استعلام واحد
+        :return: النسخة الجديدة لكل مفتاح، أو None عند الفشل
+        """
+        if not rows:
+            return {}
+
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor()
+                saved = execute_values(cursor, '''
+                    INSERT INTO bot_persistence (kind, key, data)
+                    VALUES %s
+                    ON CONFLICT (kind, key) DO UPDATE SET
+                        data = EXCLUDED.data,
+                        version = bot_persistence.version + 1,
+                        updated_at = NOW()
+                    RETURNING kind, key, version
+                ''', [(kind, key, psycopg2.Binary(data)) for kind, key, data in rows], fetch=True)
+                conn.commit()
+                return {(kind, key): version for kind, key, version in saved}
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في حفظ حالة البوت: {e}")
+            return None
+
+    def delete_persisted_data(self, kind: str, key: str) -> bool:
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor()
+                cursor.execute('DELETE FROM bot_persistence WHERE kind = %s AND key = %s', (kind, key))
+                conn.commit()
+                return True
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في حذف حالة البوت ({kind}:{key}): {e}")
+            return False
+
+    def has_persisted_data(self) -> bool:
+        """هل توجد أي حالة محفوظة للبوت"""
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT EXISTS (SELECT 1 FROM bot_persistence)
+                        OR EXISTS (SELECT 1 FROM bot_conversations)
+                ''')
+                return cursor.fetchone()[0]
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في فحص حالة البوت المحفوظة: {e}")
+            return True
+
+    def get_persisted_conversations(self, name: str) -> List[Tuple[str, object]]:
+        """حالات المحادثة النشطة لمعالج محادثة واحد"""
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT key, state FROM bot_conversations WHERE name = %s', (name,))
+                return cursor.fetchall()
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في تحميل حالات المحادثة {name}: {e}")
+            return []
+
+    def save_persisted_conversations(self, states: List[Tuple[str, str, object]]) -> bool:
+        """حفظ دفعة من حالات المحادثة، والحالة None تعني انتهاء المحادثة فيحذف صفها"""
+        if not states:
+            return True
+
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor()
+                active = [(name, key, Json(state)) for name, key, state in states if state is not None]
+                ended = [(name, key) for name, key, state in states if state is None]
+                if active:
+                    execute_values(cursor, '''
+                        INSERT INTO bot_conversations (name, key, state)
+                        VALUES %s
+                        ON CONFLICT (name, key) DO UPDATE SET
+                            state = EXCLUDED.state,
+                            updated_at = NOW()
+                    ''', active)
+                if ended:
+                    execute_values(cursor, '''
+                        DELETE FROM bot_conversations c
+                        USING (VALUES %s) AS ended(name, key)
+                        WHERE c.name = ended.name AND c.key = ended.key
+                    ''', ended)
+                conn.commit()
+                return True
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في حفظ حالات المحادثة: {e}")
+            return False
+
+    def take_throttle_token(self, key: str, capacity: float, rate: float) -> bool:
+        """
+        سحب رمز من دلو التقييد بشكل ذري.
+        الرفض لا يستهلك رمزاً، وعند تعذر الوصول لقاعدة البيانات يسمح بالطلب.
+        """
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    INSERT INTO throttle_buckets (key, tokens, updated_at)
+                    VALUES (%s, %s - 1, NOW())
+                    ON CONFLICT (key) DO UPDATE SET
+                        tokens = LEAST(%s, throttle_buckets.tokens
+                            + EXTRACT(EPOCH FROM NOW() - throttle_buckets.updated_at) * %s) - 1,
+                        updated_at = NOW()
+                    WHERE LEAST(%s, throttle_buckets.tokens
+                        + EXTRACT(EPOCH FROM NOW() - throttle_buckets.updated_at) * %s) >= 1
+                    RETURNING tokens
+                ''', (key, capacity, capacity, rate, capacity, rate))
+                allowed = cursor.fetchone() is not None
+                conn.commit()
+                return allowed
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في دلو التقييد {key}: {e}")
+            return True
+
+    def prune_throttle_buckets(self, idle_seconds: int = 3600) -> int:
+        """حذف دلاء التقييد الخاملة"""
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    'DELETE FROM throttle_buckets WHERE updated_at < NOW() - make_interval(secs => %s)',
+                    (idle_seconds,)
+                )
+                conn.commit()
+                return cursor.rowcount
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في حذف دلاء التقييد الخاملة: {e}")
+            return 0
+
+    def mark_transfer_notified(self, transfer_id: str, admin_message_id: Optional[int]) -> bool:
+        """تسجيل إرسال إشعار المشرفين بالتحويل"""
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    UPDATE transfers
+                    SET admin_message_id = %s, admin_notified_at = CURRENT_TIMESTAMP
+                    WHERE transfer_id = %s
+                ''', (admin_message_id, transfer_id))
+                conn.commit()
+                return True
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في تسجيل إشعار المشرفين بالتحويل {transfer_id}: {e}")
+            return False
+
+    def get_unnotified_transfers(self, within_seconds: int) -> List[Dict]:
+        """
+        التحويلات الحديثة التي لم يصل إشعارها للمشرفين، مثلاً عند توقف البوت قبل انتهاء خط المعالجة.
+        تشمل حالة processing لأن مرحلة Tasker تسبق إشعار المشرفين في التحويل التلقائي.
+        """
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor(cursor_factory=RealDictCursor)
+                cursor.execute('''
+                    SELECT * FROM transfers
+                    WHERE status IN ('pending', 'processing')
+                      AND admin_notified_at IS NULL
+                      AND created_at >= %s
+                    ORDER BY created_at
+                ''', (datetime.now() - timedelta(seconds=within_seconds),))
+                return [dict(row) for row in cursor.fetchall()]
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في جلب التحويلات غير المشعر بها: {e}")
+            return []
+
+    def choose_volume_resolution(self, start: datetime, end: datetime, max_points: int = None) -> str:
+        """أدق دقة يبقى فيها عدد النقاط ضمن max_points، والدقائق فقط ضمن مدة الاحتفاظ بها"""
+        max_points = max_points or int(os.getenv('TIMESERIES_MAX_POINTS', '500'))
+        span = max((end - start).total_seconds(), 1)
+        minute_floor = datetime.now() - timedelta(days=self.minute_retention_days)
+        for resolution, step in VOLUME_RESOLUTIONS.items():
+            if resolution == 'minute' and start < minute_floor:
+                continue
+            if span / step <= max_points:
+                return resolution
+        return 'day'
+
+    def get_volume_timeseries(self, start: datetime, end: datetime, resolution: Optional[str] = None,
+                              group_by: Optional[List[str]] = None,
+                              filters: Optional[Dict[str, str]] = None) -> Dict:
+        """
+        عدد التحويلات وأحجام USDT والعملة المحلية لكل فترة من الدلاء المجمعة مسبقاً.
+        :param resolution: minute أو hour أو day، أو None للاختيار حسب طول المدة
+        :param group_by: أبعاد التقسيم من VOLUME_DIMENSIONS
+        :param filters: تصفية بقيم الأبعاد، مثل {'status': 'completed'}
+        """
+        resolution = resolution or self.choose_volume_resolution(start, end)
+        group_by = [dimension for dimension in (group_by or []) if dimension in VOLUME_DIMENSIONS]
+        result = {
+            'resolution': resolution,
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'group_by': group_by,
+            'points': []
+        }
+        if resolution not in VOLUME_RESOLUTIONS:
+            logger.error(f"دقة غير معروفة لسلسلة الأحجام: {resolution}")
+            return result
+
+        where = ['resolution = %s', 'bucket_start >= date_trunc(%s, %s::timestamp)', 'bucket_start < %s']
+        params = [resolution, resolution, start, end]
+        for dimension, value in (filters or {}).items():
+            if dimension in VOLUME_DIMENSIONS and value is not None:
+                where.append(f'{dimension} = %s')
+                params.append(value)
+        columns = ', '.join(['bucket_start'] + group_by)
+
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor(cursor_factory=RealDictCursor)
+                cursor.execute(f'''
+                    SELECT {columns},
+                           SUM(transfer_count) AS count,
+                           SUM(usdt_volume) AS usdt_volume,
+                           SUM(local_volume) AS local_volume
+                    FROM transfer_volume_buckets
+                    WHERE {' AND '.join(where)}
+                    GROUP BY {columns}
+                    HAVING SUM(transfer_count) <> 0
+                    ORDER BY {columns}
+                ''', params)
+                for row in cursor.fetchall():
+                    point = dict(row)
+                    point['bucket_start'] = point['bucket_start'].isoformat()
+                    point['count'] = int(point['count'])
+                    result['points'].append(point)
+                return result
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في جلب سلسلة أحجام التحويلات: {e}")
+            return result
+
+    def rollup_volume_deltas(self, batch_size: int = 5000) -> int:
+        """
+        تجميع سجل تغييرات الأحجام في الدلاء على دفعات حتى تفريغه.
+        عملية تجميع واحدة في كل مرة (قفل استشاري)، وصفوف الدلاء تحدث بترتيب مفاتيحها.
+        :return: عدد التغييرات المجمعة
+        """
+        total = 0
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor()
+                while True:
+                    cursor.execute("SELECT pg_advisory_xact_lock(hashtext('withdraw_volume_rollup'))")
+                    cursor.execute('''
+                        WITH moved AS (
+                            DELETE FROM transfer_volume_deltas
+                            WHERE id IN (SELECT id FROM transfer_volume_deltas ORDER BY id LIMIT %s)
+                            RETURNING created_at, usdt_network, local_currency, wallet_name, status,
+                                      delta, usdt_amount, local_amount
+                        ), rolled AS (
+                            INSERT INTO transfer_volume_buckets AS b
+                                (resolution, bucket_start, usdt_network, local_currency, wallet_name, status,
+                                 transfer_count, usdt_volume, local_volume)
+                            SELECT r.res, date_trunc(r.res, m.created_at), m.usdt_network, m.local_currency,
+                                   m.wallet_name, m.status,
+                                   SUM(m.delta), SUM(m.delta * m.usdt_amount), SUM(m.delta * m.local_amount)
+                            FROM moved m
+                            CROSS JOIN (VALUES ('minute'), ('hour'), ('day')) AS r(res)
+                            GROUP BY 1, 2, 3, 4, 5, 6
+                            ORDER BY 1, 2, 3, 4, 5, 6
+                            ON CONFLICT (resolution, bucket_start, usdt_network, local_currency, wallet_name, status)
+                            DO UPDATE SET
+                                transfer_count = b.transfer_count + EXCLUDED.transfer_count,
+                                usdt_volume = b.usdt_volume + EXCLUDED.usdt_volume,
+                                local_volume = b.local_volume + EXCLUDED.local_volume
+                        )
+                        SELECT COUNT(*) FROM moved
+                    ''', (batch_size,))
+                    moved = cursor.fetchone()[0]
+                    conn.commit()
+                    total += moved
+                    if moved < batch_size:
+                        return total
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في تجميع تغييرات أحجام التحويلات: {e}")
+            return total
+
+    def prune_volume_buckets(self, interval: float = 3600) -> int:
+        """حذف دلاء الدقائق الأقدم من مدة الاحتفاظ والدلاء الفارغة، مرة كل interval ثانية على الأكثر"""
+        if time.monotonic() - self._volume_pruned_at < interval:
+            return 0
+        self._volume_pruned_at = time.monotonic()
+        try:
+            with psycopg2.connect(self.db_url) as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    DELETE FROM transfer_volume_buckets
+                    WHERE (resolution = 'minute' AND bucket_start < %s)
+                       OR transfer_count = 0
+                ''', (datetime.now() - timedelta(days=self.minute_retention_days),))
+                return cursor.rowcount
+        except psycopg2.Error as e:
+            logger.error(f"خطأ في حذف دلاء أحجام التحويلات القديمة: {e}")
+            return 0
@@ -0,0 +1,157 @@
+import os
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import telegram
+
+logger = logging.getLogger(__name__)
+
+TEXT_EDIT = 'text'
+MARKUP_EDIT = 'markup'
+
+
+class _PendingEdit:
+    """آخر محتوى مطلوب لرسالة لم يرسل بعد، مع كل من ينتظر نتيجته"""
+
+    __slots__ = ('bot', 'kind', 'text', 'parse_mode', 'reply_markup', 'waiters')
+
+    def __init__(self, bot, kind: str, text: Optional[str], parse_mode: Optional[str], reply_markup):
+        self.bot = bot
+        self.kind = kind
+        self.text = text
+        self.parse_mode = parse_mode
+        self.reply_markup = reply_markup
+        self.waiters: List[asyncio.Future] = []
+
+    def merge(self, other: '_PendingEdit') -> None:
+        """دمج تعديل أحدث: تعديل الأزرار وحده يحتفظ بالنص المعلق"""
+        self.bot = other.bot
+        if other.kind == MARKUP_EDIT and self.kind == TEXT_EDIT:
+            self.reply_markup = other.reply_markup
+        else:
+            self.kind = other.kind
+            self.text = other.text
+            self.parse_mode = other.parse_mode
+            self.reply_markup = other.reply_markup
+        self.waiters.extend(other.waiters)
+
+    def fingerprint(self) -> Tuple:
+        markup = self.reply_markup.to_json() if self.reply_markup is not None else None
+        return (self.kind, self.text, self.parse_mode, markup)
+
+
+class EditCoalescer:
+    """
+    طابور تعديلات الرسائل مفتاحه (chat_id, message_id).
+    أثناء إرسال تعديل أو انتظاره لحدود الإرسال تتجمع التعديلات التالية فيرسل آخرها فقط،
+    ويتم تجاهل التعديل المطابق لآخر محتوى مرسل وخطأ "message is not modified".
+    """
+
+    def __init__(self, group_window: float = None, max_tracked: int = None):
+        # مهلة تجميع قصيرة في المجموعات حيث حد الإرسال 20 رسالة في الدقيقة
+        self.group_window = group_window if group_window is not None else float(os.getenv('EDIT_COALESCE_WINDOW', '0.5'))
+        self.max_tracked = max_tracked or int(os.getenv('EDIT_COALESCE_TRACKED', '5000'))
+        self._pending: Dict[Tuple, _PendingEdit] = {}
+        self._workers: Dict[Tuple, asyncio.Task] = {}
+        self._last_sent: 'OrderedDict[Tuple, Tuple]' = OrderedDict()
+
+    async def edit_text(self, bot, chat_id, message_id, text: str, parse_mode: str = None, reply_markup=None):
+        """تعديل نص الرسالة، يعيد نتيجة آخر تعديل أرسل فعلاً أو None إذا لم يتغير شيء"""
+        return await self._submit(bot, chat_id, message_id, _PendingEdit(bot, TEXT_EDIT, text, parse_mode, reply_markup))
+
+    async def edit_reply_markup(self, bot, chat_id, message_id, reply_markup=None):
+        """تعديل أزرار الرسالة فقط"""
+        return await self._submit(bot, chat_id, message_id, _PendingEdit(bot, MARKUP_EDIT, None, None, reply_markup))
+
+    async def _submit(self, bot, chat_id, message_id, edit: _PendingEdit):
+        key = (str(chat_id), int(message_id))
+        waiter = asyncio.get_running_loop().create_future()
+        edit.waiters.append(waiter)
+
+        pending = self._pending.get(key)
+        if pending is not None:
+            pending.merge(edit)
+        else:
+            self._pending[key] = edit
+
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._run(key, chat_id, message_id))
+        return await waiter
+
+    def _window_for(self, chat_id) -> float:
+        try:
+            return self.group_window if int(chat_id) < 0 else 0.0
+        except (TypeError, ValueError):
+            return self.group_window
+
+    async def _run(self, key: Tuple, chat_id, message_id) -> None:
+        try:
+            window = self._window_for(chat_id)
+            while key in self._pending:
+                if window:
+                    await asyncio.sleep(window)
+                edit = self._pending.pop(key)
+                try:
+                    result = await self._send(key, chat_id, message_id, edit)
+                except Exception as e:
+                    for waiter in edit.waiters:
+                        if not waiter.done():
+                            waiter.set_exception(e)
+                else:
+                    for waiter in edit.waiters:
+                        if not waiter.done():
+                            waiter.set_result(result)
+        finally:
+            self._workers.pop(key, None)
+
+    async def _send(self, key: Tuple, chat_id, message_id, edit: _PendingEdit):
+        fingerprint = edit.fingerprint()
+        if self._last_sent.get(key) == fingerprint:
+            return None
+
+        try:
+            if edit.kind == TEXT_EDIT:
+                result = await edit.bot.edit_message_text(
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    text=edit.text,
+                    parse_mode=edit.parse_mode,
+                    reply_markup=edit.reply_markup,
+                    read_timeout=30,
+                    write_timeout=30,
+                    connect_timeout=30,
+                    pool_timeout=30
+                )
+            else:
+                result = await edit.bot.edit_message_reply_markup(
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    reply_markup=edit.reply_markup,
+                    read_timeout=30,
+                    write_timeout=30,
+                    connect_timeout=30,
+                    pool_timeout=30
+                )
+        except telegram.error.BadRequest as e:
+            if 'message is not modified' not in str(e).lower():
+                self._last_sent.pop(key, None)
+                raise
+            result = None
+        except Exception:
+            self._last_sent.pop(key, None)
+            raise
+
+        self._remember(key, fingerprint)
+        return result
+
+    def _remember(self, key: Tuple, fingerprint: Tuple) -> None:
+        self._last_sent[key] = fingerprint
+        self._last_sent.move_to_end(key)
+        while len(self._last_sent) > self.max_tracked:
+            self._last_sent.popitem(last=False)
+
+
+# طابور مشترك لكل معالجات البوت
+edit_coalescer = EditCoalescer()
@@ -1,11 +1,16 @@
 import telegram
 import logging
 import asyncio
+from utils.edit_coalescer import edit_coalescer
 
 logger = logging.getLogger(__name__)
 
-async def send_message_with_retry(context, chat_id, text, reply_markup=None, max_retries=3, parse_mode=None):
-    """إرسال رسالة مع إعادة المحاولة في حالة فشل الاتصال"""
+async def send_message_with_retry(context, chat_id, text, reply_markup=None, max_retries=3, parse_mode=None, priority=None):
+    """
+    إرسال رسالة مع إعادة المحاولة في حالة فشل الاتصال.
+    الإرسال يمر عبر مجدول البوت (SendScheduler) الذي يطبق حدود تيليجرام ويعالج RetryAfter،
+    ويمكن تحديد الأولوية عبر priority (PRIORITY_USER أو PRIORITY_ADMIN).
+    """
     for attempt in range(max_retries):
         try:
             return await context.bot.send_message(
@@ -16,7 +21,8 @@ async def send_message_with_retry(context, chat_id, text, reply_markup=None, max
                 read_timeout=30,
                 write_timeout=30,
                 connect_timeout=30,
-                pool_timeout=30
+                pool_timeout=30,
+                rate_limit_args=priority
             )
         except telegram.error.TimedOut as e:
             if attempt == max_retries - 1:  # آخر محاولة
@@ -27,8 +33,8 @@ async def send_message_with_retry(context, chat_id, text, reply_markup=None, max
             logger.error(f"خطأ في إرسال الرسالة: {e}")
             raise
 
-async def send_photo_with_retry(context, chat_id, photo, caption=None, reply_markup=None, max_retries=3, parse_mode=None):
-    """إرسال صورة مع إعادة المحاولة في حالة فشل الاتصال"""
+async def send_photo_with_retry(context, chat_id, photo, caption=None, reply_markup=None, max_retries=3, parse_mode=None, priority=None):
+    """إرسال صورة مع إعادة المحاولة في حالة فشل الاتصال، عبر مجدول البوت مثل send_message_with_retry"""
     for attempt in range(max_retries):
         try:
             return await context.bot.send_photo(
@@ -40,7 +46,8 @@ async def send_photo_with_retry(context, chat_id, photo, caption=None, reply_mar
                 read_timeout=30,
                 write_timeout=30,
                 connect_timeout=30,
-                pool_timeout=30
+                pool_timeout=30,
+                rate_limit_args=priority
             )
         except telegram.error.TimedOut as e:
             if attempt == max_retries - 1:  # آخر محاولة
@@ -51,47 +58,58 @@ async def send_photo_with_retry(context, chat_id, photo, caption=None, reply_mar
             logger.error(f"خطأ في إرسال الصورة: {e}")
             raise
 
-async def edit_message_with_retry(context, chat_id, message_id, text, reply_markup=None, max_retries=3, parse_mode=None):
-    """تعديل رسالة مع إعادة المحاولة في حالة فشل الاتصال"""
+async def edit_message_with_retry(context, chat_id, message_id, text, reply_markup=None, max_retries=3, parse_mode=None,
+                                  fallback_send=False):
+    """
+    تعديل رسالة مع إعادة المحاولة في حالة فشل الاتصال.
+    التعديلات المتتالية لنفس الرسالة تمر عبر edit_coalescer فيرسل آخرها فقط.
+    :param fallback_send: عند تعذر التعديل ترسل رسالة جديدة بدلاً من رفع الخطأ
+    """
     for attempt in range(max_retries):
         try:
-            return await context.bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=message_id,
-                text=text,
-                reply_markup=reply_markup,
+            return await edit_coalescer.edit_text(
+                context.bot, chat_id, message_id, text,
                 parse_mode=parse_mode,
-                read_timeout=30,
-                write_timeout=30,
-                connect_timeout=30,
-                pool_timeout=30
+                reply_markup=reply_markup
             )
         except telegram.error.TimedOut as e:
             if attempt == max_retries - 1:  # آخر محاولة
                 logger.error(f"فشل في تعديل الرسالة بعد {max_retries} محاولات: {e}")
+                if fallback_send:
+                    return None
                 raise
             await asyncio.sleep(2 ** attempt)  # انتظار متزايد بين المحاولات
         except telegram.error.BadRequest as e:
             # في حالة وجود مشكلة في تعديل الرسالة (مثلاً الرسالة قديمة جداً)
             logger.error(f"خطأ في تعديل الرسالة: {e}")
-            raise
+            if not fallback_send:
+                raise
+            return await _replace_message(context, chat_id, message_id, text, reply_markup, parse_mode, e)
         except Exception as e:
             logger.error(f"خطأ غير متوقع في تعديل الرسالة: {e}")
+            if fallback_send:
+                return None
             raise
 
+async def _replace_message(context, chat_id, message_id, text, reply_markup, parse_mode, error):
+    """إرسال المحتوى في رسالة جديدة عندما يتعذر تعديل الرسالة الأصلية"""
+    # رسالة بدون نص (صورة مثلاً) تبقى كما هي، وغير ذلك يتم حذفها لتجنب التكرار
+    if "There is no text in the message to edit" not in str(error):
+        try:
+            await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
+        except Exception:
+            pass
+    try:
+        return await send_message_with_retry(context, chat_id, text, reply_markup=reply_markup, parse_mode=parse_mode)
+    except Exception as send_err:
+        logger.error(f"خطأ في إرسال الرسالة البديلة: {send_err}")
+        return None
+
 async def edit_message_reply_markup_with_retry(context, chat_id, message_id, reply_markup=None, max_retries=3):
-    """تعديل أزرار الرسالة مع إعادة المحاولة في حالة فشل الاتصال"""
+    """تعديل أزرار الرسالة مع إعادة المحاولة في حالة فشل الاتصال، عبر edit_coalescer"""
     for attempt in range(max_retries):
         try:
-            return await context.bot.edit_message_reply_markup(
-                chat_id=chat_id,
-                message_id=message_id,
-                reply_markup=reply_markup,
-                read_timeout=30,
-                write_timeout=30,
-                connect_timeout=30,
-                pool_timeout=30
-            )
+            return await edit_coalescer.edit_reply_markup(context.bot, chat_id, message_id, reply_markup=reply_markup)
         except telegram.error.TimedOut as e:
             if attempt == max_retries - 1:  # آخر محاولة
                 logger.error(f"فشل في تعديل أزرار الرسالة بعد {max_retries} محاولات: {e}")
@@ -0,0 +1,219 @@
+import os
+import json
+import pickle
+import asyncio
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+USER_DATA = 'user'
+CHAT_DATA = 'chat'
+
+
+class PostgresPersistence(BasePersistence):
+    """
+    حفظ حالة البوت في PostgreSQL بصف لكل مستخدم أو محادثة.
+    يتم تحميل بيانات المستخدم عند أول تحديث منه فقط (أو عندما تغيرها عملية أخرى)،
+    وتكتب المفاتيح المتغيرة وحدها في دفعة واحدة، فتكلفة الحفظ تتبع النشاط لا عدد المستخدمين.
+
+    bot_data لا يحفظ لأنه يحمل كائنات التشغيل (مثل اتصال قاعدة البيانات) ويعاد إنشاؤه عند البدء.
+    حالات المحادثات تحمل عند البدء كما يتطلب ConversationHandler.
+    """
+
+    def __init__(self, db, update_interval: float = None, flush_delay: float = None):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=True, callback_data=False),
+            update_interval=update_interval or float(os.getenv('PERSISTENCE_UPDATE_INTERVAL', '5'))
+        )
+        self.db = db
+        # مهلة قصيرة لتجميع كل ما يرسله التطبيق في دورة الحفظ في كتابة واحدة
+        self.flush_delay = flush_delay if flush_delay is not None else float(os.getenv('PERSISTENCE_FLUSH_DELAY', '0.5'))
+
+        self._versions: Dict[Tuple[str, str], int] = {}
+        self._written: Dict[Tuple[str, str], int] = {}
+        self._dirty: Dict[Tuple[str, str], bytes] = {}
+        self._dirty_conversations: Dict[Tuple[str, str], Any] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._write_lock = asyncio.Lock()
+
+    # ----- التحميل -----
+
+    async def get_user_data(self) -> Dict[int, Dict[Any, Any]]:
+        # التحميل كسول عبر refresh_user_data
+        return {}
+
+    async def get_chat_data(self) -> Dict[int, Dict[Any, Any]]:
+        return {}
+
+    async def get_bot_data(self) -> Dict[Any, Any]:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> Dict[Tuple, Any]:
+        rows = await asyncio.to_thread(self.db.get_persisted_conversations, name)
+        return {tuple(json.loads(key)): state for key, state in rows}
+
+    async def _refresh(self, kind: str, key: str, data: Dict[Any, Any]) -> None:
+        cache_key = (kind, key)
+        if cache_key in self._dirty:
+            # تغييرات محلية لم تكتب بعد أحدث مما في قاعدة البيانات
+            return
+        row = await asyncio.to_thread(self.db.load_persisted_data, kind, key, self._versions.get(cache_key, 0))
+        if row is None:
+            return
+
+        version, payload = row
+        if cache_key in self._versions:
+            logger.info(f"تم تحديث حالة {kind}:{key} من عملية أخرى (النسخة {version})")
+        loaded = pickle.loads(payload)
+        if hasattr(data, 'load'):
+            # UserState يتجاهل الحقول القديمة غير المعروفة
+            data.load(loaded)
+        else:
+            data.clear()
+            data.update(loaded)
+        self._versions[cache_key] = version
+        self._written[cache_key] = hash(payload)
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[Any, Any]) -> None:
+        await self._refresh(USER_DATA, str(user_id), user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict[Any, Any]) -> None:
+        await self._refresh(CHAT_DATA, str(chat_id), chat_data)
+
+    async def refresh_bot_data(self, bot_data: Dict[Any, Any]) -> None:
+        pass
+
+    # ----- الحفظ -----
+
+    def _mark_dirty(self, kind: str, key: str, data: Dict[Any, Any]) -> None:
+        cache_key = (kind, key)
+        # لقطة فورية لأن المعالجات تستمر في تعديل القاموس نفسه
+        payload = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+        if self._written.get(cache_key) == hash(payload):
+            self._dirty.pop(cache_key, None)
+            return
+        self._dirty[cache_key] = payload
+        self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later(), name='persistence-flush')
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.flush_delay)
+        await self._write_dirty()
+
+    async def _write_dirty(self) -> None:
+        async with self._write_lock:
+            rows, self._dirty = self._dirty, {}
+            conversations, self._dirty_conversations = self._dirty_conversations, {}
+
+            if rows:
+                versions = await asyncio.to_thread(
+                    self.db.save_persisted_data, [(kind, key, data) for (kind, key), data in rows.items()]
+                )
+                if versions is None:
+                    # إعادة المفاتيح للمحاولة في الدورة التالية ما لم تتغير بعدها
+                    for cache_key, data in rows.items():
+                        self._dirty.setdefault(cache_key, data)
+                else:
+                    for cache_key, version in versions.items():
+                        expected = self._versions.get(cache_key, 0) + 1
+                        if version != expected and cache_key in self._versions:
+                            logger.warning(
+                                f"تعارض في حالة {cache_key[0]}:{cache_key[1]}، "
+                                f"كتبت عملية أخرى قبلنا (النسخة {version} بدلاً من {expected})"
+                            )
+                        self._versions[cache_key] = version
+                        self._written[cache_key] = hash(rows[cache_key])
+
+            if conversations:
+                saved = await asyncio.to_thread(
+                    self.db.save_persisted_conversations,
+                    [(name, key, state) for (name, key), state in conversations.items()]
+                )
+                if not saved:
+                    for cache_key, state in conversations.items():
+                        self._dirty_conversations.setdefault(cache_key, state)
+
+    async def update_user_data(self, user_id: int, data: Dict[Any, Any]) -> None:
+        self._mark_dirty(USER_DATA, str(user_id), data)
+
+    async def update_chat_data(self, chat_id: int, data: Dict[Any, Any]) -> None:
+        self._mark_dirty(CHAT_DATA, str(chat_id), data)
+
+    async def update_bot_data(self, data: Dict[Any, Any]) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def update_conversation(self, name: str, key: Tuple, new_state: Optional[object]) -> None:
+        self._dirty_conversations[(name, json.dumps(list(key)))] = new_state
+        self._schedule_flush()
+
+    async def _drop(self, kind: str, key: str) -> None:
+        cache_key = (kind, key)
+        self._dirty.pop(cache_key, None)
+        self._versions.pop(cache_key, None)
+        self._written.pop(cache_key, None)
+        await asyncio.to_thread(self.db.delete_persisted_data, kind, key)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self._drop(USER_DATA, str(user_id))
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        await self._drop(CHAT_DATA, str(chat_id))
+
+    async def flush(self) -> None:
+        """كتابة كل ما تبقى عند إيقاف التطبيق"""
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await self._write_dirty()
+        if self._dirty or self._dirty_conversations:
+            logger.error("تعذر حفظ جزء من حالة البوت عند الإيقاف")
+
+    # ----- الترحيل -----
+
+    def migrate_from_pickle(self, filepath: str) -> bool:
+        """
+        نقل ملف PicklePersistence القديم إلى قاعدة البيانات مرة واحدة،
+        فقط إذا لم تكن هناك حالة محفوظة مسبقاً، ثم إعادة تسمية الملف.
+        """
+        if not os.path.exists(filepath) or self.db.has_persisted_data():
+            return False
+
+        try:
+            with open(filepath, 'rb') as f:
+                data = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e:
+            logger.error(f"تعذر قراءة ملف الحالة القديم {filepath}: {e}")
+            return False
+
+        rows = [
+            (USER_DATA, str(user_id), pickle.dumps(user_data, protocol=pickle.HIGHEST_PROTOCOL))
+            for user_id, user_data in (data.get('user_data') or {}).items() if user_data
+        ]
+        rows += [
+            (CHAT_DATA, str(chat_id), pickle.dumps(chat_data, protocol=pickle.HIGHEST_PROTOCOL))
+            for chat_id, chat_data in (data.get('chat_data') or {}).items() if chat_data
+        ]
+        states = [
+            (name, json.dumps(list(key)), state)
+            for name, conversations in (data.get('conversations') or {}).items()
+            for key, state in conversations.items() if state is not None
+        ]
+
+        if self.db.save_persisted_data(rows) is None or not self.db.save_persisted_conversations(states):
+            return False
+
+        os.replace(filepath, f"{filepath}.migrated")
+        logger.info(f"تم نقل حالة {len(rows)} مستخدم/محادثة و {len(states)} محادثة نشطة من {filepath}")
+        return True
@@ -0,0 +1,180 @@
+import os
+import time
+import heapq
+import asyncio
+import itertools
+import logging
+from datetime import timedelta
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# الأولوية الأقل رقماً تخرج أولاً
+PRIORITY_USER = 0
+PRIORITY_ADMIN = 1
+
+# طلبات لا ترسل رسائل إلى محادثة فلا تخضع للحدود
+UNLIMITED_ENDPOINTS = frozenset({'getUpdates', 'getMe', 'getFile', 'setWebhook', 'deleteWebhook', 'answerCallbackQuery'})
+
+
+class TokenBucket:
+    """
+    دلو رموز بالحجز: كل طلب يحجز رمزاً فوراً ويعرف كم ينتظر،
+    فتخرج الرسائل بنفس ترتيب وصولها دون قفل.
+    """
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated_at')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def reserve(self) -> float:
+        """حجز رمز وإرجاع مدة الانتظار بالثواني"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def idle(self) -> bool:
+        """الدلو ممتلئ ولا يحمل أي حجز معلق"""
+        now = time.monotonic()
+        return self.tokens + (now - self.updated_at) * self.rate >= self.capacity
+
+
+class SendScheduler(BaseRateLimiter[int]):
+    """
+    مجدول مركزي لكل طلبات البوت الصادرة إلى تيليجرام.
+    يطبق حداً عاماً وحداً لكل محادثة (أبطأ في المجموعات)، ويخرج رسائل المستخدمين
+    قبل رسائل مجموعة المشرفين، ويحترم RetryAfter بإيقاف الإرسال مؤقتاً ثم الإعادة.
+
+    يمكن تحديد الأولوية لكل طلب عبر rate_limit_args=PRIORITY_USER أو PRIORITY_ADMIN.
+    """
+
+    def __init__(self, admin_chat_ids: List[int] = None, max_retries: int = None):
+        self.global_rate = float(os.getenv('TELEGRAM_GLOBAL_RATE', '30'))
+        self.chat_rate = float(os.getenv('TELEGRAM_CHAT_RATE', '1'))
+        self.group_rate = float(os.getenv('TELEGRAM_GROUP_RATE_PER_MIN', '20')) / 60
+        self.group_burst = float(os.getenv('TELEGRAM_GROUP_BURST', '3'))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv('TELEGRAM_MAX_RETRIES', '3'))
+        if admin_chat_ids is None:
+            admin_chat_ids = [os.getenv('ADMIN_GROUP_ID', '0')]
+        # ADMIN_GROUP_ID نص في الإعدادات، ومعرفات المحادثات في الطلبات أرقام
+        self.admin_chat_ids = {int(chat_id) for chat_id in admin_chat_ids if str(chat_id).lstrip('-').isdigit()}
+
+        self._global = TokenBucket(self.global_rate, self.global_rate)
+        self._chats: Dict[Union[int, str], TokenBucket] = {}
+        self._max_chats = int(os.getenv('TELEGRAM_CHAT_BUCKETS', '10000'))
+        self._paused_until = 0.0
+
+        self._heap: List[tuple] = []
+        self._counter = itertools.count()
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+        for _, _, waiter in self._heap:
+            if not waiter.done():
+                waiter.cancel()
+        self._heap.clear()
+
+    def _priority_for(self, chat_id, rate_limit_args: Optional[int]) -> int:
+        if rate_limit_args is not None:
+            return rate_limit_args
+        if chat_id in self.admin_chat_ids:
+            return PRIORITY_ADMIN
+        return PRIORITY_USER
+
+    @staticmethod
+    def _is_group(chat_id) -> bool:
+        # معرفات المجموعات والقنوات سالبة، وأسماء المستخدمين (@channel) للقنوات
+        return isinstance(chat_id, str) or chat_id < 0
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self._max_chats:
+                # حذف دلاء المحادثات الخاملة حتى لا تنمو الذاكرة مع عدد المستخدمين
+                self._chats = {key: value for key, value in self._chats.items() if not value.idle()}
+            if self._is_group(chat_id):
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.chat_rate, 1)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _global_turn(self, priority: int) -> None:
+        """انتظار دور الطلب في الحد العام حسب الأولوية"""
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, next(self._counter), waiter))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch(), name='telegram-send-scheduler')
+        await waiter
+
+    async def _dispatch(self) -> None:
+        while self._heap:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            delay = self._global.reserve()
+            if delay:
+                await asyncio.sleep(delay)
+            # الاختيار بعد الانتظار ليتقدم أي طلب أعلى أولوية وصل خلاله
+            while self._heap:
+                _, _, waiter = heapq.heappop(self._heap)
+                if not waiter.done():
+                    waiter.set_result(None)
+                    break
+
+    def _pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict[str, Any], List[Dict[str, Any]]]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[int],
+    ) -> Union[bool, Dict[str, Any], List[Dict[str, Any]]]:
+        chat_id = data.get('chat_id')
+        if chat_id is None or endpoint in UNLIMITED_ENDPOINTS:
+            return await callback(*args, **kwargs)
+
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+        priority = self._priority_for(chat_id, rate_limit_args)
+
+        for attempt in range(self.max_retries + 1):
+            delay = self._chat_bucket(chat_id).reserve()
+            if delay:
+                await asyncio.sleep(delay)
+            await self._global_turn(priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                if attempt == self.max_retries:
+                    logger.error(f"تجاوز حد الإرسال إلى {chat_id} ({endpoint}) بعد {self.max_retries} محاولات")
+                    raise
+                # حظر الإرسال يطبق على البوت كله، فيتوقف المجدول بالكامل
+                logger.warning(f"طلب تيليجرام التوقف {retry_after} ثانية عند الإرسال إلى {chat_id} ({endpoint})")
+                self._pause(float(retry_after) + 0.1)
@@ -1,9 +1,12 @@
 import os
 import json
 import logging
-import requests
-from typing import Dict, Optional, Any
+import asyncio
+import uuid
+import aiohttp
+from typing import Dict, Optional, Any, Tuple, List
 from datetime import datetime
+from utils.transfer_log import get_transfer_log
 
 logger = logging.getLogger(__name__)
 
@@ -19,91 +22,174 @@ class TaskerAutomation:
         :param tasker_endpoint: عنوان URL لواجهة برمجة تطبيقات Tasker
         """
         self.tasker_endpoint = tasker_endpoint or os.getenv("TASKER_ENDPOINT", "http://localhost:8080/tasker")
-        self.timeout = 30  # مهلة الاتصال بالثواني
+        # مهلة قصيرة للاتصال حتى لا يتعطل البوت عند عدم توفر الهاتف
+        self.connect_timeout = float(os.getenv("TASKER_CONNECT_TIMEOUT", "3"))
+        self.timeout = float(os.getenv("TASKER_TIMEOUT", "10"))  # المهلة الإجمالية بالثواني
+        
+        # جلسة HTTP مشتركة لإعادة استخدام الاتصالات
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._session_loop: Optional[asyncio.AbstractEventLoop] = None
+        
+        # وضع الدفعات: تجميع التحويلات لكل نوع محفظة وإرسالها كمهمة واحدة
+        self.batch_max = max(1, int(os.getenv("TASKER_BATCH_MAX", "1")))
+        self.batch_window = float(os.getenv("TASKER_BATCH_WINDOW", "3"))  # بالثواني
+        self._batches: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    
+    @property
+    def batching_enabled(self) -> bool:
+        return self.batch_max > 1
+    
+    def _prepare_transfer(self, transfer_data: Dict[str, Any]) -> Tuple[Dict[str, Any], str, Dict[str, Any]]:
+        """
+        تحضير بيانات الطلب ورابط Tasker وبيانات السجل المحلي
+        
+        :param transfer_data: بيانات التحويل
+        :return: (بيانات الطلب، رابط Tasker، بيانات السجل)
+        """
+        transfer_id = transfer_data.get("transfer_id", "")
+        wallet_name = transfer_data.get("wallet_name", "")
+        wallet_type = self._get_wallet_type(wallet_name)
+        recipient_number = transfer_data.get("recipient_number", "")
+        amount = transfer_data.get("amount", "")
+        currency = transfer_data.get("local_currency", "")
+        
+        # إنشاء رابط Tasker مع البيانات كمعلمات
+        tasker_link = (
+            f"tasker://transfer"
+            f"?id={transfer_id}"
+            f"&wallet={wallet_type}"
+            f"&number={recipient_number}"
+            f"&amount={amount}"
+            f"&currency={currency}"
+            f"&timestamp={datetime.now().isoformat()}"
+        )
+        
+        payload = {
+            "action": "transfer",
+            "transfer_id": transfer_id,
+            "wallet_type": wallet_type,
+            "recipient_number": recipient_number,
+            "amount": amount,
+            "currency": currency
+        }
+        
+        log_payload = {
+            "action": "transfer",
+            "wallet_name": wallet_name,
+            "wallet_type": wallet_type,
+            "recipient_number": recipient_number,
+            "amount": amount,
+            "currency": currency,
+            "transfer_id": transfer_id,
+            "timestamp": datetime.now().isoformat(),
+            "tasker_link": tasker_link
+        }
+        
+        return payload, tasker_link, log_payload
+    
+    @staticmethod
+    def outbox_payload(transfer_data: Dict[str, Any]) -> Dict[str, Any]:
+        """استخراج الحقول اللازمة لـ Tasker بصيغة قابلة للتخزين كـ JSON"""
+        fields = ("transfer_id", "wallet_name", "recipient_number", "amount", "local_currency")
+        payload = {key: transfer_data[key] for key in fields if transfer_data.get(key) is not None}
+        return json.loads(json.dumps(payload, default=str))
+    
+    def wallet_type_for(self, transfer_data: Dict[str, Any]) -> str:
+        """نوع المحفظة المستخدم لاختيار جهاز Tasker"""
+        return self._get_wallet_type(transfer_data.get("wallet_name", ""))
+    
+    def build_tasker_link(self, transfer_data: Dict[str, Any]) -> str:
+        """إنشاء رابط Tasker للتحويل دون إرساله"""
+        return self._prepare_transfer(transfer_data)[1]
+    
+    def _result_for_status(self, transfer_id: str, status: int, body: str, tasker_link: str) -> Dict[str, Any]:
+        """تحويل استجابة Tasker إلى نتيجة موحدة"""
+        if 200 <= status < 300:
+            logger.info(f"تم إرسال طلب التحويل بنجاح إلى Tasker: {transfer_id}")
+            return {
+                "success": True,
+                "message": "تم إرسال طلب التحويل بنجاح إلى Tasker",
+                "tasker_link": tasker_link
+            }
+        logger.warning(f"فشل في إرسال طلب التحويل إلى Tasker: {status} - {body}")
+        return {
+            "success": False,
+            "error": f"رفض Tasker الطلب ({status})",
+            # أخطاء الخادم والضغط قابلة لإعادة المحاولة، أما أخطاء الطلب فلا
+            "retryable": status >= 500 or status in (408, 429),
+            "tasker_link": tasker_link
+        }
+    
+    def _result_for_error(self, error: Exception, tasker_link: str) -> Dict[str, Any]:
+        """نتيجة موحدة عند تعذر الاتصال بـ Tasker"""
+        logger.error(f"خطأ في الاتصال بـ Tasker: {error}")
+        return {
+            "success": False,
+            "error": f"تعذر الاتصال بـ Tasker: {error}",
+            "retryable": True,
+            "tasker_link": tasker_link
+        }
+    
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """إرجاع الجلسة المشتركة الخاصة بحلقة الأحداث الحالية"""
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session_loop is not loop:
+            # إغلاق جلسة الحلقة السابقة حتى لا يتسرب مجمع اتصالاتها
+            await self._close_stale_session()
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.timeout, connect=self.connect_timeout),
+                connector=aiohttp.TCPConnector(limit=10, keepalive_timeout=60)
+            )
+            self._session_loop = loop
+        return self._session
     
-    def send_transfer_to_tasker(self, transfer_data: Dict[str, Any]) -> Dict[str, Any]:
+    async def _close_stale_session(self) -> None:
+        """إغلاق الجلسة السابقة سواء كانت حلقتها مغلقة أو ما زالت تعمل"""
+        session, session_loop = self._session, self._session_loop
+        self._session = None
+        self._session_loop = None
+        if session is None or session.closed:
+            return
+        try:
+            if session_loop is not None and session_loop.is_running():
+                # الحلقة السابقة تعمل في خيط آخر: الإغلاق يتم داخلها
+                asyncio.run_coroutine_threadsafe(session.close(), session_loop)
+            else:
+                await session.close()
+        except Exception as e:
+            logger.warning(f"تعذر إغلاق جلسة Tasker السابقة: {e}")
+    
+    async def send_transfer_to_tasker_async(self, transfer_data: Dict[str, Any],
+                                            idempotency_key: str = None,
+                                            endpoint: str = None) -> Dict[str, Any]:
         """
-        إرسال بيانات التحويل إلى Tasker لتنفيذ العملية تلقائياً
+        إرسال بيانات التحويل إلى Tasker دون حجب حلقة الأحداث
         
         :param transfer_data: بيانات التحويل (المحفظة، الرقم، المبلغ، العملة، إلخ)
+        :param idempotency_key: مفتاح ثابت لكل مهمة يسمح لـ Tasker بتجاهل الطلبات المكررة عند إعادة المحاولة
+        :param endpoint: عنوان الجهاز المختار، وإلا يستخدم TASKER_ENDPOINT
         :return: نتيجة العملية
         """
         try:
-            # تحضير البيانات للإرسال إلى Tasker
-            transfer_id = transfer_data.get("transfer_id", "")
-            wallet_name = transfer_data.get("wallet_name", "")
-            wallet_type = self._get_wallet_type(wallet_name)
-            recipient_number = transfer_data.get("recipient_number", "")
-            amount = transfer_data.get("amount", "")
-            currency = transfer_data.get("local_currency", "")
+            payload, tasker_link, log_payload = self._prepare_transfer(transfer_data)
+            transfer_id = payload["transfer_id"]
+            headers = {}
+            if idempotency_key:
+                payload["idempotency_key"] = idempotency_key
+                headers["Idempotency-Key"] = idempotency_key
             
             logger.info(f"إرسال طلب تحويل إلى Tasker: {transfer_id}")
             
-            # إنشاء رابط Tasker مع البيانات كمعلمات
-            tasker_link = (
-                f"tasker://transfer"
-                f"?id={transfer_id}"
-                f"&wallet={wallet_type}"
-                f"&number={recipient_number}"
-                f"&amount={amount}"
-                f"&currency={currency}"
-                f"&timestamp={datetime.now().isoformat()}"
-            )
-            
-            # تسجيل الرابط في السجلات
-            logger.info(f"تم إنشاء رابط Tasker: {tasker_link}")
-            
-            # تسجيل البيانات محلياً للاختبار
-            self._log_transfer_locally({
-                "action": "transfer",
-                "wallet_name": wallet_name,
-                "wallet_type": wallet_type,
-                "recipient_number": recipient_number,
-                "amount": amount,
-                "currency": currency,
-                "transfer_id": transfer_id,
-                "timestamp": datetime.now().isoformat(),
-                "tasker_link": tasker_link
-            })
+            # الكتابة إلى القرص تتم في خيط سجل التحويلات
+            self._log_transfer_locally(log_payload)
             
-            # محاولة إرسال البيانات إلى خادم Tasker المحلي
             try:
-                response = requests.post(
-                    self.tasker_endpoint,
-                    json={
-                        "action": "transfer",
-                        "transfer_id": transfer_id,
-                        "wallet_type": wallet_type,
-                        "recipient_number": recipient_number,
-                        "amount": amount,
-                        "currency": currency
-                    },
-                    timeout=self.timeout
-                )
-                
-                if response.status_code == 200:
-                    logger.info(f"تم إرسال طلب التحويل بنجاح إلى Tasker: {transfer_id}")
-                    return {
-                        "success": True,
-                        "message": "تم إرسال طلب التحويل بنجاح إلى Tasker",
-                        "tasker_link": tasker_link
-                    }
-                else:
-                    logger.warning(f"فشل في إرسال طلب التحويل إلى Tasker: {response.status_code} - {response.text}")
-                    # في حالة فشل الاتصال، نعتبر العملية ناجحة ونرجع رابط Tasker
-                    return {
-                        "success": True,
-                        "message": "تم إنشاء رابط Tasker بنجاح (وضع الاختبار)",
-                        "tasker_link": tasker_link
-                    }
-            except requests.RequestException as e:
-                logger.error(f"خطأ في الاتصال بـ Tasker: {e}")
-                # في حالة فشل الاتصال، نعتبر العملية ناجحة ونرجع رابط Tasker
-                return {
-                    "success": True,
-                    "message": "تم إنشاء رابط Tasker بنجاح (وضع الاختبار)",
-                    "tasker_link": tasker_link
-                }
+                session = await self._get_session()
+                async with session.post(endpoint or self.tasker_endpoint, json=payload, headers=headers) as response:
+                    body = await response.text()
+                    return self._result_for_status(transfer_id, response.status, body, tasker_link)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                return self._result_for_error(e, tasker_link)
                 
         except Exception as e:
             logger.error(f"خطأ غير متوقع في إرسال التحويل: {e}", exc_info=True)
@@ -112,39 +198,128 @@ class TaskerAutomation:
                 "error": str(e)
             }
     
-    def _log_transfer_locally(self, payload: Dict[str, Any]) -> None:
+    async def send_batch_to_tasker_async(self, items: List[Tuple[Dict[str, Any], Optional[str]]],
+                                         endpoint: str = None) -> Dict[str, Any]:
         """
-        تسجيل بيانات التحويل محلياً للاختبار
+        إرسال عدة تحويلات لنفس نوع المحفظة إلى Tasker كمهمة واحدة.
+        نتائج كل تحويل تصل لاحقاً في استدعاء عكسي واحد يحمل قائمة results.
         
-        :param payload: بيانات التحويل
+        :param items: قائمة (بيانات التحويل، مفتاح منع التكرار)
+        :param endpoint: عنوان الجهاز المختار، وإلا يستخدم TASKER_ENDPOINT
+        :return: نتيجة الإرسال للدفعة كاملة
         """
+        batch_id = uuid.uuid4().hex
         try:
-            # تسجيل في سجل النظام أولاً
-            logger.info(f"محاولة تسجيل بيانات التحويل محلياً: {payload.get('transfer_id')}")
+            prepared = []
+            log_payloads = []
+            for transfer_data, idempotency_key in items:
+                payload, _, log_payload = self._prepare_transfer(transfer_data)
+                if idempotency_key:
+                    payload["idempotency_key"] = idempotency_key
+                log_payload["batch_id"] = batch_id
+                prepared.append(payload)
+                log_payloads.append(log_payload)
             
-            # إنشاء مسار مجلد السجلات
-            log_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "logs")
-            os.makedirs(log_dir, exist_ok=True)
-            logger.info(f"مسار مجلد السجلات: {log_dir}")
+            wallet_type = prepared[0]["wallet_type"]
+            transfer_ids = [payload["transfer_id"] for payload in prepared]
+            logger.info(f"إرسال دفعة {batch_id} إلى Tasker ({wallet_type}): {', '.join(map(str, transfer_ids))}")
             
-            # تسجيل في ملف
-            log_file = os.path.join(log_dir, "tasker_transfers.log")
-            logger.info(f"مسار ملف السجل: {log_file}")
+            for log_payload in log_payloads:
+                self._log_transfer_locally(log_payload)
             
-            with open(log_file, "a", encoding="utf-8") as f:
-                f.write(f"[{datetime.now().isoformat()}] طلب تحويل جديد:\n")
-                f.write(json.dumps(payload, ensure_ascii=False, indent=2))
-                f.write("\n\n")
-                
-            logger.info(f"تم تسجيل طلب التحويل محلياً بنجاح: {payload.get('transfer_id')}")
+            try:
+                session = await self._get_session()
+                async with session.post(
+                    endpoint or self.tasker_endpoint,
+                    json={
+                        "action": "batch_transfer",
+                        "batch_id": batch_id,
+                        "wallet_type": wallet_type,
+                        "items": prepared
+                    },
+                    headers={"Idempotency-Key": batch_id}
+                ) as response:
+                    body = await response.text()
+                    result = self._result_for_status(batch_id, response.status, body, "")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                result = self._result_for_error(e, "")
             
-            # تسجيل في ملف منفصل باسم معرف التحويل
-            transfer_log_file = os.path.join(log_dir, f"transfer_{payload.get('transfer_id')}.json")
-            with open(transfer_log_file, "w", encoding="utf-8") as f:
-                json.dump(payload, f, ensure_ascii=False, indent=2)
-                
-            logger.info(f"تم إنشاء ملف سجل منفصل للتحويل: {transfer_log_file}")
+            result.pop("tasker_link", None)
+            result["batch_id"] = batch_id
+            return result
             
+        except Exception as e:
+            logger.error(f"خطأ غير متوقع في إرسال دفعة التحويلات: {e}", exc_info=True)
+            return {
+                "success": False,
+                "error": str(e),
+                "batch_id": batch_id
+            }
+    
+    async def dispatch(self, transfer_data: Dict[str, Any], idempotency_key: str = None,
+                       endpoint: str = None) -> Dict[str, Any]:
+        """
+        إرسال تحويل إلى Tasker، مع تجميعه في دفعة عند تفعيل وضع الدفعات.
+        في وضع الدفعات ينتظر المستدعي حتى إرسال الدفعة التي انضم إليها.
+        """
+        if not self.batching_enabled:
+            return await self.send_transfer_to_tasker_async(transfer_data, idempotency_key, endpoint)
+        
+        key = (self.wallet_type_for(transfer_data), endpoint or self.tasker_endpoint)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = {"items": [], "futures": [], "timer": None}
+            self._batches[key] = batch
+            # أول عنصر يبدأ نافذة التجميع
+            batch["timer"] = loop.call_later(self.batch_window, self._flush_batch, key)
+        
+        batch["items"].append((transfer_data, idempotency_key))
+        batch["futures"].append(future)
+        
+        if len(batch["items"]) >= self.batch_max:
+            self._flush_batch(key)
+        
+        return await future
+    
+    def _flush_batch(self, key: Tuple[str, str]) -> None:
+        """إغلاق الدفعة المفتوحة لنوع المحفظة وإرسالها"""
+        batch = self._batches.pop(key, None)
+        if batch is None:
+            return
+        if batch["timer"] is not None:
+            batch["timer"].cancel()
+        asyncio.get_running_loop().create_task(self._send_pending_batch(key[1], batch))
+    
+    async def _send_pending_batch(self, endpoint: str, batch: Dict[str, Any]) -> None:
+        if len(batch["items"]) == 1:
+            transfer_data, idempotency_key = batch["items"][0]
+            result = await self.send_transfer_to_tasker_async(transfer_data, idempotency_key, endpoint)
+        else:
+            result = await self.send_batch_to_tasker_async(batch["items"], endpoint)
+        
+        for future in batch["futures"]:
+            if not future.done():
+                future.set_result(dict(result))
+    
+    async def close(self) -> None:
+        """إغلاق الجلسة المشتركة"""
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+    
+    def _log_transfer_locally(self, payload: Dict[str, Any]) -> None:
+        """
+        تسجيل بيانات التحويل محلياً في سجل JSONL تكتبه خيط خلفي،
+        يمكن البحث فيه بمعرف التحويل عبر get_transfer_log(...).lookup
+        
+        :param payload: بيانات التحويل
+        """
+        try:
+            log_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "logs")
+            get_transfer_log(log_dir).log(payload)
         except Exception as e:
             logger.error(f"خطأ في تسجيل التحويل محلياً: {e}", exc_info=True)
     
@@ -173,50 +348,3 @@ class TaskerAutomation:
         
         # إرجاع القيمة الافتراضية إذا لم يتم العثور على تطابق
         return "unknown"
-    
-    def handle_tasker_callback(self, callback_data: Dict[str, Any]) -> Dict[str, Any]:
-        """
-        معالجة الاستدعاء العكسي من Tasker بعد محاولة التحويل
-        
-        :param callback_data: بيانات الاستدعاء العكسي من Tasker
-        :return: نتيجة المعالجة
-        """
-        try:
-            transfer_id = callback_data.get("transfer_id")
-            success = callback_data.get("success", False)
-            error_message = callback_data.get("error")
-            
-            if not transfer_id:
-                logger.error("معرف التحويل مفقود في بيانات الاستدعاء العكسي")
-                return {
-                    "success": False,
-                    "error": "معرف التحويل مفقود"
-                }
-            
-            logger.info(f"استلام استدعاء عكسي من Tasker للتحويل {transfer_id}: نجاح={success}")
-            
-            if success:
-                # تم التحويل بنجاح
-                result = {
-                    "success": True,
-                    "transfer_id": transfer_id,
-                    "message": "تم التحويل بنجاح",
-                    "timestamp": datetime.now().isoformat()
-                }
-            else:
-                # فشل التحويل
-                result = {
-                    "success": False,
-                    "transfer_id": transfer_id,
-                    "error": error_message or "حدث خطأ أثناء التحويل",
-                    "timestamp": datetime.now().isoformat()
-                }
-            
-            return result
-            
-        except Exception as e:
-            logger.error(f"خطأ في معالجة الاستدعاء العكسي: {e}")
-            return {
-                "success": False,
-                "error": f"خطأ في معالجة الاستدعاء العكسي: {str(e)}"
-            }
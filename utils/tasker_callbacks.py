@@ -0,0 +1,174 @@
+import os
+import hmac
+import json
+import hashlib
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SIGNATURE_HEADER = 'X-Tasker-Signature'
+ATTEMPT_HEADER = 'X-Tasker-Attempt'
+
+
+class TaskerCallbackIngestor:
+    """
+    استقبال الاستدعاءات العكسية من Tasker بشكل متكرر الأمان:
+    التحقق من توقيع HMAC، الحفظ في صندوق وارد يتجاهل المكرر بمفتاح (التحويل، المحاولة)،
+    ثم تطبيق تغييرات الحالة من خيط خلفي بعيداً عن مسار الطلب.
+    """
+
+    def __init__(self, db, secret: str = None, on_applied=None):
+        """
+        :param db: كائن قاعدة البيانات
+        :param secret: المفتاح المشترك مع Tasker لتوقيع الاستدعاءات
+        :param on_applied: دالة اختيارية تستدعى بقائمة الاستدعاءات بعد تطبيقها
+        """
+        self.db = db
+        secret = secret if secret is not None else os.getenv('TASKER_CALLBACK_SECRET', '')
+        self._mac = hmac.new(secret.encode('utf-8'), digestmod=hashlib.sha256) if secret else None
+        if self._mac is None:
+            logger.error("TASKER_CALLBACK_SECRET غير محدد، سيتم رفض جميع استدعاءات Tasker")
+        self.on_applied = on_applied
+        self.batch_size = int(os.getenv('TASKER_CALLBACK_BATCH', '100'))
+        self.poll_interval = float(os.getenv('TASKER_CALLBACK_POLL_INTERVAL', '5'))
+
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @property
+    def signing_enabled(self) -> bool:
+        """هل يوجد مفتاح مشترك للتحقق من التوقيعات"""
+        return self._mac is not None
+
+    def verify_signature(self, body: bytes, signature: Optional[str]) -> bool:
+        """التحقق من توقيع HMAC-SHA256 لجسم الطلب الخام، ويرفض كل شيء دون مفتاح مشترك"""
+        if self._mac is None:
+            return False
+        if not signature:
+            return False
+        signature = signature.strip()
+        if signature.startswith('sha256='):
+            signature = signature[len('sha256='):]
+        mac = self._mac.copy()
+        mac.update(body)
+        return hmac.compare_digest(mac.hexdigest(), signature.lower())
+
+    @staticmethod
+    def _normalize_item(item: Dict[str, Any], default_attempt: Optional[str]) -> Optional[Dict[str, Any]]:
+        """توحيد صيغ الاستدعاء القديمة (status) والجديدة (success)"""
+        transfer_id = str(item.get('transfer_id') or '').strip()
+        if not transfer_id:
+            return None
+
+        status = item.get('status')
+        if status not in ('completed', 'failed', 'processing'):
+            status = 'completed' if item.get('success', False) else 'failed'
+
+        attempt_id = item.get('attempt_id') or item.get('idempotency_key') or default_attempt
+        if not attempt_id:
+            # إعادة إرسال نفس الاستدعاء تنتج نفس البصمة فيتم تجاهلها
+            canonical = json.dumps(item, sort_keys=True, ensure_ascii=False, default=str)
+            attempt_id = hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+        error = item.get('error')
+        if status == 'failed' and not error:
+            error = 'فشل التحويل التلقائي'
+
+        return {
+            'transfer_id': transfer_id,
+            'attempt_id': str(attempt_id),
+            'status': status,
+            'error': error,
+            'payload': item
+        }
+
+    def parse(self, data: Dict[str, Any], attempt_header: str = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        تحويل جسم الاستدعاء (تحويل واحد أو دفعة results) إلى عناصر موحدة
+        :return: (العناصر، رسالة الخطأ)
+        """
+        if not isinstance(data, dict):
+            return [], 'No data provided'
+
+        if 'results' in data:
+            items = data.get('results')
+            if not isinstance(items, list):
+                return [], 'results must be a list'
+            batch_attempt = data.get('batch_id')
+        else:
+            items = [data]
+            batch_attempt = None
+
+        callbacks = []
+        for item in items:
+            if not isinstance(item, dict):
+                return [], 'each result must be an object'
+            callback = self._normalize_item(item, attempt_header or batch_attempt)
+            if callback is None:
+                return [], 'transfer_id is required'
+            callbacks.append(callback)
+        return callbacks, None
+
+    def ingest(self, callbacks: List[Dict[str, Any]]) -> Optional[int]:
+        """حفظ الاستدعاءات وإيقاظ خيط التطبيق، يعيد عدد الجديدة أو None عند الفشل"""
+        inserted = self.db.record_tasker_callbacks(callbacks)
+        if inserted:
+            self.start()
+            self._wakeup.set()
+        return inserted
+
+    def apply_pending(self) -> int:
+        """تطبيق الاستدعاءات المعلقة حتى تفريغ الصندوق"""
+        total = 0
+        while True:
+            applied = self.db.apply_tasker_callbacks(self.batch_size)
+            if not applied:
+                return total
+            total += len(applied)
+            for callback in applied:
+                if callback['outcome'] == 'applied' and callback['status'] == 'failed':
+                    logger.error(f"فشل التحويل {callback['transfer_id']}: {callback.get('error')}")
+                elif callback['outcome'] == 'applied':
+                    logger.info(f"تم تطبيق نتيجة Tasker للتحويل {callback['transfer_id']}: {callback['status']}")
+                else:
+                    logger.info(
+                        f"تم تجاهل نتيجة Tasker للتحويل {callback['transfer_id']} ({callback['status']}) "
+                        f"لأن حالته الحالية لا تسمح بالانتقال"
+                    )
+            if self.on_applied:
+                try:
+                    self.on_applied(applied)
+                except Exception as e:
+                    logger.error(f"خطأ في معالجة الاستدعاءات المطبقة: {e}", exc_info=True)
+            if len(applied) < self.batch_size:
+                return total
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            # الاستطلاع الدوري يلتقط ما حفظته عمليات أخرى أو ما فشل تطبيقه سابقاً
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            try:
+                self.apply_pending()
+            except Exception as e:
+                logger.error(f"خطأ في خيط تطبيق استدعاءات Tasker: {e}", exc_info=True)
+
+    def start(self) -> None:
+        """تشغيل خيط التطبيق عند أول استخدام"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='tasker-callback-applier', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._thread = None
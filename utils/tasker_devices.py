@@ -0,0 +1,101 @@
+import os
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+# أنواع المحافظ التي يعرفها TaskerAutomation._get_wallet_type
+KNOWN_WALLET_TYPES = ('jawali', 'kreemy', 'cash', 'onecash', 'jaib')
+
+
+class TaskerDeviceRegistry:
+    """
+    سجل أجهزة Tasker (هواتف Android) التي تنفذ التحويلات.
+    كل جهاز يعلن أنواع المحافظ التي يخدمها وأقصى عدد من المهام المتزامنة،
+    ويعتبر سليماً ما دامت نبضته الأخيرة ضمن heartbeat_ttl.
+    """
+
+    def __init__(self, db, heartbeat_ttl: int = None, allowed_hosts: List[str] = None):
+        self.db = db
+        self.heartbeat_ttl = heartbeat_ttl or int(os.getenv('TASKER_HEARTBEAT_TTL', '90'))
+        # العناوين التي يسمح للأجهزة بإعلانها، افتراضياً مضيف TASKER_ENDPOINT فقط
+        if allowed_hosts is None:
+            allowed_hosts = os.getenv('TASKER_ALLOWED_HOSTS', '').split(',')
+        self.allowed_hosts = {h.strip().lower() for h in allowed_hosts if h.strip()}
+        if not self.allowed_hosts:
+            default_host = urlparse(os.getenv('TASKER_ENDPOINT', 'http://localhost:8080/tasker')).hostname
+            if default_host:
+                self.allowed_hosts.add(default_host.lower())
+
+    def is_allowed_endpoint(self, endpoint: str) -> bool:
+        """هل عنوان الجهاز http(s) ومضيفه (أو المضيف:المنفذ) ضمن القائمة المسموح بها"""
+        try:
+            parsed = urlparse(endpoint)
+            host = parsed.hostname
+            port = parsed.port
+        except ValueError:
+            return False
+        if parsed.scheme not in ('http', 'https') or not host:
+            return False
+        host = host.lower()
+        return host in self.allowed_hosts or (port is not None and f"{host}:{port}" in self.allowed_hosts)
+
+    def heartbeat(self, data: Dict[str, Any]) -> Tuple[bool, Optional[str]]:
+        """
+        تسجيل نبضة جهاز.
+        :param data: device_id, endpoint, wallet_types, max_in_flight, in_flight (اختياري)
+        :return: (نجاح العملية، رسالة الخطأ)
+        """
+        device_id = str(data.get('device_id') or '').strip()
+        endpoint = str(data.get('endpoint') or '').strip()
+        wallet_types = data.get('wallet_types') or []
+        if isinstance(wallet_types, str):
+            wallet_types = [w.strip() for w in wallet_types.split(',')]
+        wallet_types = [w.lower() for w in wallet_types if w]
+
+        if not device_id or not endpoint:
+            return False, 'device_id و endpoint مطلوبان'
+        if not self.is_allowed_endpoint(endpoint):
+            logger.warning(f"رفض نبضة الجهاز {device_id}: العنوان {endpoint} غير مسموح به")
+            return False, 'endpoint غير مسموح به (راجع TASKER_ALLOWED_HOSTS)'
+        if not wallet_types:
+            return False, 'يجب تحديد نوع محفظة واحد على الأقل'
+        unknown = [w for w in wallet_types if w not in KNOWN_WALLET_TYPES]
+        if unknown:
+            return False, f"أنواع محافظ غير معروفة: {', '.join(unknown)}"
+
+        try:
+            max_in_flight = max(1, int(data.get('max_in_flight', 1)))
+            # الجهاز يبلغ عن حمله الفعلي فيصحح أي انحراف في العداد
+            in_flight = data.get('in_flight')
+            in_flight = max(0, int(in_flight)) if in_flight is not None else None
+        except (TypeError, ValueError):
+            return False, 'max_in_flight و in_flight يجب أن تكون أرقاماً'
+
+        if not self.db.upsert_tasker_device(device_id, endpoint, wallet_types, max_in_flight, in_flight):
+            return False, 'فشل في حفظ بيانات الجهاز'
+        return True, None
+
+    def acquire(self, wallet_type: str, job_id: int) -> Optional[Dict]:
+        """حجز خانة على أقل الأجهزة السليمة حملاً لنوع المحفظة"""
+        device = self.db.acquire_tasker_device(wallet_type, job_id, self.heartbeat_ttl)
+        if device:
+            logger.info(
+                f"تم اختيار جهاز Tasker {device['device_id']} للمحفظة {wallet_type} "
+                f"({device['in_flight']}/{device['max_in_flight']})"
+            )
+        return device
+
+    def serves(self, wallet_type: str) -> bool:
+        """هل يوجد جهاز مسجل يخدم نوع المحفظة (حتى لو كان مشغولاً أو غير متصل)"""
+        return self.db.has_tasker_device_for(wallet_type)
+
+    def release_job(self, job_id: int) -> Optional[str]:
+        return self.db.release_tasker_job_device(job_id)
+
+    def release_transfer(self, transfer_id: str) -> Optional[str]:
+        return self.db.release_tasker_device_for_transfer(transfer_id)
+
+    def list_devices(self) -> List[Dict]:
+        return self.db.get_tasker_devices()
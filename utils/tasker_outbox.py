@@ -0,0 +1,162 @@
+import os
+import asyncio
+import logging
+import random
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class TaskerOutboxWorker:
+    """
+    مجموعة عمال تفرغ صندوق صادر مهام Tasker.
+    كل مهمة تحمل مفتاحاً ثابتاً لمنع التكرار، وتعاد محاولتها بتأخير تصاعدي،
+    وتنقل إلى حالة الفشل النهائي بعد استنفاد المحاولات مع إعادة التحويل للمشرفين.
+    """
+
+    def __init__(self, db, tasker, devices=None, concurrency: int = None, max_attempts: int = None):
+        """
+        :param db: كائن قاعدة البيانات
+        :param tasker: كائن TaskerAutomation
+        :param devices: سجل أجهزة Tasker (TaskerDeviceRegistry)، بدونه يستخدم TASKER_ENDPOINT
+        :param concurrency: عدد العمال المتزامنين
+        :param max_attempts: أقصى عدد للمحاولات قبل الفشل النهائي
+        """
+        self.db = db
+        self.tasker = tasker
+        self.devices = devices
+        self.concurrency = concurrency or int(os.getenv('TASKER_WORKERS', '4'))
+        self.max_attempts = max_attempts or int(os.getenv('TASKER_MAX_ATTEMPTS', '6'))
+        self.base_delay = float(os.getenv('TASKER_RETRY_BASE_DELAY', '5'))
+        self.max_delay = float(os.getenv('TASKER_RETRY_MAX_DELAY', '300'))
+        self.poll_interval = float(os.getenv('TASKER_OUTBOX_POLL_INTERVAL', '2'))
+        # فترة الانتظار عندما تكون جميع الأجهزة مشغولة أو غير متصلة
+        self.device_wait = float(os.getenv('TASKER_DEVICE_WAIT', '5'))
+        # مهلة الحجز يجب أن تتجاوز مهلة طلب Tasker ونافذة تجميع الدفعات
+        self.lease_seconds = int(self.tasker.timeout + self.tasker.batch_window) + 30
+        # في وضع الدفعات يحجز كل عامل عدة مهام لتتجمع في دفعة واحدة
+        self.claim_size = self.tasker.batch_max if self.tasker.batching_enabled else 1
+
+        self.on_dead_letter: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+
+    @staticmethod
+    def new_idempotency_key(transfer_id: str) -> str:
+        """مفتاح فريد لكل مهمة يبقى ثابتاً عبر إعادة المحاولات"""
+        return f"{transfer_id}:{uuid.uuid4().hex}"
+
+    def enqueue(self, transfer_data: Dict[str, Any], expected_status: str = 'pending') -> bool:
+        """
+        إضافة مهمة Tasker مع تغيير حالة التحويل في نفس المعاملة.
+        يمكن استدعاؤها من أي خيط أو عملية، والعمال يلتقطون المهمة بالاستطلاع.
+        """
+        transfer_id = transfer_data.get('transfer_id')
+        payload = self.tasker.outbox_payload(transfer_data)
+        return self.db.enqueue_tasker_job(
+            transfer_id, payload, self.new_idempotency_key(transfer_id), expected_status,
+            self.tasker.wallet_type_for(payload)
+        )
+
+    async def enqueue_async(self, transfer_data: Dict[str, Any], expected_status: str = 'pending') -> bool:
+        """إضافة مهمة من حلقة الأحداث وإيقاظ العمال فوراً"""
+        queued = await asyncio.to_thread(self.enqueue, transfer_data, expected_status)
+        if queued:
+            self.wake()
+        return queued
+
+    def wake(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _retry_delay(self, attempts: int) -> float:
+        """تأخير تصاعدي مع تشويش عشوائي لتجنب تزامن إعادة المحاولات"""
+        delay = min(self.max_delay, self.base_delay * (2 ** max(0, attempts - 1)))
+        return delay * random.uniform(0.8, 1.2)
+
+    async def _process(self, job: Dict[str, Any]) -> None:
+        job_id = job['id']
+        transfer_id = job['transfer_id']
+
+        device = None
+        if self.devices:
+            wallet_type = self.tasker.wallet_type_for(job['payload'])
+            device = await asyncio.to_thread(self.devices.acquire, wallet_type, job_id)
+            if device is None and await asyncio.to_thread(self.devices.serves, wallet_type):
+                # توجد أجهزة لهذه المحفظة لكنها مشغولة أو غير متصلة، لا تحتسب المحاولة
+                await asyncio.to_thread(
+                    self.db.reschedule_tasker_job, job_id, self.device_wait,
+                    f"لا يوجد جهاز متاح للمحفظة {wallet_type}", False
+                )
+                return
+
+        result = await self.tasker.dispatch(
+            job['payload'], job['idempotency_key'],
+            endpoint=device['endpoint'] if device else None
+        )
+
+        if result.get('success'):
+            await asyncio.to_thread(self.db.mark_tasker_job_sent, job_id)
+            return
+
+        if device:
+            await asyncio.to_thread(self.devices.release_job, job_id)
+
+        error = result.get('error', 'خطأ غير معروف')
+        if result.get('retryable', False) and job['attempts'] < self.max_attempts:
+            delay = self._retry_delay(job['attempts'])
+            logger.warning(
+                f"فشل إرسال مهمة Tasker {job_id} للتحويل {transfer_id} "
+                f"(محاولة {job['attempts']}/{self.max_attempts})، إعادة المحاولة بعد {delay:.0f} ثانية: {error}"
+            )
+            await asyncio.to_thread(self.db.reschedule_tasker_job, job_id, delay, error)
+            return
+
+        if await asyncio.to_thread(self.db.dead_letter_tasker_job, job_id, error) and self.on_dead_letter:
+            try:
+                await self.on_dead_letter({**job, 'error': error})
+            except Exception as e:
+                logger.error(f"خطأ في إشعار فشل مهمة Tasker {job_id}: {e}", exc_info=True)
+
+    async def _worker(self, index: int) -> None:
+        while True:
+            try:
+                jobs = await asyncio.to_thread(self.db.claim_tasker_jobs, self.claim_size, self.lease_seconds)
+                if not jobs:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                results = await asyncio.gather(*(self._process(job) for job in jobs), return_exceptions=True)
+                for job, result in zip(jobs, results):
+                    if isinstance(result, Exception):
+                        logger.error(f"خطأ في معالجة مهمة Tasker {job['id']}: {result}", exc_info=result)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"خطأ في عامل Tasker رقم {index}: {e}", exc_info=True)
+                await asyncio.sleep(self.poll_interval)
+
+    def start(self, on_dead_letter: Callable[[Dict[str, Any]], Awaitable[None]] = None) -> None:
+        """تشغيل العمال في حلقة الأحداث الحالية"""
+        if on_dead_letter is not None:
+            self.on_dead_letter = on_dead_letter
+        if self._tasks:
+            return
+        self._wakeup = asyncio.Event()
+        self._tasks = [
+            asyncio.create_task(self._worker(index), name=f"tasker-outbox-{index}")
+            for index in range(self.concurrency)
+        ]
+        logger.info(f"تم تشغيل {self.concurrency} عمال لصندوق صادر Tasker")
+
+    async def stop(self) -> None:
+        """إيقاف العمال، والمهام المحجوزة تعود للصندوق بعد انتهاء مهلة الحجز"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._wakeup = None
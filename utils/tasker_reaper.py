@@ -0,0 +1,141 @@
+import os
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from utils.tasker_devices import KNOWN_WALLET_TYPES
+
+logger = logging.getLogger(__name__)
+
+
+class TaskerReaper:
+    """
+    مهمة دورية تعيد التحويلات العالقة في حالة المعالجة إلى "معلق"
+    عندما يتجاوز انتظار الاستدعاء العكسي مهلة المحفظة (SLA)، مع إشعار المشرفين.
+    """
+
+    def __init__(self, db, tasker, interval: float = None):
+        """
+        :param db: كائن قاعدة البيانات
+        :param tasker: كائن TaskerAutomation لتحديد نوع المحفظة
+        :param interval: الفترة بين كل فحص بالثواني
+        """
+        self.db = db
+        self.tasker = tasker
+        self.interval = interval or float(os.getenv('TASKER_REAPER_INTERVAL', '60'))
+        # المهلة الافتراضية، ويمكن تخصيصها لكل محفظة مثل TASKER_SLA_JAIB=600
+        self.default_sla = float(os.getenv('TASKER_SLA_SECONDS', '900'))
+        self.sla = {
+            wallet_type: float(os.getenv(f'TASKER_SLA_{wallet_type.upper()}', str(self.default_sla)))
+            for wallet_type in KNOWN_WALLET_TYPES
+        }
+
+        self.on_reaped: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def sla_for(self, wallet_type: Optional[str]) -> float:
+        return self.sla.get(wallet_type, self.default_sla)
+
+    async def reap_once(self) -> List[Dict[str, Any]]:
+        """فحص واحد، يعيد التحويلات التي تمت إعادتها"""
+        min_sla = min([self.default_sla, *self.sla.values()])
+        candidates = await asyncio.to_thread(self.db.find_stuck_tasker_transfers, min_sla)
+
+        reaped = []
+        for transfer in candidates:
+            wallet_type = transfer.get('wallet_type') or self.tasker.wallet_type_for(transfer)
+            sla = self.sla_for(wallet_type)
+            # المرشحون تجاوزوا أقل مهلة، ويبقى التحقق من مهلة المحفظة نفسها
+            age = float(transfer['age_seconds'])
+            if age < sla:
+                continue
+
+            reason = f"لم يصل رد Tasker خلال {sla:.0f} ثانية"
+            job = await asyncio.to_thread(
+                self.db.reap_stuck_tasker_transfer,
+                transfer['transfer_id'], transfer['processing_started_at'], reason
+            )
+            if job is None:
+                continue
+
+            item = {**transfer, 'wallet_type': wallet_type, 'sla_seconds': sla, 'age_seconds': age, 'error': reason}
+            reaped.append(item)
+            if self.on_reaped:
+                try:
+                    await self.on_reaped(item)
+                except Exception as e:
+                    logger.error(f"خطأ في إشعار التحويل العالق {transfer['transfer_id']}: {e}", exc_info=True)
+
+        if reaped:
+            logger.warning(f"تمت إعادة {len(reaped)} تحويلات عالقة إلى حالة معلق")
+        return reaped
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.reap_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"خطأ في فحص التحويلات العالقة: {e}", exc_info=True)
+            await asyncio.sleep(self.interval)
+
+    def start(self, on_reaped: Callable[[Dict[str, Any]], Awaitable[None]] = None) -> None:
+        """تشغيل الفحص الدوري في حلقة الأحداث الحالية"""
+        if on_reaped is not None:
+            self.on_reaped = on_reaped
+        if self._task is not None:
+            return
+        self._task = asyncio.create_task(self._run(), name='tasker-reaper')
+        logger.info(f"تم تشغيل فحص التحويلات العالقة كل {self.interval:.0f} ثانية")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+
+def summarize_latency(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    تجميع صفوف مدرج زمن التنفيذ لكل (جهاز، محفظة، نتيجة) مع عدد تراكمي لكل فئة
+    وتقدير أعلى للوسيط والمئين 95.
+    """
+    groups: Dict[tuple, Dict[str, Any]] = {}
+    for row in rows:
+        key = (row['device_id'], row['wallet_type'], row['outcome'])
+        group = groups.setdefault(key, {
+            'device_id': row['device_id'],
+            'wallet_type': row['wallet_type'],
+            'outcome': row['outcome'],
+            'count': 0,
+            'sum_seconds': 0.0,
+            'buckets': []
+        })
+        group['count'] += row['count']
+        group['sum_seconds'] += row['sum_seconds']
+        group['buckets'].append({
+            'le': 'inf' if row['bucket_le'] == float('inf') else row['bucket_le'],
+            'count': group['count']
+        })
+
+    summary = []
+    for group in groups.values():
+        count = group['count']
+        group['avg_seconds'] = round(group['sum_seconds'] / count, 2) if count else None
+        group['p50_le'] = _quantile_bucket(group['buckets'], count, 0.5)
+        group['p95_le'] = _quantile_bucket(group['buckets'], count, 0.95)
+        summary.append(group)
+    return summary
+
+
+def _quantile_bucket(buckets: List[Dict[str, Any]], count: int, quantile: float):
+    """حد الفئة التي يقع فيها المئين المطلوب"""
+    if not count:
+        return None
+    target = quantile * count
+    for bucket in buckets:
+        if bucket['count'] >= target:
+            return bucket['le']
+    return buckets[-1]['le']
@@ -0,0 +1,157 @@
+import os
+import re
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, ContextTypes, TypeHandler
+
+logger = logging.getLogger(__name__)
+
+# السعة/الثواني لكل فئة، مثلاً 3/60 تعني 3 طلبات كل دقيقة مع السماح بدفعة من 3
+DEFAULT_LIMITS = {
+    'start': '1/2',
+    'txid': '3/60',
+    'amount': '5/30',
+    'callback': '10/10',
+    'message': '20/60',
+}
+
+TXID_PATTERN = re.compile(r'^(0x)?[0-9a-fA-F]{64}$')
+AMOUNT_PATTERN = re.compile(r'^\d+(\.\d+)?$')
+START_PATTERN = re.compile(r'^(/start\b|🏧 سحب$|سحب$)')
+
+
+def classify_update(update: Update) -> Optional[str]:
+    """فئة التحديث لتحديد حدّه، أو None إذا لم يخضع للتقييد"""
+    if update.callback_query is not None:
+        return 'callback'
+    message = update.message
+    if message is None:
+        return None
+    text = (message.text or '').strip()
+    if START_PATTERN.match(text):
+        return 'start'
+    if TXID_PATTERN.match(text):
+        return 'txid'
+    if AMOUNT_PATTERN.match(text):
+        return 'amount'
+    return 'message'
+
+
+def parse_limit(value: str) -> Tuple[float, float]:
+    """تحويل "السعة/الثواني" إلى (السعة، معدل التعبئة بالثانية)"""
+    capacity, seconds = value.split('/')
+    capacity = float(capacity)
+    return capacity, capacity / float(seconds)
+
+
+class MemoryThrottleStore:
+    """
+    دلاء رموز في الذاكرة بحجم أقصى ثابت.
+    الدلو يحذف بعد أن يمتلئ من جديد (TTL)، والأقدم استخداماً يحذف عند بلوغ الحد الأقصى.
+    """
+
+    def __init__(self, max_keys: int = None):
+        self.max_keys = max_keys or int(os.getenv('THROTTLE_MAX_KEYS', '50000'))
+        self._buckets: 'OrderedDict[Tuple, List[float]]' = OrderedDict()
+
+    async def take(self, key: Tuple, capacity: float, rate: float) -> bool:
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            tokens = capacity
+        else:
+            tokens = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        # بعد expires_at يكون الدلو ممتلئاً فحذفه لا يغير شيئاً
+        self._buckets[key] = [tokens, now, now + (capacity - tokens) / rate]
+        self._buckets.move_to_end(key)
+        self._evict(now)
+        return allowed
+
+    def _evict(self, now: float) -> None:
+        while self._buckets:
+            key, bucket = next(iter(self._buckets.items()))
+            if bucket[2] > now and len(self._buckets) <= self.max_keys:
+                break
+            del self._buckets[key]
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class PostgresThrottleStore:
+    """دلاء رموز مشتركة في PostgreSQL لتشغيل عدة نسخ من البوت"""
+
+    def __init__(self, db, prune_every: int = 1000):
+        self.db = db
+        self.prune_every = prune_every
+        self._calls = 0
+
+    async def take(self, key: Tuple, capacity: float, rate: float) -> bool:
+        self._calls += 1
+        if self._calls % self.prune_every == 0:
+            await asyncio.to_thread(self.db.prune_throttle_buckets)
+        return await asyncio.to_thread(self.db.take_throttle_token, ':'.join(map(str, key)), capacity, rate)
+
+
+class ThrottleMiddleware:
+    """
+    معالج في المجموعة -1 يطبق دلو رموز لكل (مستخدم، فئة) قبل وصول التحديث لأي معالج آخر.
+    التحديث المرفوض يوقف المعالجة عبر ApplicationHandlerStop.
+    """
+
+    def __init__(self, store=None, limits: Dict[str, str] = None, exempt_chat_ids: List[Any] = None):
+        self.store = store or MemoryThrottleStore()
+        self.limits = {}
+        for name, default in {**DEFAULT_LIMITS, **(limits or {})}.items():
+            self.limits[name] = parse_limit(os.getenv(f'THROTTLE_{name.upper()}', default))
+        self.exempt_chat_ids = {
+            int(chat_id) for chat_id in (exempt_chat_ids or []) if str(chat_id).lstrip('-').isdigit()
+        }
+
+    @property
+    def handler(self) -> TypeHandler:
+        return TypeHandler(Update, self.check)
+
+    async def check(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        user = update.effective_user
+        if user is None:
+            return
+        if update.effective_chat is not None and update.effective_chat.id in self.exempt_chat_ids:
+            return
+
+        name = classify_update(update)
+        if name is None:
+            return
+
+        capacity, rate = self.limits[name]
+        if await self.store.take((user.id, name), capacity, rate):
+            return
+
+        logger.warning(f"تم تقييد المستخدم {user.id} في الفئة {name}")
+        try:
+            if update.callback_query is not None:
+                await update.callback_query.answer("⏳ الرجاء الانتظار قليلاً قبل المحاولة مرة أخرى")
+            elif name == 'start':
+                await update.message.delete()
+        except Exception:
+            pass
+        raise ApplicationHandlerStop
+
+
+def build_throttle(db=None, exempt_chat_ids: List[Any] = None) -> ThrottleMiddleware:
+    """إنشاء المقيد حسب THROTTLE_BACKEND (memory أو postgres)"""
+    backend = os.getenv('THROTTLE_BACKEND', 'memory').lower()
+    if backend == 'postgres' and db is not None:
+        store = PostgresThrottleStore(db)
+    else:
+        store = MemoryThrottleStore()
+    return ThrottleMiddleware(store, exempt_chat_ids=exempt_chat_ids)
@@ -0,0 +1,143 @@
+import os
+import time
+import queue
+import select
+import logging
+import threading
+from collections import deque
+from typing import Deque, Iterator, List, Optional, Tuple
+
+import psycopg2
+import psycopg2.extensions
+
+from utils.database import TRANSFER_EVENTS_CHANNEL
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """اتصال متصفح واحد بطابور محدود، المشترك البطيء يفصل بدلاً من تراكم الذاكرة"""
+
+    __slots__ = ('queue', 'lagging')
+
+    def __init__(self, size: int):
+        self.queue: 'queue.Queue[Tuple[str, str]]' = queue.Queue(maxsize=size)
+        self.lagging = False
+
+
+class TransferEventBroker:
+    """
+    مستمع واحد لكل عملية على قناة transfer_events في PostgreSQL،
+    يوزع كل إشعار على جميع المتصفحات المتصلة عبر Server-Sent Events.
+    يحتفظ بآخر الأحداث لإعادتها للمتصفح الذي يعيد الاتصال مع Last-Event-ID.
+    """
+
+    def __init__(self, db_url: str, channel: str = TRANSFER_EVENTS_CHANNEL, max_subscribers: int = None):
+        self.db_url = db_url
+        self.channel = channel
+        # كل متصفح يحجز خيط gthread طوال الاتصال، فالحد الافتراضي نصف خيوط العامل
+        # حتى يبقى النصف الآخر لبقية طلبات لوحة التحكم
+        threads = int(os.getenv('DASHBOARD_THREADS', '16'))
+        self.max_subscribers = max_subscribers or int(os.getenv('DASHBOARD_MAX_STREAMS', str(max(1, threads // 2))))
+        if self.max_subscribers >= threads:
+            logger.warning(
+                f"DASHBOARD_MAX_STREAMS ({self.max_subscribers}) لا يقل عن DASHBOARD_THREADS ({threads})، "
+                "البث المباشر قد يحجز كل خيوط العامل"
+            )
+        self.heartbeat = float(os.getenv('SSE_HEARTBEAT', '15'))
+        # الاتصال ينتهي دورياً ويعيد المتصفح فتحه تلقائياً، فلا يحجز خيط العامل طويلاً
+        self.max_duration = float(os.getenv('SSE_MAX_DURATION', '300'))
+        # معرفات الأحداث تبدأ بمعرف العملية حتى لا يخلط إعادة الاتصال بعامل آخر بين التسلسلات
+        self._boot = format(int(time.time() * 1000), 'x')
+        self._sequence = 0
+        self._recent: Deque[Tuple[str, str]] = deque(maxlen=int(os.getenv('SSE_REPLAY_EVENTS', '200')))
+        self._subscribers: List[Subscription] = []
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    # ----- الاستماع -----
+
+    def _listen(self) -> None:
+        delay = 1
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(self.db_url)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                conn.cursor().execute(f'LISTEN {self.channel}')
+                logger.info(f"بدء الاستماع لقناة {self.channel}")
+                delay = 1
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self._publish(conn.notifies.pop(0).payload)
+            except Exception as e:
+                logger.error(f"خطأ في مستمع قناة {self.channel}، إعادة الاتصال بعد {delay} ثانية: {e}")
+                time.sleep(delay)
+                delay = min(delay * 2, 60)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except psycopg2.Error:
+                        pass
+
+    def _publish(self, payload: str) -> None:
+        with self._lock:
+            self._sequence += 1
+            event = (f"{self._boot}-{self._sequence}", payload)
+            self._recent.append(event)
+            for subscription in self._subscribers:
+                try:
+                    subscription.queue.put_nowait(event)
+                except queue.Full:
+                    subscription.lagging = True
+
+    def _ensure_listener(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._listen, name='transfer-events', daemon=True)
+            self._thread.start()
+
+    # ----- المشتركون -----
+
+    def subscribe(self, last_event_id: Optional[str] = None) -> Optional[Subscription]:
+        """تسجيل متصفح جديد، أو None إذا بلغ العدد الأقصى"""
+        with self._lock:
+            self._ensure_listener()
+            if len(self._subscribers) >= self.max_subscribers:
+                return None
+            subscription = Subscription(self._recent.maxlen)
+            if last_event_id and last_event_id.startswith(f"{self._boot}-"):
+                try:
+                    last_sequence = int(last_event_id.rsplit('-', 1)[1])
+                except ValueError:
+                    last_sequence = None
+                if last_sequence is not None:
+                    for event in self._recent:
+                        if int(event[0].rsplit('-', 1)[1]) > last_sequence:
+                            subscription.queue.put_nowait(event)
+            self._subscribers.append(subscription)
+            return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            if subscription in self._subscribers:
+                self._subscribers.remove(subscription)
+
+    def stream(self, subscription: Subscription) -> Iterator[str]:
+        """مولد نص text/event-stream للمشترك"""
+        deadline = time.monotonic() + self.max_duration
+        try:
+            yield "retry: 3000\n\n"
+            while time.monotonic() < deadline and not subscription.lagging:
+                try:
+                    event_id, payload = subscription.queue.get(timeout=self.heartbeat)
+                except queue.Empty:
+                    # تعليق SSE يبقي الاتصال مفتوحاً عبر الوسطاء
+                    yield ": ping\n\n"
+                    continue
+                yield f"id: {event_id}\nevent: transfer\ndata: {payload}\n\n"
+        finally:
+            self.unsubscribe(subscription)
@@ -0,0 +1,200 @@
+import os
+import json
+import gzip
+import queue
+import shutil
+import sqlite3
+import atexit
+import logging
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# اسم المقطع الحالي في الفهرس قبل تدويره وضغطه
+CURRENT_SEGMENT = 'current'
+
+
+class TransferLogWriter:
+    """
+    سجل تحويلات بصيغة JSONL يكتب من خيط خلفي عبر طابور.
+    يتم تدوير الملف حسب الحجم أو الزمن وضغط المقاطع القديمة،
+    وفهرس SQLite يربط معرف التحويل بالمقطع والموضع بدلاً من ملف لكل تحويل.
+    """
+
+    def __init__(self, log_dir: str, base_name: str = 'tasker_transfers',
+                 max_bytes: int = None, rotate_seconds: float = None):
+        self.log_dir = log_dir
+        self.base_name = base_name
+        self.max_bytes = max_bytes or int(os.getenv('TRANSFER_LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+        self.rotate_seconds = rotate_seconds or float(os.getenv('TRANSFER_LOG_ROTATE_HOURS', '24')) * 3600
+        self.current_path = os.path.join(log_dir, f"{base_name}.jsonl")
+        self.index_path = os.path.join(log_dir, f"{base_name}_index.sqlite3")
+
+        self._queue: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        # قفل الفهرس بين خيط الكتابة والبحث
+        self._index_lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            os.makedirs(self.log_dir, exist_ok=True)
+            self._thread = threading.Thread(target=self._run, name='transfer-log-writer', daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def log(self, payload: Dict[str, Any]) -> None:
+        """إضافة سجل إلى الطابور دون انتظار الكتابة على القرص"""
+        if self._thread is None or not self._thread.is_alive():
+            self.start()
+        self._queue.put(payload)
+
+    def close(self, timeout: float = 5.0) -> None:
+        """تفريغ الطابور وإيقاف خيط الكتابة"""
+        thread = self._thread
+        if thread is None or not thread.is_alive():
+            return
+        self._queue.put(None)
+        thread.join(timeout)
+
+    def _open_index(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.index_path, check_same_thread=False)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS entries (
+                transfer_id TEXT NOT NULL,
+                segment TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL,
+                logged_at TEXT NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_entries_transfer_id ON entries(transfer_id)')
+        conn.commit()
+        return conn
+
+    def _run(self) -> None:
+        index = self._open_index()
+        handle = open(self.current_path, 'ab')
+        opened_at = time.time()
+        if handle.tell() > 0:
+            # ملف موجود من تشغيل سابق، عمره من آخر تعديل
+            opened_at = os.path.getmtime(self.current_path)
+
+        try:
+            while True:
+                batch = []
+                try:
+                    batch.append(self._queue.get(timeout=1.0))
+                except queue.Empty:
+                    pass
+
+                # تجميع كل ما في الطابور في كتابة وتثبيت واحد
+                while True:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+
+                stop = None in batch
+                records = [record for record in batch if record is not None]
+
+                if records:
+                    rows = []
+                    for record in records:
+                        line = json.dumps(record, ensure_ascii=False, separators=(',', ':'), default=str).encode('utf-8') + b'\n'
+                        offset = handle.tell()
+                        handle.write(line)
+                        rows.append((
+                            str(record.get('transfer_id', '')),
+                            CURRENT_SEGMENT,
+                            offset,
+                            len(line),
+                            record.get('timestamp') or datetime.now().isoformat()
+                        ))
+                    handle.flush()
+                    with self._index_lock:
+                        index.executemany(
+                            'INSERT INTO entries (transfer_id, segment, offset, length, logged_at) VALUES (?, ?, ?, ?, ?)',
+                            rows
+                        )
+                        index.commit()
+
+                size = handle.tell()
+                if size and (size >= self.max_bytes or time.time() - opened_at >= self.rotate_seconds):
+                    handle.close()
+                    self._rotate(index)
+                    handle = open(self.current_path, 'ab')
+                    opened_at = time.time()
+
+                if stop:
+                    break
+        except Exception as e:
+            logger.error(f"خطأ في خيط كتابة سجل التحويلات: {e}", exc_info=True)
+        finally:
+            handle.close()
+            index.close()
+
+    def _rotate(self, index: sqlite3.Connection) -> None:
+        """نقل المقطع الحالي وضغطه وتحديث الفهرس"""
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        segment = f"{self.base_name}-{stamp}.jsonl.gz"
+        rotated = os.path.join(self.log_dir, f"{self.base_name}-{stamp}.jsonl")
+
+        # البحث ينتظر حتى تتطابق الملفات مع الفهرس
+        with self._index_lock:
+            os.replace(self.current_path, rotated)
+            with open(rotated, 'rb') as src, gzip.open(os.path.join(self.log_dir, segment), 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            index.execute('UPDATE entries SET segment = ? WHERE segment = ?', (segment, CURRENT_SEGMENT))
+            index.commit()
+            os.remove(rotated)
+        logger.info(f"تم تدوير سجل التحويلات إلى {segment}")
+
+    def lookup(self, transfer_id: str) -> List[Dict[str, Any]]:
+        """البحث عن سجلات تحويل عبر الفهرس"""
+        if not os.path.exists(self.index_path):
+            return []
+
+        records = []
+        with self._index_lock:
+            conn = sqlite3.connect(self.index_path)
+            try:
+                rows = conn.execute(
+                    'SELECT segment, offset, length FROM entries WHERE transfer_id = ? ORDER BY rowid',
+                    (str(transfer_id),)
+                ).fetchall()
+            finally:
+                conn.close()
+
+            for segment, offset, length in rows:
+                try:
+                    if segment == CURRENT_SEGMENT:
+                        opener, path = open, self.current_path
+                    else:
+                        opener, path = gzip.open, os.path.join(self.log_dir, segment)
+                    with opener(path, 'rb') as f:
+                        f.seek(offset)
+                        records.append(json.loads(f.read(length)))
+                except (OSError, ValueError) as e:
+                    logger.error(f"تعذر قراءة سجل التحويل {transfer_id} من {segment}: {e}")
+        return records
+
+
+_writers: Dict[str, TransferLogWriter] = {}
+_writers_lock = threading.Lock()
+
+
+def get_transfer_log(log_dir: str) -> TransferLogWriter:
+    """كاتب واحد مشترك لكل مجلد سجلات داخل العملية"""
+    log_dir = os.path.abspath(log_dir)
+    with _writers_lock:
+        writer = _writers.get(log_dir)
+        if writer is None:
+            writer = TransferLogWriter(log_dir)
+            _writers[log_dir] = writer
+        return writer
@@ -0,0 +1,149 @@
+import os
+import asyncio
+import logging
+import random
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# المعالج يعيد False لإيقاف التحويل عند هذه المرحلة، وأي قيمة أخرى تمرره للمرحلة التالية
+StageHandler = Callable[[Dict[str, Any]], Awaitable[Optional[bool]]]
+
+
+class PipelineStage:
+    """مرحلة في خط المعالجة بطابور وعدد عمال وسياسة إعادة محاولة خاصة بها"""
+
+    def __init__(self, name: str, handler: StageHandler, workers: int = 1,
+                 max_retries: int = 3, retry_delay: float = 2.0, queue_size: int = 1000):
+        """
+        :param name: اسم المرحلة (يستخدم في السجلات ومتغيرات البيئة)
+        :param handler: دالة المعالجة غير المتزامنة
+        :param workers: عدد العمال المتزامنين
+        :param max_retries: عدد إعادة المحاولات عند حدوث استثناء
+        :param retry_delay: التأخير الأساسي قبل إعادة المحاولة (يتضاعف مع كل محاولة)
+        :param queue_size: الحد الأقصى للطابور
+        """
+        prefix = f"PIPELINE_{name.upper()}"
+        self.name = name
+        self.handler = handler
+        self.workers = int(os.getenv(f"{prefix}_WORKERS", str(workers)))
+        self.max_retries = int(os.getenv(f"{prefix}_RETRIES", str(max_retries)))
+        self.retry_delay = retry_delay
+        self.queue_size = queue_size
+        self.queue: Optional[asyncio.Queue] = None
+        self.next: Optional['PipelineStage'] = None
+
+    def _backoff(self, attempt: int) -> float:
+        return self.retry_delay * (2 ** attempt) * random.uniform(0.8, 1.2)
+
+
+class TransferPipeline:
+    """
+    خط معالجة التحويلات بعد حفظها: كل مرحلة تعمل بشكل مستقل في الخلفية،
+    فيعود معالج المستخدم مباشرة بعد الحفظ وتعديل رسالة الحالة.
+    فشل مرحلة بعد استنفاد محاولاتها لا يمنع المراحل التالية (التحويل محفوظ مسبقاً).
+    """
+
+    def __init__(self):
+        self.stages: List[PipelineStage] = []
+        self._tasks: List[asyncio.Task] = []
+        self._retries: set = set()
+
+    def add_stage(self, name: str, handler: StageHandler, **options) -> 'TransferPipeline':
+        stage = PipelineStage(name, handler, **options)
+        if self.stages:
+            self.stages[-1].next = stage
+        self.stages.append(stage)
+        return self
+
+    def submit(self, item: Dict[str, Any]) -> bool:
+        """إدخال تحويل محفوظ إلى المرحلة الأولى دون انتظار"""
+        if not self._tasks:
+            logger.error(f"خط معالجة التحويلات غير مشغل، تعذر إدخال {item.get('transfer_id')}")
+            return False
+        try:
+            self.stages[0].queue.put_nowait((item, 0))
+            return True
+        except asyncio.QueueFull:
+            logger.error(f"طابور خط المعالجة ممتلئ، تعذر إدخال {item.get('transfer_id')}")
+            return False
+
+    async def run_inline(self, item: Dict[str, Any]) -> None:
+        """
+        تنفيذ المراحل بالتتابع في المهمة الحالية بمحاولة واحدة لكل مرحلة،
+        بديل submit عندما يكون الطابور ممتلئاً أو الخط غير مشغل.
+        """
+        transfer_id = item.get('transfer_id')
+        if not self.stages:
+            logger.error(f"لا توجد مراحل معرفة في خط المعالجة، تعذر معالجة {transfer_id}")
+            return
+        for stage in self.stages:
+            try:
+                result = await stage.handler(item)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"فشلت مرحلة {stage.name} للتحويل {transfer_id} خارج الطابور: {e}", exc_info=True)
+                result = None
+            if result is False:
+                return
+
+    async def _retry_later(self, stage: PipelineStage, item: Dict[str, Any], attempt: int) -> None:
+        await asyncio.sleep(stage._backoff(attempt - 1))
+        await stage.queue.put((item, attempt))
+
+    async def _worker(self, stage: PipelineStage, index: int) -> None:
+        while True:
+            item, attempt = await stage.queue.get()
+            try:
+                result = await stage.handler(item)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                transfer_id = item.get('transfer_id')
+                if attempt < stage.max_retries:
+                    logger.warning(
+                        f"فشل مرحلة {stage.name} للتحويل {transfer_id} "
+                        f"(محاولة {attempt + 1}/{stage.max_retries + 1}): {e}"
+                    )
+                    task = asyncio.create_task(self._retry_later(stage, item, attempt + 1))
+                    self._retries.add(task)
+                    task.add_done_callback(self._retries.discard)
+                    continue
+                logger.error(f"فشلت مرحلة {stage.name} نهائياً للتحويل {transfer_id}: {e}", exc_info=True)
+                result = None
+            finally:
+                stage.queue.task_done()
+
+            if result is not False and stage.next is not None:
+                await stage.next.queue.put((item, 0))
+
+    def start(self) -> None:
+        """تشغيل عمال كل المراحل في حلقة الأحداث الحالية"""
+        if self._tasks:
+            return
+        for stage in self.stages:
+            stage.queue = asyncio.Queue(maxsize=stage.queue_size)
+            self._tasks += [
+                asyncio.create_task(self._worker(stage, index), name=f"pipeline-{stage.name}-{index}")
+                for index in range(stage.workers)
+            ]
+        logger.info(
+            "تم تشغيل خط معالجة التحويلات: "
+            + "، ".join(f"{stage.name} ({stage.workers})" for stage in self.stages)
+        )
+
+    async def stop(self, timeout: float = 10) -> None:
+        """انتظار تفريغ الطوابير لمدة محدودة ثم إيقاف العمال"""
+        if not self._tasks:
+            return
+        try:
+            for stage in self.stages:
+                await asyncio.wait_for(stage.queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning("تم إيقاف خط معالجة التحويلات قبل تفريغ الطوابير")
+        for task in [*self._tasks, *self._retries]:
+            task.cancel()
+        await asyncio.gather(*self._tasks, *self._retries, return_exceptions=True)
+        self._tasks = []
+        self._retries = set()
@@ -0,0 +1,96 @@
+import os
+import asyncio
+import logging
+from typing import Any, Awaitable, Dict, List, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+class _UserLock:
+    __slots__ = ('lock', 'users')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    معالج تحديثات ينفذ تحديثات المستخدم الواحد بالترتيب واحداً تلو الآخر،
+    وتحديثات المستخدمين المختلفين بالتوازي حتى حد أقصى.
+    تحديثات مجموعة المشرفين لها مسار وحد مستقلان فلا تنتظر خلف ضغط المستخدمين.
+    PTB ينشئ مهمة لكل تحديث فور سحبه من الطابور، لذا يحد المعالج نفسه من العمل المعلق:
+    حد قبول عام قبل أقفال المستخدمين، وحد لتحديثات المستخدم الواحد المنتظرة.
+    """
+
+    def __init__(self, admin_chat_ids: List[Any] = None, max_user_updates: int = None, max_admin_updates: int = None,
+                 max_pending_updates: int = None, max_pending_per_user: int = None):
+        self.max_user_updates = max_user_updates or int(os.getenv('MAX_CONCURRENT_UPDATES', '64'))
+        self.max_admin_updates = max_admin_updates or int(os.getenv('MAX_CONCURRENT_ADMIN_UPDATES', '8'))
+        self.max_pending_updates = max_pending_updates or int(os.getenv('UPDATE_QUEUE_SIZE', '1000'))
+        self.max_pending_per_user = max_pending_per_user or int(os.getenv('MAX_PENDING_UPDATES_PER_USER', '20'))
+        # حد القبول العام هو سيمافور BaseUpdateProcessor، ويحجز قبل أقفال المستخدمين في do_process_update
+        super().__init__(max_concurrent_updates=self.max_pending_updates)
+
+        if admin_chat_ids is None:
+            admin_chat_ids = [os.getenv('ADMIN_GROUP_ID', '0')]
+        self.admin_chat_ids = {int(chat_id) for chat_id in admin_chat_ids if str(chat_id).lstrip('-').isdigit()}
+
+        self._user_lane = asyncio.Semaphore(self.max_user_updates)
+        self._admin_lane = asyncio.Semaphore(self.max_admin_updates)
+        self._locks: Dict[Any, _UserLock] = {}
+
+    def _is_admin_update(self, update: Any) -> bool:
+        if not isinstance(update, Update):
+            return False
+        chat = update.effective_chat
+        return chat is not None and chat.id in self.admin_chat_ids
+
+    @staticmethod
+    def _order_key(update: Any) -> Optional[Any]:
+        """مفتاح الترتيب: المستخدم، أو المحادثة إذا لم يوجد مستخدم"""
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user is not None:
+            return ('user', update.effective_user.id)
+        if update.effective_chat is not None:
+            return ('chat', update.effective_chat.id)
+        return None
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        # القفل قبل حجز الخانة، حتى لا تشغل تحديثات مستخدم واحد متراكمة خانات الآخرين
+        key = self._order_key(update)
+        lane = self._admin_lane if self._is_admin_update(update) else self._user_lane
+
+        if key is None:
+            async with lane:
+                await coroutine
+            return
+
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = _UserLock()
+        elif entry.users >= self.max_pending_per_user:
+            # إغراق من مستخدم واحد: إسقاط التحديث بدلاً من حجز خانات القبول خلف قفله
+            logger.warning(f"تم إسقاط تحديث من {key}: {entry.users} تحديثات معلقة بالفعل")
+            if hasattr(coroutine, 'close'):
+                coroutine.close()
+            return
+        entry.users += 1
+        try:
+            async with entry.lock:
+                async with lane:
+                    await coroutine
+        finally:
+            entry.users -= 1
+            if entry.users == 0:
+                self._locks.pop(key, None)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
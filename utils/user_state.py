@@ -0,0 +1,155 @@
+import logging
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# عدد رسائل البوت التي نحتفظ بمعرفاتها لحذفها لاحقاً
+MAX_TRACKED_MESSAGES = 20
+
+# حقول الحجز التي تحرر عند انتهاء مهلة المحادثة أو إلغائها
+DEPOSIT_FIELDS = ('unique_amount', 'deposit_address', 'deposit_start_time', 'base_amount',
+                  'final_usdt_amount', 'local_amount', 'rounded_local_amount')
+
+PRIMITIVES = (str, int, float, bool, type(None))
+
+
+def _compact(value: Any) -> Any:
+    """تحويل القيمة إلى أنواع أساسية فقط، ورفض الكائنات (رسائل، أزرار...)"""
+    if isinstance(value, PRIMITIVES):
+        return value
+    if isinstance(value, datetime):
+        return value.timestamp()
+    if isinstance(value, (list, tuple)):
+        return [_compact(item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): _compact(item) for key, item in value.items()}
+    raise TypeError(f"لا يمكن حفظ {type(value).__name__} في حالة المستخدم")
+
+
+class UserState:
+    """
+    حالة المستخدم المحفوظة (context.user_data) بحقول ثابتة وقيم أساسية فقط،
+    فيبقى حجمها في الذاكرة وفي قاعدة البيانات محدوداً.
+    تدعم واجهة القاموس المستخدمة في المعالجات، لكن تعيين مفتاح غير معروف يرفع KeyError.
+    """
+
+    __slots__ = (
+        # رسائل البوت والتنقل
+        'bot_messages', 'last_start_time', 'last_menu_action', 'verified_user',
+        'current_state', 'last_message',
+        # بيانات التحويل
+        'transfer_id', 'user_id', 'transfer_type', 'timestamp',
+        'local_currency', 'currency', 'wallet_id', 'wallet_name', 'account_number',
+        'digital_currency', 'usdt_network',
+        'recipient_name', 'recipient_number', 'transfer_agency', 'transfer_notes',
+        'confirmed_recipient_info',
+        # حجز الإيداع
+        'base_amount', 'unique_amount', 'final_usdt_amount', 'local_amount',
+        'rounded_local_amount', 'deposit_start_time', 'deposit_address',
+        'verification_message_id',
+        # المشرفين
+        'active_transfer_id', 'admin_info', 'transfer_info', 'preview_message_id',
+    )
+
+    def __init__(self):
+        self.clear()
+
+    # ----- واجهة القاموس -----
+
+    def __getitem__(self, key: str) -> Any:
+        value = getattr(self, key, None) if key in self.__slots__ else None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key not in self.__slots__:
+            raise KeyError(f"حقل غير معروف في حالة المستخدم: {key}")
+        object.__setattr__(self, key, _compact(value))
+
+    def __delitem__(self, key: str) -> None:
+        self[key]
+        object.__setattr__(self, key, None)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.__slots__ and getattr(self, key) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        return (key for key in self.__slots__ if getattr(self, key) is not None)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __bool__(self) -> bool:
+        return any(getattr(self, key) is not None for key in self.__slots__)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        value = getattr(self, key, None) if key in self.__slots__ else None
+        return default if value is None else value
+
+    def pop(self, key: str, default: Any = None) -> Any:
+        value = self.get(key)
+        if value is not None:
+            object.__setattr__(self, key, None)
+            return value
+        return default
+
+    def keys(self) -> List[str]:
+        return list(self)
+
+    def items(self) -> List[Tuple[str, Any]]:
+        return [(key, getattr(self, key)) for key in self]
+
+    def update(self, other: Any = None, **kwargs) -> None:
+        for key, value in dict(other or {}, **kwargs).items():
+            self[key] = value
+
+    def clear(self) -> None:
+        for key in self.__slots__:
+            object.__setattr__(self, key, None)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """نسخة قاموس عادية للعمليات المؤقتة (مثل حفظ التحويل)"""
+        return dict(self.items())
+
+    # ----- عمليات خاصة -----
+
+    def track_message(self, message_id: int) -> None:
+        """تسجيل رسالة للبوت مع الاحتفاظ بآخر MAX_TRACKED_MESSAGES فقط"""
+        messages = self.bot_messages or []
+        messages.append(int(message_id))
+        object.__setattr__(self, 'bot_messages', messages[-MAX_TRACKED_MESSAGES:])
+
+    def release_deposit(self) -> Optional[float]:
+        """تحرير المبلغ المميز المحجوز للإيداع وإرجاعه إن وجد"""
+        unique_amount = self.unique_amount
+        for key in DEPOSIT_FIELDS:
+            object.__setattr__(self, key, None)
+        return unique_amount
+
+    def load(self, data: Any) -> None:
+        """
+        تحميل حالة محفوظة مع تجاهل الحقول القديمة غير المعروفة
+        (مثل last_markup من ملفات PicklePersistence السابقة).
+        """
+        self.clear()
+        for key, value in dict(data or {}).items():
+            if key not in self.__slots__:
+                continue
+            try:
+                self[key] = value
+            except TypeError:
+                logger.warning(f"تم تجاهل الحقل {key} عند تحميل حالة المستخدم")
+
+    # ----- الحفظ -----
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # الحقول الفارغة لا تحفظ
+        return self.to_dict()
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.load(state)
+
+    def __repr__(self) -> str:
+        return f"UserState({self.to_dict()!r})"
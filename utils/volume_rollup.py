@@ -0,0 +1,54 @@
+import os
+import asyncio
+import logging
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class VolumeRollup:
+    """
+    مهمة دورية تجمع سجل تغييرات الأحجام (transfer_volume_deltas) في دلاء السلاسل الزمنية
+    وتحذف دلاء الدقائق القديمة، فيبقى مسار القراءة في لوحة التحكم للقراءة فقط.
+    """
+
+    def __init__(self, db, interval: float = None):
+        """
+        :param db: كائن قاعدة البيانات
+        :param interval: الفترة بين كل تجميع بالثواني
+        """
+        self.db = db
+        self.interval = interval or float(os.getenv('TIMESERIES_ROLLUP_INTERVAL', '30'))
+        self._task: Optional[asyncio.Task] = None
+
+    async def rollup_once(self) -> int:
+        """تجميع واحد حتى تفريغ السجل، يعيد عدد التغييرات المجمعة"""
+        rolled = await asyncio.to_thread(self.db.rollup_volume_deltas)
+        await asyncio.to_thread(self.db.prune_volume_buckets)
+        if rolled:
+            logger.debug(f"تم تجميع {rolled} تغيير في دلاء أحجام التحويلات")
+        return rolled
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.rollup_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"خطأ في تجميع أحجام التحويلات: {e}", exc_info=True)
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        """تشغيل التجميع الدوري في حلقة الأحداث الحالية"""
+        if self._task is not None:
+            return
+        self._task = asyncio.create_task(self._run(), name='volume-rollup')
+        logger.info(f"تم تشغيل تجميع أحجام التحويلات كل {self.interval:.0f} ثانية")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None